@@ -50,6 +50,16 @@ class ProvPermission(BaseUserPermission):
     permission_level = models.UserPermissionLevels.PROV
 
 
+class OwnerPermission(permissions.BasePermission):
+    """
+    Assert that a user is the owner of the resource - or a superuser.
+    """
+    message = 'You do not have permission to access this resource.'
+
+    def has_object_permission(self, request, view, obj):
+        return request.user.is_superuser or request.user == obj.owner
+
+
 class DataPushPermission(permissions.BasePermission):
     """
     Permission mixin to prevent access to POST and PUT methods by users who do not have the correct permission flag.
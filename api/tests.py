@@ -1,14 +1,26 @@
+import json
+import os
+import tempfile
 import typing
 
 import unittest
+from unittest import mock
 
+from django.apps import apps
 from django.contrib.auth import get_user_model
-from django.test import Client, TestCase
+from django.core.cache import cache
+from django.test import Client, TestCase, override_settings
 
+from bson import json_util
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APIClient
 
+from api.views import datasources as datasource_views
+from applications.models import Application
 from datasources import connectors, models
+from datasources.connectors.base import WriteBufferMode
+from datasources.connectors.csv import QueryShapeStats, index_builder, query_sampler, write_buffer
+from provenance import models as prov_models
 
 
 class RootApiTest(TestCase):
@@ -27,6 +39,23 @@ class RootApiTest(TestCase):
 
         self.assertEqual(response.status_code, 401)  # 401 Unauthorized
 
+    def test_metrics_staff_only(self):
+        """
+        Test that process metrics are only available to staff users.
+        """
+        client = APIClient()
+        client.force_authenticate(self.user)
+
+        response = client.get('/api/metrics/')
+        self.assertEqual(response.status_code, 403)
+
+        staff_user = get_user_model().objects.create_user('Test API Staff User', is_staff=True)
+        client.force_authenticate(staff_user)
+
+        response = client.get('/api/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('write_buffer.depth', response.json()['data'])
+
     def test_force_auth(self):
         """
         Test simply that we can access the API using forced authentication.
@@ -116,7 +145,7 @@ class DataSourceApiTest(TestCase):
         response = self.client.get('/api/datasources/')
         self.assertEqual(response.status_code, 200)
 
-        self.assertEqual(len(response.json()), 0)
+        self.assertEqual(len(response.json()['results']), 0)
 
         self.model = models.DataSource.objects.create(
             name=self.test_name,
@@ -126,9 +155,9 @@ class DataSourceApiTest(TestCase):
 
         response = self.client.get('/api/datasources/')
 
-        self.assertEqual(len(response.json()), 1)
+        self.assertEqual(len(response.json()['results']), 1)
 
-        datasource = response.json()[0]
+        datasource = response.json()['results'][0]
         self._assert_datasource_correct(datasource)
 
     def test_api_datasource_get(self):
@@ -150,6 +179,61 @@ class DataSourceApiTest(TestCase):
         datasource = response.json()
         self._assert_datasource_correct(datasource)
 
+    def test_api_datasource_list_pagination(self):
+        """
+        Test that the :class:`DataSource` API list is paginated using a cursor.
+        """
+        datasources = [
+            models.DataSource.objects.create(name=self.test_name + str(i), owner=self.user, url=self.test_url)
+            for i in range(5)
+        ]
+
+        response = self.client.get('/api/datasources/', {'page_size': 2})
+        self.assertEqual(response.status_code, 200)
+
+        pks = []
+        while True:
+            contents = response.json()
+            self.assertLessEqual(len(contents['results']), 2)
+            pks.extend(datasource['id'] for datasource in contents['results'])
+
+            if contents['next'] is None:
+                break
+
+            response = self.client.get(contents['next'])
+
+        self.assertEqual(pks, [datasource.pk for datasource in datasources])
+
+    def test_api_datasource_query_count(self):
+        """
+        Test that the number of queries to list or retrieve data sources does not depend on the number of
+        data sources or of their metadata items.
+        """
+        licence = models.Licence.objects.create(name='Test Licence', short_name='TL', owner=self.user)
+        fields = [
+            models.MetadataField.objects.create(name='Test Field ' + str(i), short_name='test_field_' + str(i))
+            for i in range(2)
+        ]
+
+        for i in range(10):
+            datasource = models.DataSource.objects.create(name=self.test_name + str(i), owner=self.user,
+                                                          url=self.test_url, licence=licence)
+            for field in fields:
+                datasource.metadata_items.create(field=field, value=str(i))
+
+        # Data sources with licences, metadata items and metadata fields
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/datasources/')
+
+        self.assertEqual(len(response.json()['results']), 10)
+        self.assertEqual(len(response.json()['results'][0]['metadata_items']), 2)
+        self.assertEqual(response.json()['results'][0]['licence']['name'], 'Test Licence')
+
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/datasources/{}/'.format(datasource.pk))
+
+        self.assertEqual(len(response.json()['metadata_items']), 2)
+
 
 class DataSourceApiFilterTest(TestCase):
     datasources = []
@@ -200,14 +284,14 @@ class DataSourceApiFilterTest(TestCase):
         response = self.client.get('/api/datasources/')
         self.assertEqual(response.status_code, 200)
 
-        contents = response.json()
+        contents = response.json()['results']
         self.assertEqual(len(contents), 3)
 
     def test_filter_yes(self):
         response = self.client.get('/api/datasources/?filter_field=yes')
         self.assertEqual(response.status_code, 200)
 
-        contents = response.json()
+        contents = response.json()['results']
         self.assertEqual(len(contents), 1)
         self.assertEqual(self.test_name + '-yes', contents[0]['name'])
 
@@ -215,10 +299,51 @@ class DataSourceApiFilterTest(TestCase):
         response = self.client.get('/api/datasources/?filter_field=no')
         self.assertEqual(response.status_code, 200)
 
-        contents = response.json()
+        contents = response.json()['results']
         self.assertEqual(len(contents), 1)
         self.assertEqual(self.test_name + '-no', contents[0]['name'])
 
+    def test_filter_multiple(self):
+        other_field = models.MetadataField.objects.create(name='Other filter field', short_name='other_field')
+        self.datasources[1].metadata_items.create(field=other_field, value='a')
+        self.datasources[2].metadata_items.create(field=other_field, value='a')
+
+        # Any number of filters are resolved in a single subquery
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/datasources/?filter_field=yes&other_field=a')
+
+        contents = response.json()['results']
+        self.assertEqual([self.test_name + '-yes'], [datasource['name'] for datasource in contents])
+
+        response = self.client.get('/api/datasources/?filter_field=no&other_field=b')
+        self.assertEqual(len(response.json()['results']), 0)
+
+    def test_filter_empty(self):
+        empty_field = models.MetadataField.objects.create(name='Empty filter field', short_name='empty_field')
+        self.datasources[1].metadata_items.create(field=empty_field, value='')
+
+        # Empty values have no facets so are matched against metadata items
+        response = self.client.get('/api/datasources/?empty_field=')
+        contents = response.json()['results']
+        self.assertEqual([self.test_name + '-yes'], [datasource['name'] for datasource in contents])
+
+        response = self.client.get('/api/datasources/?empty_field=&filter_field=yes')
+        self.assertEqual(len(response.json()['results']), 1)
+
+        response = self.client.get('/api/datasources/?empty_field=&filter_field=no')
+        self.assertEqual(len(response.json()['results']), 0)
+
+    def test_filter_updated(self):
+        item = models.MetadataItem.objects.get(datasource=self.datasources[2])
+        item.value = 'yes'
+        item.save()
+
+        response = self.client.get('/api/datasources/?filter_field=yes')
+        self.assertEqual(len(response.json()['results']), 2)
+
+        response = self.client.get('/api/datasources/?filter_field=no')
+        self.assertEqual(len(response.json()['results']), 0)
+
 
 class DataSourceApiPermissionsTest(TestCase):
     @classmethod
@@ -406,6 +531,513 @@ class DataSourceApiPermissionsTest(TestCase):
         self.assertEqual(response.status_code, 200)
 
 
+class DataSourceApiInternalTest(TestCase):
+    """
+    Test the :class:`DataSource` API for internal data sources backed by MongoDB.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('Test API User')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+        self.model = models.DataSource.objects.create(
+            name='Internal',
+            owner=self.user,
+            url='test_api_internal',
+            plugin_name='CsvToMongoConnector'
+        )
+        self.url = '/api/datasources/{}/data/'.format(self.model.pk)
+
+    def tearDown(self):
+        with self.model.data_connector as data_connector:
+            data_connector.clear_data()
+            data_connector.clean_data(index_fields=[], background=False)
+
+        QueryShapeStats.objects(collection=self.model.connector_string).delete()
+        self.model.delete()
+
+    def _post_rows(self, rows: typing.List[typing.Dict]):
+        response = self.client.post(self.url, rows, format='json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_api_datasource_aggregate(self):
+        """
+        Test that aggregations are calculated over data in an internal data source.
+        """
+        self._post_rows([
+            {'sensor': 'a', 'temp': 10, 'time': 0},
+            {'sensor': 'a', 'temp': 20, 'time': 1800},
+            {'sensor': 'a', 'temp': 30, 'time': 3600},
+            {'sensor': 'b', 'temp': 5, 'time': 0},
+        ])
+
+        response = self.client.get(self.url + 'aggregate/?group_by=sensor&metric=count,avg:temp,max:temp')
+        self.assertEqual(response.status_code, 200)
+
+        data = response.json()['data']
+        self.assertEqual(data, [
+            {'sensor': 'a', 'count': 3, 'avg_temp': 20, 'max_temp': 30},
+            {'sensor': 'b', 'count': 1, 'avg_temp': 5, 'max_temp': 5},
+        ])
+
+        response = self.client.get(self.url + 'aggregate/?sensor=a&metric=count&bucket=1h')
+        self.assertEqual(response.status_code, 200)
+
+        data = response.json()['data']
+        self.assertEqual(data, [
+            {'__bucket': 0, 'count': 2},
+            {'__bucket': 3600, 'count': 1},
+        ])
+
+        # A field named 'bucket' does not clash with the time bucket
+        self._post_rows([
+            {'sensor': 'c', 'temp': 40, 'time': 0, 'bucket': 'x'},
+            {'sensor': 'c', 'temp': 50, 'time': 3600, 'bucket': 'x'},
+            {'sensor': 'c', 'temp': 60, 'time': 3600, 'bucket': 'y'},
+        ])
+
+        response = self.client.get(self.url + 'aggregate/?sensor=c&group_by=bucket&metric=count&bucket=1h')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['data'], [
+            {'bucket': 'x', '__bucket': 0, 'count': 1},
+            {'bucket': 'x', '__bucket': 3600, 'count': 1},
+            {'bucket': 'y', '__bucket': 3600, 'count': 1},
+        ])
+
+        response = self.client.get(self.url + 'aggregate/?group_by=__bucket&bucket=1h')
+        self.assertEqual(response.status_code, 400)
+
+    def test_api_datasource_put_replace(self):
+        """
+        Test that PUTting data replaces all existing data in an internal data source.
+        """
+        self._post_rows([
+            {'sensor': 'a', 'temp': 10},
+            {'sensor': 'b', 'temp': 20},
+        ])
+
+        response = self.client.put(self.url, [{'sensor': 'c', 'temp': 30}], format='json')
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['data'], [{'sensor': 'c', 'temp': 30}])
+
+    def test_api_datasource_put_replace_batches(self):
+        """
+        Test that replacement data is inserted in batches, including a final partial batch.
+        """
+        rows = [{'sensor': 'a', 'temp': i} for i in range(5)]
+
+        with mock.patch('datasources.connectors.csv.REPLACE_BATCH_SIZE', 2):
+            response = self.client.put(self.url, rows, format='json')
+            self.assertEqual(response.status_code, 200)
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(row['temp'] for row in response.json()['data']), list(range(5)))
+
+        # Replacing with no data leaves an empty data source
+        response = self.client.put(self.url, [], format='json')
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.json()['data'], [])
+
+    def test_api_datasource_put_replace_buffered(self):
+        """
+        Test that rows still in the write buffer are replaced rather than written to the replacement data.
+        """
+        with tempfile.TemporaryDirectory() as buffer_dir, override_settings(WRITE_BUFFER_DIR=buffer_dir,
+                                                                             WRITE_BUFFER_FLUSH_INTERVAL=60):
+            with self.model.data_connector as data_connector:
+                data_connector.buffer_data({'sensor': 'a', 'temp': 10})
+
+            response = self.client.put(self.url, [{'sensor': 'c', 'temp': 30}], format='json')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(write_buffer.depth(), 0)
+
+            write_buffer.flush()
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.json()['data'], [{'sensor': 'c', 'temp': 30}])
+
+    def test_api_datasource_put_invalid(self):
+        """
+        Test that malformed replacement data is rejected and leaves existing data in place.
+        """
+        self._post_rows([{'sensor': 'a', 'temp': 10}])
+
+        for data in [[{'sensor': 'b'}, 1], [['sensor', 'b']], 'sensor', [{'sensor.name': 'b'}]]:
+            response = self.client.put(self.url, data, format='json')
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()['status'], 'error')
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.json()['data'], [{'sensor': 'a', 'temp': 10}])
+
+    def test_index_sync(self):
+        """
+        Test that indexes are created and dropped to match the requested index fields.
+        """
+        with self.model.data_connector as data_connector:
+            collection = data_connector._get_collection()
+
+            # Index created before the requested fields were recorded
+            collection.create_index('temp')
+
+            data_connector.clean_data(index_fields=['sensor'], background=False)
+
+            state = data_connector.get_index_state()
+            self.assertEqual(state['fields'], ['sensor'])
+            self.assertEqual(state['status'], 'ready')
+            self.assertIn('sensor_1', collection.index_information())
+            self.assertNotIn('temp_1', collection.index_information())
+
+            data_connector.clean_data(index_fields=[], background=False)
+
+            state = data_connector.get_index_state()
+            self.assertEqual(state['fields'], [])
+            self.assertNotIn('sensor_1', collection.index_information())
+
+    def test_index_sync_background(self):
+        """
+        Test that indexes are built in the background, once per collection in each batch however many times requested.
+        """
+        with self.model.data_connector as data_connector:
+            collection = data_connector._get_collection()
+
+            data_connector.clean_data(index_fields=['sensor'])
+            data_connector.clean_data(index_fields=['sensor', 'temp'])
+            self.assertEqual(data_connector.get_index_state()['status'], 'building')
+
+            index_builder.drain()
+
+            state = data_connector.get_index_state()
+            self.assertEqual(state['fields'], ['sensor', 'temp'])
+            self.assertEqual(state['status'], 'ready')
+            self.assertIn('sensor_1', collection.index_information())
+            self.assertIn('temp_1', collection.index_information())
+
+            with mock.patch('datasources.connectors.csv._sync_indexes') as sync_indexes:
+                connectors.csv._sync_index_batch([data_connector.location] * 3)
+            sync_indexes.assert_called_once_with(data_connector.location)
+
+            data_connector.clean_data(index_fields=[], background=False)
+
+    def test_api_datasource_indexes(self):
+        """
+        Test that the status of indexes on an internal data source can be retrieved.
+        """
+        with self.model.data_connector as data_connector:
+            data_connector.clean_data(index_fields=['sensor'], background=False)
+
+        response = self.client.get(self.url + 'indexes/')
+        self.assertEqual(response.status_code, 200)
+
+        data = response.json()['data']
+        self.assertEqual(data['fields'], ['sensor'])
+        self.assertEqual(data['status'], 'ready')
+
+    @override_settings(INDEX_ADVISOR_SAMPLE_RATE=1)
+    def test_query_sampling(self):
+        """
+        Test that queries against an internal data source are sampled for the index advisor.
+        """
+        self._post_rows([
+            {'sensor': 'a', 'temp': 10},
+            {'sensor': 'b', 'temp': 20},
+        ])
+
+        response = self.client.get(self.url + '?sensor=a')
+        self.assertEqual(response.status_code, 200)
+
+        query_sampler.drain()
+        stats = QueryShapeStats.objects.get(collection=self.model.connector_string, fields=['sensor'])
+        self.assertEqual(stats.queries, 1)
+
+        # Operators are recorded against the field they filter
+        response = self.client.get(self.url + '?temp__gt=15&temp__lt=30')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['data'], [{'sensor': 'b', 'temp': 20}])
+
+        query_sampler.drain()
+        stats = QueryShapeStats.objects.get(collection=self.model.connector_string, fields=['temp'])
+        self.assertEqual(stats.queries, 1)
+        self.assertFalse(QueryShapeStats.objects(collection=self.model.connector_string,
+                                                 fields__in=['temp__gt', 'temp__lt']).count())
+
+    def test_api_datasource_aggregate_invalid(self):
+        """
+        Test that an invalid aggregation is rejected.
+        """
+        response = self.client.get(self.url + 'aggregate/?metric=median:temp')
+        self.assertEqual(response.status_code, 400)
+
+        # Field names which MongoDB would interpret as operators or paths
+        for query in ['$where=1', 'group_by=$site', 'metric=sum:a.b', 'bucket=1h&bucket_field=$time']:
+            response = self.client.get(self.url + 'aggregate/?' + query)
+            self.assertEqual(response.status_code, 400)
+
+    @override_settings(PROV_ASYNC_WRITES=False)
+    def test_api_datasource_prov_pagination(self):
+        """
+        Test that PROV records can be filtered and retrieved a page at a time.
+        """
+        # Records left by other tests with the same primary key
+        prov_models.prov_writer.drain()
+        prov_models.ProvWrapper.objects(related_pk=self.model.pk).delete()
+
+        for _ in range(5):
+            prov_models.ProvWrapper.create_prov(self.model, self.user.get_uri(),
+                                                activity_type=prov_models.ProvActivity.ACCESS)
+
+        url = '/api/datasources/{}/prov/'.format(self.model.pk)
+        params = {'activity': 'access', 'limit': 2}
+
+        records = []
+        for expected_count in [2, 2, 1]:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+
+            data = json.loads(b''.join(response.streaming_content))
+            self.assertEqual(len(data['prov']), expected_count)
+            records.extend(data['prov'])
+
+            params['cursor'] = data['next']
+
+        self.assertIsNone(params['cursor'])
+        self.assertEqual(len({record['_id']['$oid'] for record in records}), 5)
+
+        response = self.client.get(url, {'since': '2100-01-01'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(b''.join(response.streaming_content))['prov'], [])
+
+        response = self.client.get(url, {'activity': 'delete'})
+        self.assertEqual(response.status_code, 400)
+
+        prov_models.ProvWrapper.objects(related_pk=self.model.pk).delete()
+
+    @override_settings(PROV_ASYNC_WRITES=False)
+    def test_api_datasource_prov_missing_entries(self):
+        """
+        Test that PROV records whose entries have been removed since their wrappers were read give valid JSON.
+        """
+        wrappers = [{'entry': i} for i in range(4)]
+        batches = [[], [{'_id': 1}], [], [{'_id': 2}]]
+
+        with mock.patch('api.views.datasources.PROV_FETCH_BATCH_SIZE', 1), \
+                mock.patch.object(prov_models.ProvWrapper, 'get_entries', side_effect=batches):
+            content = ''.join(datasource_views.DataSourceApiViewset._stream_prov(wrappers, None))
+
+        self.assertEqual(json.loads(content), {'prov': [{'_id': 1}, {'_id': 2}], 'next': None})
+
+    def test_api_datasource_prov_usage(self):
+        """
+        Test that counts of PROV records are retrieved from rollups.
+        """
+        # Records left by other tests with the same primary key
+        prov_models.prov_writer.drain()
+        prov_models.ProvRollup.objects(related_pk=self.model.pk).delete()
+
+        for _ in range(3):
+            prov_models.ProvWrapper.create_prov(self.model, self.user.get_uri(),
+                                                activity_type=prov_models.ProvActivity.ACCESS)
+
+        url = '/api/datasources/{}/prov/usage/'.format(self.model.pk)
+
+        for granularity in ['hour', 'day']:
+            response = self.client.get(url, {'activity': 'access', 'granularity': granularity})
+            self.assertEqual(response.status_code, 200)
+
+            data = response.json()['data']
+            self.assertEqual(sum(rollup['count'] for rollup in data), 3)
+            self.assertTrue(all(rollup['application'] == 'piot:app-pedasi' for rollup in data))
+
+        response = self.client.get(url, {'granularity': 'week'})
+        self.assertEqual(response.status_code, 400)
+
+        prov_models.ProvWrapper.objects(related_pk=self.model.pk).delete()
+        prov_models.ProvRollup.objects(related_pk=self.model.pk).delete()
+
+    @override_settings(PROV_ASYNC_WRITES=False)
+    def test_api_prov_lineage(self):
+        """
+        Test that the PROV lineage graph links data sources, applications and users.
+        """
+        application = Application.objects.create(name='Test Lineage Application', owner=self.user)
+        other = models.DataSource.objects.create(
+            name='Internal Lineage',
+            owner=self.user,
+            url='test_api_lineage',
+            plugin_name='CsvToMongoConnector'
+        )
+        private = models.DataSource.objects.create(
+            name='Private Lineage',
+            owner=get_user_model().objects.create_user('Test Lineage Owner'),
+            url='test_api_lineage_private',
+            plugin_name='CsvToMongoConnector',
+            public_permission_level=models.UserPermissionLevels.NONE
+        )
+        application_id = 'piot:app-' + str(application.pk)
+
+        # Records left by other tests with the same primary keys
+        prov_models.prov_writer.drain()
+        prov_models.ProvEdge.objects(application_id=application_id).delete()
+        prov_models.ProvEdge.objects(related_pk__in=[self.model.pk, other.pk, private.pk]).delete()
+
+        for instance in [self.model, self.model, other, private]:
+            prov_models.ProvWrapper.create_prov(instance, self.user.get_uri(), application=application,
+                                                activity_type=prov_models.ProvActivity.ACCESS)
+
+        model_id = prov_models.ProvEntry.get_entity_id('datasource', self.model.pk)
+        other_id = prov_models.ProvEntry.get_entity_id('datasource', other.pk)
+        private_id = prov_models.ProvEntry.get_entity_id('datasource', private.pk)
+
+        url = '/api/datasources/{}/prov/lineage/'.format(self.model.pk)
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+        data = response.json()['data']
+        nodes = {node['id']: node['type'] for node in data['nodes']}
+        self.assertEqual(nodes[model_id], 'entity')
+        self.assertEqual(nodes[application_id], 'application')
+        self.assertNotIn(other_id, nodes)
+
+        used = [link for link in data['links']
+                if link['relation'] == 'used' and link['source'] == application_id]
+        self.assertEqual(len(used), 1)
+        self.assertEqual(used[0]['count'], 2)
+        self.assertEqual(nodes[used[0]['on_behalf_of']], 'user')
+
+        # Other data sources used by the same application
+        response = self.client.get(url, {'depth': 2})
+        nodes = {node['id'] for node in response.json()['data']['nodes']}
+        self.assertIn(other_id, nodes)
+
+        # Data sources on which the user does not have the PROV permission level are not included
+        self.assertNotIn(private_id, nodes)
+        acted = [link for link in response.json()['data']['links'] if link['relation'] == 'actedOnBehalfOf']
+        self.assertEqual(acted[0]['count'], 3)
+
+        response = self.client.get(url, {'depth': 10})
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.get('/api/applications/{}/prov/lineage/'.format(application.pk))
+        self.assertEqual(response.status_code, 200)
+
+        nodes = {node['id'] for node in response.json()['data']['nodes']}
+        self.assertLessEqual({model_id, other_id, application_id}, nodes)
+        self.assertNotIn(private_id, nodes)
+
+        # Only the owner of an application may see its lineage
+        self.client.force_authenticate(get_user_model().objects.create_user('Test Lineage User'))
+        response = self.client.get('/api/applications/{}/prov/lineage/'.format(application.pk))
+        self.assertEqual(response.status_code, 403)
+
+        prov_models.ProvEdge.objects(application_id=application_id).delete()
+        prov_models.ProvWrapper.objects(related_pk__in=[self.model.pk, other.pk, private.pk]).delete()
+
+    def test_api_datasource_post_buffered(self):
+        """
+        Test that single rows pushed to a buffered data source are written once the buffer is flushed.
+        """
+        self.model.write_buffer = WriteBufferMode.DURABLE
+        self.model.save()
+
+        with tempfile.TemporaryDirectory() as buffer_dir, override_settings(WRITE_BUFFER_DIR=buffer_dir,
+                                                                             WRITE_BUFFER_FLUSH_INTERVAL=60):
+            for i in range(3):
+                response = self.client.post(self.url, {'sensor': 'a', 'temp': i}, format='json')
+                self.assertEqual(response.status_code, 202)
+
+            self.assertEqual(write_buffer.depth(), 3)
+
+            write_buffer.flush()
+            self.assertEqual(write_buffer.depth(), 0)
+            self.assertEqual(os.listdir(buffer_dir), [])
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['data']), 3)
+
+        # Field names which cannot be stored are rejected before being buffered
+        response = self.client.post(self.url, {'sensor.name': 'a', 'temp': 1}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.post(self.url, {'$set': 'a'}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_write_buffer_rejected(self):
+        """
+        Test that rows which cannot be written are moved out of the buffer without blocking valid rows.
+        """
+        with tempfile.TemporaryDirectory() as buffer_dir, override_settings(WRITE_BUFFER_DIR=buffer_dir,
+                                                                             WRITE_BUFFER_FLUSH_INTERVAL=60):
+            # Bypass validation - e.g. a journal written before rows were validated
+            write_buffer.append(self.model.connector_string, {'sensor': 'a', 'temp': 10})
+            write_buffer.append(self.model.connector_string, {'sensor.name': 'b', 'temp': 20})
+            write_buffer.append(self.model.connector_string, {'sensor': 'c', 'temp': 30})
+
+            write_buffer.flush()
+            self.assertEqual(write_buffer.depth(), 0)
+            self.assertEqual(os.listdir(buffer_dir), ['rejected'])
+
+            rejected_dir = os.path.join(buffer_dir, 'rejected')
+            with open(os.path.join(rejected_dir, os.listdir(rejected_dir)[0])) as f:
+                self.assertEqual(len(f.readlines()), 1)
+
+        response = self.client.get(self.url)
+        self.assertCountEqual(response.json()['data'], [{'sensor': 'a', 'temp': 10}, {'sensor': 'c', 'temp': 30}])
+
+    def test_write_buffer_reused_pid(self):
+        """
+        Test that a journal left by an exited process is claimed even if its process id has been reused.
+        """
+        with tempfile.TemporaryDirectory() as buffer_dir, override_settings(WRITE_BUFFER_DIR=buffer_dir,
+                                                                             WRITE_BUFFER_FLUSH_INTERVAL=60):
+            # Process id of this process, but an earlier start time
+            owner = '{0}-0'.format(os.getpid())
+            with open(write_buffer._journal_name(self.model.connector_string, owner, 'journal'), 'w') as journal:
+                journal.write(json_util.dumps({'sensor': 'a', 'temp': 10}) + '\n')
+
+            write_buffer.flush()
+            self.assertEqual(os.listdir(buffer_dir), [])
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.json()['data'], [{'sensor': 'a', 'temp': 10}])
+
+    def test_write_buffer_replay(self):
+        """
+        Test that a journal left by an exited process is written without duplicating rows already written.
+        """
+        with tempfile.TemporaryDirectory() as buffer_dir, override_settings(WRITE_BUFFER_DIR=buffer_dir,
+                                                                             WRITE_BUFFER_FLUSH_INTERVAL=60):
+            with self.model.data_connector as data_connector:
+                data_connector.buffer_data({'sensor': 'a', 'temp': 10})
+                data_connector.buffer_data({'sensor': 'b', 'temp': 20})
+
+            # Pretend the journal belongs to a process which crashed after writing one of the rows
+            journal = os.path.join(buffer_dir, os.listdir(buffer_dir)[0])
+            with open(journal) as f:
+                written_row = json_util.loads(f.readlines()[-1])
+            data_connector._get_collection().insert_one(written_row)
+
+            write_buffer._journals.pop(self.model.connector_string).close()
+            write_buffer._journal_depth.clear()
+            os.rename(journal, journal.replace('.{}.'.format(write_buffer._owner), '.999999999.'))
+
+            write_buffer.flush()
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertCountEqual(response.json()['data'], [{'sensor': 'a', 'temp': 10}, {'sensor': 'b', 'temp': 20}])
+
+
 class DataSourceApiIoTUKTest(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -587,5 +1219,105 @@ class DataSourceApiHyperCatTest(TestCase):
         # TODO test content
 
 
+class SearchApiTest(TestCase):
+    """
+    Test that the search API returns ranked data sources which the user has permission to access.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('Test Search API User')
+        cls.owner = get_user_model().objects.create_user('Test Search API Owner')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+        processor = apps.get_app_config('haystack').signal_processor
+
+        # Transactions are never committed within a test case
+        patcher = mock.patch('core.signals.transaction.on_commit', lambda func: func())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(processor.flush)
+
+        self.public = models.DataSource.objects.create(name='Public Quokka Counts', owner=self.owner)
+        self.private = models.DataSource.objects.create(
+            name='Private Quokka Counts', owner=self.owner,
+            public_permission_level=models.UserPermissionLevels.NONE
+        )
+        self.granted = models.DataSource.objects.create(
+            name='Granted Quokka Counts', owner=self.owner,
+            public_permission_level=models.UserPermissionLevels.NONE
+        )
+        models.UserPermissionLink.objects.create(user=self.user, datasource=self.granted,
+                                                 granted=models.UserPermissionLevels.VIEW)
+
+        processor.flush()
+        cache.clear()
+
+    def _search(self, **params):
+        response = self.client.get('/api/search/', params)
+        self.assertEqual(response.status_code, 200)
+
+        return response.json()['data']
+
+    def test_search_permissions(self):
+        results = self._search(q='quokka')['results']
+        self.assertEqual({result['id'] for result in results}, {self.public.pk, self.granted.pk})
+        self.assertIn('quokka', results[0]['highlights'][0].lower())
+
+        results = self._search(q='quokka', permission='data')['results']
+        self.assertEqual([result['id'] for result in results], [self.public.pk])
+
+        self.client.force_authenticate(self.owner)
+        results = self._search(q='quokka')['results']
+        self.assertEqual(len(results), 3)
+
+    def test_search_pagination(self):
+        data = self._search(q='quokka', page_size=1)
+        self.assertEqual(len(data['results']), 1)
+        ids = [data['results'][0]['id']]
+
+        while data['next'] is not None:
+            data = self._search(q='quokka', page_size=1, cursor=data['next'])
+            ids.extend(result['id'] for result in data['results'])
+
+        self.assertCountEqual(ids, [self.public.pk, self.granted.pk])
+
+    def test_search_pagination_index_changed(self):
+        """
+        Test that results are not repeated when a data source ranked before the cursor is added between pages.
+        """
+        ranked = [(self.public.pk, 2.0, []), (self.granted.pk, 1.0, [])]
+
+        with mock.patch('api.views.search.get_ranked_results', return_value=ranked):
+            data = self._search(q='quokka', page_size=1)
+        self.assertEqual([result['id'] for result in data['results']], [self.public.pk])
+
+        new = models.DataSource.objects.create(name='New Quokka Counts', owner=self.owner)
+        with mock.patch('api.views.search.get_ranked_results', return_value=[(new.pk, 3.0, [])] + ranked):
+            data = self._search(q='quokka', page_size=1, cursor=data['next'])
+        self.assertEqual([result['id'] for result in data['results']], [self.granted.pk])
+        self.assertIsNone(data['next'])
+
+    def test_search_cache(self):
+        self._search(q='quokka')
+
+        # Permissions are checked on cached results
+        self.granted.delete()
+
+        with mock.patch('api.views.search.SearchQuerySet') as search:
+            results = self._search(q='quokka')['results']
+
+        search.assert_not_called()
+        self.assertEqual([result['id'] for result in results], [self.public.pk])
+
+    def test_search_invalid(self):
+        for params in [{}, {'q': 'quokka', 'permission': 'all'}, {'q': 'quokka', 'cursor': 'x'},
+                       {'q': 'quokka', 'page_size': 0}]:
+            response = self.client.get('/api/search/', params)
+            self.assertEqual(response.status_code, 400)
+
+
 if __name__ == '__main__':
     TestCase.run()
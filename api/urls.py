@@ -2,7 +2,10 @@ from django.urls import include, path
 
 from rest_framework import routers
 
+from .views import applications as application_views
 from .views import datasources as datasource_views
+from .views import metrics as metrics_views
+from .views import search as search_views
 
 app_name = 'api'
 
@@ -11,6 +14,18 @@ router = routers.DefaultRouter()
 router.register('datasources', datasource_views.DataSourceApiViewset)
 
 urlpatterns = [
+    path('applications/<int:pk>/prov/lineage/',
+         application_views.ApplicationProvLineageApiView.as_view(),
+         name='application-prov-lineage'),
+
+    path('metrics/',
+         metrics_views.MetricsApiView.as_view(),
+         name='metrics'),
+
+    path('search/',
+         search_views.SearchApiView.as_view(),
+         name='search'),
+
     path('',
          include(router.urls)),
 ]
@@ -0,0 +1,48 @@
+"""
+This module contains API endpoints exposing information about PEDASI Applications.
+"""
+
+from django.http import JsonResponse
+from django.shortcuts import get_object_or_404
+
+from networkx.readwrite import json_graph
+from rest_framework import request, views
+
+from .. import permissions
+from .datasources import filter_lineage_graph, get_lineage_depth, PROV_LINEAGE_MAX_EDGES
+from applications import models
+from provenance import models as prov_models
+
+
+class ApplicationProvLineageApiView(views.APIView):
+    """
+    Provides a view for:
+
+    /api/applications/<int>/prov/lineage/
+      Retrieve the PROV lineage graph around an :class:`applications.models.Application` - the data sources it has used
+      and the users on whose behalf it used them.  Only available to the owner of the application.
+      Only data sources on which the user has the PROV permission level are included.
+    """
+    permission_classes = [permissions.OwnerPermission]
+
+    def get(self, request: request.Request, pk: int, format=None):
+        instance = get_object_or_404(models.Application, pk=pk)
+        self.check_object_permissions(request, instance)
+
+        try:
+            depth = get_lineage_depth(request.query_params)
+
+        except ValueError as e:
+            return JsonResponse({
+                'status': 'error',
+                'message': str(e),
+            }, status=400)
+
+        graph = prov_models.ProvEdge.traverse(application_id='piot:app-' + str(instance.pk),
+                                              depth=depth, max_edges=PROV_LINEAGE_MAX_EDGES)
+        graph = filter_lineage_graph(graph, request.user)
+
+        return JsonResponse({
+            'status': 'success',
+            'data': json_graph.node_link_data(graph),
+        })
@@ -2,21 +2,126 @@
 This module contains the API endpoint viewset defining the PEDASI Application API.
 """
 
+from collections import abc as collections_abc
 import csv
+import datetime
 import json
 import typing
 
+from bson import json_util
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
 from django.db.models import ObjectDoesNotExist
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils import dateparse, timezone
+import networkx
+from networkx.readwrite import json_graph
 
-from rest_framework import decorators, request, response, viewsets
+from rest_framework import decorators, pagination, request, response, viewsets
 from requests.exceptions import HTTPError
 
 from .. import permissions
+from applications.models import Application
 from datasources import models, serializers
-from datasources.connectors.base import DatasetNotFoundError
+from datasources.connectors.base import DatasetNotFoundError, WriteBufferMode
 from provenance import models as prov_models
 
+#: Default number of data sources in each page of results
+DATASOURCE_PAGE_SIZE = 100
+
+#: Maximum number of data sources in each page of results
+DATASOURCE_MAX_PAGE_SIZE = 1000
+
+#: Default number of PROV records in each page of results
+PROV_PAGE_SIZE = 100
+
+#: Maximum number of PROV records in each page of results
+PROV_MAX_PAGE_SIZE = 1000
+
+#: Number of PROV records fetched from the database at once while streaming a response
+PROV_FETCH_BATCH_SIZE = 100
+
+#: Maximum number of steps when traversing the PROV lineage graph
+PROV_LINEAGE_MAX_DEPTH = 3
+
+#: Maximum number of edges of the PROV lineage graph in a response
+PROV_LINEAGE_MAX_EDGES = 1000
+
+
+def get_lineage_depth(params: typing.Mapping[str, str]) -> int:
+    """
+    Get the number of steps to traverse the PROV lineage graph from query parameters.
+
+    :raises ValueError: Depth is not valid
+    """
+    depth = int(params.get('depth', 1))
+    if not 1 <= depth <= PROV_LINEAGE_MAX_DEPTH:
+        raise ValueError('Depth must be between 1 and {0}'.format(PROV_LINEAGE_MAX_DEPTH))
+
+    return depth
+
+
+def filter_lineage_graph(graph: networkx.MultiDiGraph, user) -> networkx.MultiDiGraph:
+    """
+    Remove from a PROV lineage graph the model instances whose PROV records a user may not see.
+
+    A user may see data sources on which they have the PROV permission level and applications which they own.
+    Applications and users are removed unless they are linked to a remaining model instance.
+
+    :param graph: Lineage graph from :meth:`provenance.models.ProvEdge.traverse` - modified in place
+    :param user: User requesting the graph
+    :return: Filtered lineage graph
+    """
+    entities = {}
+    for node, data in graph.nodes(data=True):
+        if data['type'] == 'entity':
+            entities.setdefault((data['app_label'], data['model_name']), {})[data['pk']] = node
+
+    visible = set()
+
+    datasources = entities.pop(('datasources', 'datasource'), {})
+    if datasources:
+        permitted = models.DataSource.objects.filter(
+            models.DataSource.permission_level_filter(user, models.UserPermissionLevels.PROV),
+            pk__in=datasources
+        ).values_list('pk', flat=True)
+        visible.update(datasources[pk] for pk in permitted)
+
+    applications = entities.pop(('applications', 'application'), {})
+    if applications:
+        permitted = Application.objects.filter(pk__in=applications)
+        if not user.is_superuser:
+            permitted = permitted.filter(owner_id=user.pk)
+        visible.update(applications[pk] for pk in permitted.values_list('pk', flat=True))
+
+    # Applications and users which acted upon the remaining instances
+    for source, target, data in list(graph.edges(data=True)):
+        if data['relation'] == 'used' and target in visible:
+            visible.update({source, data['on_behalf_of']})
+
+    graph.remove_nodes_from([node for node in list(graph.nodes) if node not in visible])
+
+    # Counts of actions on behalf of users should include only the remaining instances
+    for source, target, data in graph.edges(data=True):
+        if data['relation'] == 'actedOnBehalfOf':
+            data['count'] = sum(
+                used['count'] for edges in graph[source].values()
+                for used in edges.values()
+                if used['relation'] == 'used' and used['on_behalf_of'] == target
+            )
+
+    return graph
+
+
+class DataSourceCursorPagination(pagination.CursorPagination):
+    """
+    Paginate data sources by id using a cursor - the cost of fetching a page does not increase with its position.
+    """
+    ordering = 'pk'
+    page_size = DATASOURCE_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = DATASOURCE_MAX_PAGE_SIZE
+
 
 class DataSourceApiViewset(viewsets.ReadOnlyModelViewSet):
     """
@@ -24,12 +129,23 @@ class DataSourceApiViewset(viewsets.ReadOnlyModelViewSet):
 
     /api/datasources/
       List all :class:`datasources.models.DataSource`\ s.
+      Results are paginated using a cursor - follow the 'next' link to get the next page.
+      The number of results in each page may be set using 'page_size'.
 
     /api/datasources/<int>/
       Retrieve a single :class:`datasources.models.DataSource`.
 
     /api/datasources/<int>/prov/
       Retrieve PROV records related to a :class:`datasources.models.DataSource`.
+      Results are filtered by time, activity type and application, and paginated using a cursor.
+
+    /api/datasources/<int>/prov/usage/
+      Retrieve counts of PROV records related to a :class:`datasources.models.DataSource` per time bucket.
+
+    /api/datasources/<int>/prov/lineage/
+      Retrieve the PROV lineage graph around a :class:`datasources.models.DataSource` - the applications and users
+      which have used it and, at greater depth, the other data sources they have used.
+      Only data sources on which the user has the PROV permission level are included.
 
     /api/datasources/<int>/metadata/
       Retrieve :class:`datasources.models.DataSource` metadata via API call to data source URL.
@@ -37,6 +153,14 @@ class DataSourceApiViewset(viewsets.ReadOnlyModelViewSet):
     /api/datasources/<int>/data/
       Retrieve :class:`datasources.models.DataSource` data via API call to data source URL.
 
+    /api/datasources/<int>/data/aggregate/
+      Retrieve the result of an aggregation over :class:`datasources.models.DataSource` data.
+      Only applicable to internal data sources.
+
+    /api/datasources/<int>/data/indexes/
+      Retrieve the status of indexes on :class:`datasources.models.DataSource` data.
+      Only applicable to internal data sources.
+
     /api/datasources/<int>/datasets/
       Retrieve :class:`datasources.models.DataSource` list of data sets via API call to data source URL.
 
@@ -49,6 +173,16 @@ class DataSourceApiViewset(viewsets.ReadOnlyModelViewSet):
     queryset = models.DataSource.objects.all()
     serializer_class = serializers.DataSourceSerializer
     permission_classes = [permissions.ViewPermission]
+    pagination_class = DataSourceCursorPagination
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+
+        if self.action in {'list', 'retrieve'}:
+            # Fetch everything required by the serializer in a fixed number of queries
+            queryset = queryset.select_related('licence').prefetch_related('metadata_items__field')
+
+        return queryset
 
     def _create_prov_entry(self, instance: models.DataSource) -> None:
         """
@@ -65,7 +199,10 @@ class DataSourceApiViewset(viewsets.ReadOnlyModelViewSet):
                 instance,
                 self.request.user.get_uri(),
                 application=application,
-                activity_type=prov_models.ProvActivity.ACCESS
+                activity_type=prov_models.ProvActivity.ACCESS,
+                asynchronous=True,
+                sample_rate=instance.prov_sample_rate,
+                coalesce_window=instance.prov_coalesce_window
             )
 
         except ObjectDoesNotExist:
@@ -73,7 +210,10 @@ class DataSourceApiViewset(viewsets.ReadOnlyModelViewSet):
             prov_models.ProvWrapper.create_prov(
                 instance,
                 self.request.user.get_uri(),
-                activity_type=prov_models.ProvActivity.ACCESS
+                activity_type=prov_models.ProvActivity.ACCESS,
+                asynchronous=True,
+                sample_rate=instance.prov_sample_rate,
+                coalesce_window=instance.prov_coalesce_window
             )
 
         except AttributeError:
@@ -85,16 +225,33 @@ class DataSourceApiViewset(viewsets.ReadOnlyModelViewSet):
         Query filter to filter data sources by variable metadata.
 
         Query parameters are key value pairs of the metadata field short name and the metadata value.
+        Data sources are matched using their :class:`datasources.models.DataSourceFacet`\ s, so any number of filters
+        is resolved by a single indexed lookup rather than a join per filter.
+        Empty metadata values have no facets, so filters on an empty value are matched against metadata items.
 
         :return: Filtered queryset
         """
-        for key, value in self.request.query_params.items():
+        ignored_params = {
             # The key 'search' is used to activate filters.SearchFilter - don't interfere with it
-            if key == 'search':
+            'search',
+            self.paginator.cursor_query_param,
+            self.paginator.page_size_query_param,
+        }
+
+        facet_values = set()
+        for key, value in self.request.query_params.items():
+            if key in ignored_params:
                 continue
 
-            queryset = queryset.filter(metadata_items__field__short_name=key,
-                                       metadata_items__value=value)
+            if value:
+                facet_values.add((models.DataSourceFacet.METADATA_PREFIX + key, value))
+
+            else:
+                queryset = queryset.filter(metadata_items__field__short_name=key,
+                                           metadata_items__value=value)
+
+        if facet_values:
+            queryset = queryset.filter(pk__in=models.DataSourceFacet.filter_datasources(facet_values))
 
         return queryset
 
@@ -164,25 +321,203 @@ class DataSourceApiViewset(viewsets.ReadOnlyModelViewSet):
         serializer = self.get_serializer(queryset, many=True)
         return response.Response(serializer.data)
 
+    @staticmethod
+    def _parse_prov_time(value: str) -> datetime.datetime:
+        """
+        Parse a date or datetime passed as a query parameter - timezone is assumed to be UTC if not specified.
+        """
+        parsed = dateparse.parse_datetime(value)
+        if parsed is None:
+            date = dateparse.parse_date(value)
+            if date is None:
+                raise ValueError('Invalid date or datetime \'{0}\''.format(value))
+
+            parsed = datetime.datetime.combine(date, datetime.time())
+
+        if timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed, datetime.timezone.utc)
+
+        return parsed
+
+    @staticmethod
+    def _encode_prov_cursor(wrapper: typing.Mapping[str, typing.Any]) -> str:
+        """
+        Encode the position of a raw :class:`ProvWrapper` document as a pagination cursor.
+        """
+        timestamp = wrapper['timestamp'].replace(tzinfo=datetime.timezone.utc)
+        return '{0}_{1}'.format(int(timestamp.timestamp() * 1000), wrapper['_id'])
+
+    @staticmethod
+    def _decode_prov_cursor(cursor: str) -> typing.Tuple[datetime.datetime, ObjectId]:
+        """
+        Decode a pagination cursor into the timestamp and id of the last :class:`ProvWrapper` on the previous page.
+        """
+        try:
+            timestamp, wrapper_id = cursor.split('_')
+            return (
+                datetime.datetime.fromtimestamp(int(timestamp) / 1000, datetime.timezone.utc),
+                ObjectId(wrapper_id)
+            )
+
+        except (TypeError, ValueError, InvalidId) as exc:
+            raise ValueError('Invalid cursor \'{0}\''.format(cursor)) from exc
+
+    def _get_prov_filters(self, params: typing.Mapping[str, str]) -> typing.Dict[str, typing.Any]:
+        """
+        Get the filters to apply to PROV records from query parameters.
+
+        :raises ValueError: A query parameter is not valid
+        """
+        filters = {}
+
+        for param in ('since', 'until'):
+            if param in params:
+                filters[param] = self._parse_prov_time(params[param])
+
+        if 'activity' in params:
+            try:
+                filters['activity_type'] = prov_models.ProvActivity[params['activity'].upper()]
+
+            except KeyError as exc:
+                raise ValueError('Invalid activity \'{0}\''.format(params['activity'])) from exc
+
+        if 'application' in params:
+            filters['application_id'] = 'piot:app-' + params['application']
+
+        if 'cursor' in params:
+            filters['after'] = self._decode_prov_cursor(params['cursor'])
+
+        return filters
+
+    @staticmethod
+    def _stream_prov(wrappers: typing.List[typing.Mapping[str, typing.Any]],
+                     next_cursor: typing.Optional[str]) -> typing.Iterator[str]:
+        """
+        Generate a JSON response containing PROV records, fetching the records in batches.
+        """
+        yield '{"prov": ['
+
+        written = False
+        for i in range(0, len(wrappers), PROV_FETCH_BATCH_SIZE):
+            entry_ids = [wrapper['entry'] for wrapper in wrappers[i:i + PROV_FETCH_BATCH_SIZE]]
+
+            # Entries may have been archived or deleted since the wrappers were read
+            entries = prov_models.ProvWrapper.get_entries(entry_ids)
+            if not entries:
+                continue
+
+            yield (', ' if written else '') + ', '.join(json_util.dumps(entry) for entry in entries)
+            written = True
+
+        yield '], "next": ' + json.dumps(next_cursor) + '}'
+
     @decorators.action(detail=True, permission_classes=[permissions.ProvPermission])
     def prov(self, request, pk=None):
         """
         View for /api/datasources/<int>/prov/
 
-        Retrieve PROV records related to a :class:`DataSource`.
+        Retrieve PROV records related to a :class:`DataSource`, newest first.
+
+        Records may be filtered using the 'since', 'until', 'activity' and 'application' query parameters.
+        Results are paginated - pass the 'next' value of a response as the 'cursor' query parameter
+        to get the next page.
         """
         instance = self.get_object()
 
-        data = {
-            # Get all ProvEntry's related to this instance and encode them as JSON
-            'prov': [json.loads(record.to_json()) for record in prov_models.ProvWrapper.filter_model_instance(instance)]
-        }
+        try:
+            filters = self._get_prov_filters(request.query_params)
+            limit = min(int(request.query_params.get('limit', PROV_PAGE_SIZE)), PROV_MAX_PAGE_SIZE)
+            if limit <= 0:
+                raise ValueError('Limit must be positive')
+
+        except ValueError as e:
+            return JsonResponse({
+                'status': 'error',
+                'message': str(e),
+            }, status=400)
+
+        # Get one extra record to find out if there is another page
+        records = prov_models.ProvWrapper.filter_records(instance, **filters)
+        wrappers = list(records.only('id', 'timestamp', 'entry').as_pymongo()[:limit + 1])
+
+        next_cursor = None
+        if len(wrappers) > limit:
+            wrappers = wrappers[:limit]
+            next_cursor = self._encode_prov_cursor(wrappers[-1])
 
         # Record this action in PROV
         if not instance.prov_exempt:
             self._create_prov_entry(instance)
 
-        return response.Response(data, status=200)
+        return StreamingHttpResponse(self._stream_prov(wrappers, next_cursor),
+                                     content_type='application/json')
+
+    @decorators.action(detail=True, permission_classes=[permissions.ProvPermission], url_path='prov/usage')
+    def prov_usage(self, request, pk=None):
+        """
+        View for /api/datasources/<int>/prov/usage/
+
+        Retrieve counts of PROV records related to a :class:`DataSource` by application, activity type
+        and time bucket, oldest first.
+
+        Counts may be filtered using the 'since', 'until', 'activity' and 'application' query parameters.
+        The size of time buckets is set by the 'granularity' query parameter - 'hour' or 'day'.
+        """
+        instance = self.get_object()
+
+        try:
+            filters = self._get_prov_filters(request.query_params)
+            filters.pop('after', None)
+
+            granularity = prov_models.RollupGranularity(request.query_params.get('granularity', 'day'))
+
+        except ValueError as e:
+            return JsonResponse({
+                'status': 'error',
+                'message': str(e),
+            }, status=400)
+
+        rollups = prov_models.ProvRollup.filter_model_instance(instance, granularity=granularity, **filters)
+
+        return JsonResponse({
+            'status': 'success',
+            'data': [
+                {
+                    'bucket': rollup['bucket'].replace(tzinfo=datetime.timezone.utc).isoformat(),
+                    'application': rollup.get('application_id'),
+                    'activity': rollup.get('activity_type'),
+                    'count': rollup['count'],
+                } for rollup in rollups.as_pymongo()
+            ],
+        })
+
+    @decorators.action(detail=True, permission_classes=[permissions.ProvPermission], url_path='prov/lineage')
+    def prov_lineage(self, request, pk=None):
+        """
+        View for /api/datasources/<int>/prov/lineage/
+
+        Retrieve the PROV lineage graph around a :class:`DataSource` in node-link form.
+
+        The number of steps to traverse is set by the 'depth' query parameter.
+        """
+        instance = self.get_object()
+
+        try:
+            depth = get_lineage_depth(request.query_params)
+
+        except ValueError as e:
+            return JsonResponse({
+                'status': 'error',
+                'message': str(e),
+            }, status=400)
+
+        graph = prov_models.ProvEdge.traverse(instance=instance, depth=depth, max_edges=PROV_LINEAGE_MAX_EDGES)
+        graph = filter_lineage_graph(graph, request.user)
+
+        return JsonResponse({
+            'status': 'success',
+            'data': json_graph.node_link_data(graph),
+        })
 
     @decorators.action(detail=True, permission_classes=[permissions.MetadataPermission])
     def metadata(self, request, pk=None):
@@ -222,33 +557,84 @@ class DataSourceApiViewset(viewsets.ReadOnlyModelViewSet):
         return self.try_passthrough_response(map_response,
                                              'Data source does not provide data')
 
+    @staticmethod
+    def _get_pushed_data(request: request.Request) -> typing.List:
+        """
+        Get the data pushed in a request - either as JSON body text or as POSTed CSV files.
+
+        :return: List of pushed data - one item per CSV file, or a single item containing the JSON body
+        """
+        if request.FILES:
+            pushed_data = []
+
+            for filename, f in request.FILES.items():
+                # TODO read in chunks
+                # TODO don't assume utf-8
+                data = f.read().decode('utf-8').splitlines()
+                pushed_data.append(csv.DictReader(data))
+
+            return pushed_data
+
+        return [request.data]
+
+    @classmethod
+    def _iter_pushed_rows(cls, request: request.Request) -> typing.Iterator[typing.Mapping[str, typing.Any]]:
+        """
+        Get the individual rows of data which have been pushed to a data source.
+
+        :raises ValueError: Pushed data is not a row or list of rows
+        """
+        for data in cls._get_pushed_data(request):
+            # A JSON body may be a single row rather than a list of rows
+            rows = [data] if isinstance(data, collections_abc.Mapping) else data
+            if isinstance(rows, (str, bytes)) or not isinstance(rows, collections_abc.Iterable):
+                raise ValueError('Data must be a row or a list of rows')
+
+            for row in rows:
+                if not isinstance(row, collections_abc.Mapping):
+                    raise ValueError('Each row must map field names to values')
+
+                yield row
+
+    @staticmethod
+    def _get_index_fields(instance: models.DataSource) -> typing.List[str]:
+        """
+        Get the fields which should be indexed within an internal data source.
+        """
+        return list(instance.metadata_items.filter(
+            field__short_name='indexed_field'
+        ).values_list('value', flat=True))
+
     @data.mapping.post
     def post_data(self, request: request.Request, pk=None):
         """
         Add data to this data source.  Only applicable to internal data sources.
 
         Data can be added either as JSON body text or as a POSTed CSV file.
+
+        If write buffering is enabled on this data source, a single row sent as JSON body text
+        is acknowledged with 202 Accepted once buffered, and is written to the data source shortly afterwards.
         """
         instance = self.get_object()
 
+        buffered = (
+            instance.write_buffer != WriteBufferMode.DISABLED and
+            not request.FILES and
+            isinstance(request.data, collections_abc.Mapping)
+        )
+
         try:
             with instance.data_connector as data_connector:
-                if request.FILES:
-                    for filename, f in request.FILES.items():
-                        # TODO read in chunks
-                        # TODO don't assume utf-8
-                        data = f.read().decode('utf-8').splitlines()
-                        reader = csv.DictReader(data)
-
-                        data_connector.post_data(reader)
+                if buffered:
+                    data_connector.buffer_data(request.data,
+                                               durable=instance.write_buffer == WriteBufferMode.DURABLE)
 
                 else:
-                    data_connector.post_data(request.data)
+                    for data in self._get_pushed_data(request):
+                        data_connector.post_data(data)
 
-                # Rebuild index
-                index_fields = instance.metadata_items.filter(field__short_name='indexed_field').values_list('value')
-                if index_fields:
-                    data_connector.clean_data(index_fields=index_fields)
+                # Update indexes - this is a no-op unless the indexed fields have changed
+                data_connector.clean_data(index_fields=self._get_index_fields(instance))
 
                 # Record this action in PROV
                 if not instance.prov_exempt:
@@ -261,20 +647,107 @@ class DataSourceApiViewset(viewsets.ReadOnlyModelViewSet):
                 'message': 'Data source does not support writing of data'
             }, status=405)
 
+        except ValueError as e:
+            # Data contains a field name which cannot be stored
+            return JsonResponse({
+                'status': 'error',
+                'message': str(e),
+            }, status=400)
+
         return JsonResponse({
             'status': 'success',
             'data': None,
-        })
+        }, status=202 if buffered else 200)
 
     @data.mapping.put
     def put_data(self, request: request.Request, pk=None):
+        """
+        Replace all data in this data source.  Only applicable to internal data sources.
+
+        Data can be added either as JSON body text or as a PUT CSV file.
+        Existing data remains available until the new data has been completely loaded.
+        """
         instance = self.get_object()
 
         with instance.data_connector as data_connector:
-            # Remove all existing data
-            data_connector.clear_data()
+            try:
+                replace_data = data_connector.replace_data
 
-        return self.post_data(request, pk)
+            except AttributeError:
+                # Connector has no 'replace_data' method
+                return JsonResponse({
+                    'status': 'error',
+                    'message': 'Data source does not support writing of data'
+                }, status=405)
+
+            try:
+                replace_data(self._iter_pushed_rows(request), index_fields=self._get_index_fields(instance))
+
+            except ValueError as e:
+                # Data contains a malformed row or a field name which cannot be stored
+                return JsonResponse({
+                    'status': 'error',
+                    'message': str(e),
+                }, status=400)
+
+            # Record this action in PROV
+            if not instance.prov_exempt:
+                self._create_prov_entry(instance)
+
+        return JsonResponse({
+            'status': 'success',
+            'data': None,
+        })
+
+    @decorators.action(detail=True,
+                       url_path='data/aggregate',
+                       permission_classes=[permissions.DataPermission])
+    def aggregate(self, request, pk=None):
+        """
+        View for /api/datasources/<int>/data/aggregate/
+
+        Retrieve the result of an aggregation over :class:`DataSource` data - e.g. counts, means, min / max.
+        The aggregation is performed within the data store so only the result is returned.
+        """
+        def map_response(data_connector, params):
+            try:
+                return data_connector.get_aggregate(params=params)
+
+            except ValueError as e:
+                data = {
+                    'status': 'error',
+                    'message': str(e),
+                }
+                return response.Response(data, status=400)
+
+        return self.try_passthrough_response(map_response,
+                                             'Data source does not support aggregation')
+
+    @decorators.action(detail=True,
+                       url_path='data/indexes',
+                       permission_classes=[permissions.MetadataPermission])
+    def indexes(self, request, pk=None):
+        """
+        View for /api/datasources/<int>/data/indexes/
+
+        Retrieve the status of indexes on :class:`DataSource` data.  Only applicable to internal data sources.
+        """
+        instance = self.get_object()
+
+        try:
+            with instance.data_connector as data_connector:
+                data = {
+                    'status': 'success',
+                    'data': data_connector.get_index_state(),
+                }
+                return response.Response(data, status=200)
+
+        except AttributeError:
+            data = {
+                'status': 'error',
+                'message': 'Data source does not support indexing',
+            }
+            return response.Response(data, status=400)
 
     @decorators.action(detail=True, permission_classes=[permissions.MetadataPermission])
     def datasets(self, request, pk=None):
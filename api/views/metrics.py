@@ -0,0 +1,24 @@
+"""
+This module contains the API endpoint exposing metrics describing the state of the running PEDASI process.
+"""
+
+from rest_framework import permissions, request, response, views
+
+from core import metrics
+
+
+class MetricsApiView(views.APIView):
+    """
+    Provides a view for:
+
+    /api/metrics/
+      Retrieve the current value of metrics registered in :mod:`core.metrics`.
+      Values are those of the process which handled the request.  Only available to staff users.
+    """
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request: request.Request, format=None):
+        return response.Response({
+            'status': 'success',
+            'data': metrics.collect(),
+        })
@@ -0,0 +1,159 @@
+"""
+This module contains the API endpoint for searching PEDASI data sources.
+"""
+
+import hashlib
+import typing
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import JsonResponse
+from haystack.query import SearchQuerySet
+
+from rest_framework import request, views
+
+from datasources import models
+
+#: Default number of results in each page
+SEARCH_PAGE_SIZE = 20
+
+#: Maximum number of results in each page
+SEARCH_MAX_PAGE_SIZE = 100
+
+#: Maximum number of ranked results read from the search index for a query
+SEARCH_MAX_RESULTS = 1000
+
+
+def get_ranked_results(query: str) -> typing.List[typing.Tuple[int, float, typing.List[str]]]:
+    """
+    Get the data sources matching a text query, best match first, with the matching text highlighted.
+
+    Results with equal scores are ordered by id, so that each result has a fixed position relative to any
+    (score, id) pair - see :func:`encode_cursor`.
+
+    Results are cached for SEARCH_CACHE_TIMEOUT seconds - they are the same for every user, since permissions are
+    checked afterwards.
+
+    :param query: Text query
+    :return: List of data source id, score and highlighted text tuples
+    """
+    cache_key = 'api.search.' + hashlib.sha1(query.encode('utf-8')).hexdigest()
+
+    results = cache.get(cache_key)
+    if results is None:
+        search_results = SearchQuerySet().models(models.DataSource).auto_query(query).highlight()
+
+        results = []
+        for result in search_results[:SEARCH_MAX_RESULTS]:
+            highlighted = getattr(result, 'highlighted', None) or []
+            if isinstance(highlighted, dict):
+                highlighted = highlighted.get(search_results.query.backend.content_field_name, [])
+
+            results.append((int(result.pk), result.score, list(highlighted)))
+
+        results.sort(key=lambda result: (-result[1], result[0]))
+        cache.set(cache_key, results, settings.SEARCH_CACHE_TIMEOUT)
+
+    return results
+
+
+def encode_cursor(score: float, pk: int) -> str:
+    """
+    Encode the position after a search result as a cursor.
+
+    The cursor holds the score and id of the last result returned rather than its position in the results,
+    so that results do not shift between pages when data sources are added to or removed from the search index.
+    """
+    return '{0!r}_{1}'.format(score, pk)
+
+
+def decode_cursor(cursor: str) -> typing.Tuple[float, int]:
+    """
+    Decode a cursor created by :func:`encode_cursor`.
+
+    :raises ValueError: Cursor is not valid
+    """
+    try:
+        score, pk = cursor.rsplit('_', 1)
+        return float(score), int(pk)
+
+    except ValueError as exc:
+        raise ValueError('Invalid cursor \'{0}\''.format(cursor)) from exc
+
+
+class SearchApiView(views.APIView):
+    """
+    Provides a view for:
+
+    /api/search/?q=<text>
+      Search :class:`datasources.models.DataSource`\ s by text - returns ids of matching data sources, best match
+      first, with highlighted text.
+
+      Only data sources on which the user has the permission level given by the 'permission' parameter are returned
+      - one of 'view' (default), 'meta', 'data' or 'prov'.
+      Results are paginated using a cursor - pass the value of 'next' from the previous page as 'cursor'.
+      The cursor holds the score and id of the last result seen rather than a position, so adding or removing a data
+      source between pages does not shift the remaining results.  Pages are not fully stable though - changes to the
+      index may change the scores of other results.
+      The number of results in each page may be set using 'page_size'.
+    """
+    def get(self, request: request.Request, format=None):
+        params = request.query_params
+
+        try:
+            query = params.get('q', '').strip()
+            if not query:
+                raise ValueError('Parameter q is required')
+
+            try:
+                level = models.UserPermissionLevels[params.get('permission', 'view').upper()]
+
+            except KeyError as exc:
+                raise ValueError('Invalid permission \'{0}\''.format(params['permission'])) from exc
+
+            page_size = int(params.get('page_size', SEARCH_PAGE_SIZE))
+            if not 1 <= page_size <= SEARCH_MAX_PAGE_SIZE:
+                raise ValueError('Page size must be between 1 and {0}'.format(SEARCH_MAX_PAGE_SIZE))
+
+            cursor = decode_cursor(params['cursor']) if 'cursor' in params else None
+
+        except ValueError as e:
+            return JsonResponse({
+                'status': 'error',
+                'message': str(e),
+            }, status=400)
+
+        ranked = get_ranked_results(query)
+        if cursor is not None:
+            last_score, last_pk = cursor
+            ranked = [result for result in ranked if (-result[1], result[0]) > (-last_score, last_pk)]
+
+        # Check permissions on all remaining results in a single query
+        permitted = set(models.DataSource.objects.filter(
+            models.DataSource.permission_level_filter(request.user, level),
+            pk__in=[pk for pk, score, highlights in ranked]
+        ).values_list('pk', flat=True))
+
+        results = []
+        next_cursor = None
+        for pk, score, highlights in ranked:
+            if pk not in permitted:
+                continue
+
+            if len(results) == page_size:
+                next_cursor = encode_cursor(results[-1]['score'], results[-1]['id'])
+                break
+
+            results.append({
+                'id': pk,
+                'score': score,
+                'highlights': highlights,
+            })
+
+        return JsonResponse({
+            'status': 'success',
+            'data': {
+                'results': results,
+                'next': next_cursor,
+            },
+        })
@@ -0,0 +1,391 @@
+"""
+This module contains an in-memory index providing search-as-you-type suggestions of data source and application names
+and metadata values.
+
+Every prefix of every word of a suggestion is mapped to the suggestions containing it, so a lookup is a dictionary
+access per word of the query rather than a search of the full text index.
+
+The index is built when the server starts and is updated when data sources, applications and metadata are saved by this
+process.  Changes made by other processes are included when the index is next rebuilt - in a background thread once it
+is older than AUTOCOMPLETE_REFRESH_INTERVAL seconds.
+
+The index holds suggestions from all data sources - those which a user does not have permission to view are filtered
+out on each lookup.
+"""
+
+import heapq
+import logging
+import os
+import re
+import threading
+import time
+import typing
+import urllib.parse
+
+from django.apps import apps
+from django.conf import settings
+from django.db import close_old_connections, connections, transaction
+from django.db.models import signals
+from django.db.utils import OperationalError, ProgrammingError
+from django.dispatch import receiver
+from django.urls import reverse
+
+from core import metrics
+
+logger = logging.getLogger(__name__)
+
+#: Words are indexed by prefixes up to this length - longer query words are checked against each suggestion
+MAX_PREFIX_LENGTH = 16
+
+#: Order in which kinds of suggestion are shown when equally relevant
+KIND_ORDER = ['datasource', 'application', 'metadata']
+
+#: Fields of a data source or application which affect its suggestions
+SUGGESTION_FIELDS = {'name', 'is_deleted'}
+
+
+class Suggestion(typing.NamedTuple):
+    """
+    A single autocomplete suggestion.
+    """
+    #: Kind of object suggested - one of :data:`KIND_ORDER`
+    kind: str
+
+    #: Text to be shown and completed
+    label: str
+
+    #: Page for the suggestion - None if it has no page of its own
+    url: typing.Optional[str]
+
+
+def _get_words(text: str) -> typing.List[str]:
+    return re.findall(r'\w+', text.lower())
+
+
+def get_datasource_suggestions(datasource) -> typing.Dict[tuple, Suggestion]:
+    """
+    Get suggestions for a data source - its name and non-operational metadata values.
+
+    Metadata items should be prefetched with their fields when getting suggestions for many data sources.
+    """
+    suggestions = {
+        ('datasource', datasource.pk): Suggestion('datasource', datasource.name, datasource.get_absolute_url()),
+    }
+
+    search_url = reverse('datasources:datasource.search')
+    for item in datasource.metadata_items.all():
+        if item.field.operational or not item.value:
+            continue
+
+        facet = 'metadata.{0}:{1}'.format(item.field.short_name, item.value)
+        suggestions[('metadata', item.field.short_name, item.value)] = Suggestion(
+            'metadata', item.value, search_url + '?' + urllib.parse.urlencode({'facet': facet})
+        )
+
+    return suggestions
+
+
+def get_application_suggestions(application) -> typing.Dict[tuple, Suggestion]:
+    """
+    Get suggestions for an application - its name.
+    """
+    return {
+        ('application', application.pk): Suggestion('application', application.name,
+                                                     application.get_absolute_url()),
+    }
+
+
+def _get_viewable_datasources(user, pks: typing.Set[int]) -> typing.Set[tuple]:
+    """
+    Get the keys of the data sources which a user may view, from a set of primary keys, in a single query.
+
+    Uses the same permission check as the search API - soft deleted data sources are never included.
+    """
+    if not pks:
+        return set()
+
+    from datasources.models import DataSource, UserPermissionLevels
+
+    return {('datasource', pk) for pk in DataSource.objects.filter(
+        DataSource.permission_level_filter(user, UserPermissionLevels.VIEW),
+        pk__in=pks
+    ).values_list('pk', flat=True)}
+
+
+class AutocompleteIndex:
+    """
+    Maps word prefixes to suggestions.
+
+    Suggestions are contributed by sources - data sources and applications - and a suggestion contributed by several
+    sources, such as a metadata value of several data sources, is kept until none of them contributes it.
+    """
+    def __init__(self):
+        self._pid = None
+        self._reset()
+        self._clear()
+
+        metrics.register_gauge('autocomplete.size', lambda: len(self._suggestions))
+        metrics.register_gauge('autocomplete.age', self.age)
+
+    def _reset(self) -> None:
+        """
+        Create a new lock - called on first use and after a fork, since threads are not inherited.
+
+        The contents of the index are kept, so worker processes start with the index built before they were forked.
+        """
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._building = False
+
+    def _clear(self) -> None:
+        self._built_at = None
+
+        #: Maps suggestion key to suggestion
+        self._suggestions = {}
+
+        #: Maps suggestion key to keys of sources which contribute it
+        self._sources = {}
+
+        #: Maps source key to keys of suggestions which it contributes
+        self._contributions = {}
+
+        #: Maps word prefix to keys of suggestions containing a word with that prefix
+        self._prefixes = {}
+
+    def age(self) -> typing.Optional[float]:
+        """
+        Get the time in seconds since the index was built - None if it has not been built.
+        """
+        return None if self._built_at is None else time.monotonic() - self._built_at
+
+    def _add(self, source: tuple, suggestions: typing.Dict[tuple, Suggestion]) -> None:
+        self._contributions[source] = set(suggestions)
+
+        for key, suggestion in suggestions.items():
+            self._sources.setdefault(key, set()).add(source)
+
+            previous = self._suggestions.get(key)
+            if previous == suggestion:
+                continue
+
+            if previous is not None:
+                self._remove_prefixes(key, previous)
+
+            self._suggestions[key] = suggestion
+            for word in _get_words(suggestion.label):
+                for length in range(1, min(len(word), MAX_PREFIX_LENGTH) + 1):
+                    self._prefixes.setdefault(word[:length], set()).add(key)
+
+    def _remove_prefixes(self, key: tuple, suggestion: Suggestion) -> None:
+        for word in _get_words(suggestion.label):
+            for length in range(1, min(len(word), MAX_PREFIX_LENGTH) + 1):
+                keys = self._prefixes.get(word[:length])
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self._prefixes[word[:length]]
+
+    def _remove(self, source: tuple) -> None:
+        for key in self._contributions.pop(source, set()):
+            sources = self._sources[key]
+            sources.discard(source)
+
+            if not sources:
+                del self._sources[key]
+                self._remove_prefixes(key, self._suggestions.pop(key))
+
+    def update(self, source: tuple, suggestions: typing.Dict[tuple, Suggestion]) -> None:
+        """
+        Replace the suggestions contributed by a source.
+
+        :param source: Key of the source - e.g. ('datasource', pk)
+        :param suggestions: Maps key of each suggestion to the suggestion
+        """
+        with self._lock:
+            if self._built_at is None:
+                # Will be included when the index is built
+                return
+
+            self._remove(source)
+            self._add(source, suggestions)
+
+    def remove(self, source: tuple) -> None:
+        """
+        Remove the suggestions contributed by a source.
+        """
+        with self._lock:
+            self._remove(source)
+
+    def build(self) -> None:
+        """
+        Build the index from all data sources and applications, replacing its current contents.
+        """
+        DataSource = apps.get_model('datasources', 'DataSource')
+        Application = apps.get_model('applications', 'Application')
+
+        new_index = AutocompleteIndex.__new__(AutocompleteIndex)
+        new_index._clear()
+
+        for datasource in DataSource.objects.prefetch_related('metadata_items__field'):
+            new_index._add(('datasource', datasource.pk), get_datasource_suggestions(datasource))
+
+        for application in Application.objects.all():
+            new_index._add(('application', application.pk), get_application_suggestions(application))
+
+        with self._lock:
+            self._suggestions = new_index._suggestions
+            self._sources = new_index._sources
+            self._contributions = new_index._contributions
+            self._prefixes = new_index._prefixes
+            self._built_at = time.monotonic()
+
+    def build_at_startup(self) -> None:
+        """
+        Build the index before server worker processes are forked, so that each starts with a copy.
+
+        Database connections are closed afterwards since they cannot be shared with worker processes.
+        If the database is not available the index is built in the background on first use instead.
+        """
+        try:
+            self.build()
+
+        except (OperationalError, ProgrammingError):
+            logger.warning('Could not build autocomplete index, database has not been initialized')
+
+        finally:
+            connections.close_all()
+
+    def _rebuild(self) -> None:
+        try:
+            self.build()
+
+        except Exception:
+            logger.exception('Failed to rebuild autocomplete index')
+
+        finally:
+            self._building = False
+
+            # This thread holds its own database connection
+            close_old_connections()
+
+    def _ensure_fresh(self) -> None:
+        """
+        Start building the index in the background if it has not been built or is out of date.
+        """
+        if self._pid != os.getpid():
+            self._reset()
+
+        with self._lock:
+            if self._building or (self._built_at is not None and self.age() < settings.AUTOCOMPLETE_REFRESH_INTERVAL):
+                return
+
+            self._building = True
+
+        threading.Thread(target=self._rebuild, name='autocomplete', daemon=True).start()
+
+    def lookup(self, query: str, user, limit: int = 10) -> typing.List[Suggestion]:
+        """
+        Get suggestions containing words starting with each word of a query.
+
+        Suggestions starting with the query are ranked first, then shorter suggestions.
+        Only suggestions contributed by an application or a data source which the user may view are returned.
+        No suggestions are returned until the index has been built.
+
+        :param query: Text typed so far
+        :param user: User making the query
+        :param limit: Maximum number of suggestions to return
+        :return: List of suggestions
+        """
+        words = _get_words(query)
+        if not words:
+            return []
+
+        self._ensure_fresh()
+
+        with self._lock:
+            candidates = [self._prefixes.get(word[:MAX_PREFIX_LENGTH], set()) for word in words]
+            keys = set.intersection(*sorted(candidates, key=len))
+            sources = {key: set(self._sources[key]) for key in keys}
+            suggestions = {key: self._suggestions[key] for key in keys}
+
+        if not user.is_superuser:
+            permitted = _get_viewable_datasources(
+                user, {pk for key in keys for kind, pk in sources[key] if kind == 'datasource'}
+            )
+            suggestions = {
+                key: suggestion for key, suggestion in suggestions.items()
+                if any(source[0] == 'application' or source in permitted for source in sources[key])
+            }
+
+        suggestions = list(suggestions.values())
+
+        long_words = [word for word in words if len(word) > MAX_PREFIX_LENGTH]
+        if long_words:
+            suggestions = [
+                suggestion for suggestion in suggestions
+                if all(any(label_word.startswith(word) for label_word in _get_words(suggestion.label))
+                       for word in long_words)
+            ]
+
+        query = query.strip().lower()
+        return heapq.nsmallest(limit, suggestions, key=lambda suggestion: (
+            not suggestion.label.lower().startswith(query),
+            len(suggestion.label),
+            KIND_ORDER.index(suggestion.kind),
+            suggestion.label,
+        ))
+
+
+#: Index used by the autocomplete view
+index = AutocompleteIndex()
+
+
+def _update_datasource(pk) -> None:
+    DataSource = apps.get_model('datasources', 'DataSource')
+
+    datasource = DataSource.objects.select_related('owner').prefetch_related(
+        'metadata_items__field'
+    ).filter(pk=pk).first()
+
+    if datasource is None:
+        # Soft deleted
+        index.remove(('datasource', pk))
+    else:
+        index.update(('datasource', pk), get_datasource_suggestions(datasource))
+
+
+# Changes cannot be read until they have been committed - and may be rolled back
+
+@receiver(signals.post_save, sender='datasources.DataSource')
+@receiver(signals.post_delete, sender='datasources.DataSource')
+def datasource_changed(sender, instance, update_fields=None, **kwargs):
+    # e.g. request counters are saved on each access to an external data source
+    if update_fields is not None and not SUGGESTION_FIELDS.intersection(update_fields):
+        return
+
+    pk = instance.pk
+    transaction.on_commit(lambda: _update_datasource(pk))
+
+
+@receiver(signals.post_save, sender='datasources.MetadataItem')
+@receiver(signals.post_delete, sender='datasources.MetadataItem')
+def metadata_item_changed(sender, instance, **kwargs):
+    pk = instance.datasource_id
+    transaction.on_commit(lambda: _update_datasource(pk))
+
+
+@receiver(signals.post_save, sender='applications.Application')
+@receiver(signals.post_delete, sender='applications.Application')
+def application_changed(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not SUGGESTION_FIELDS.intersection(update_fields):
+        return
+
+    application = instance
+
+    def update():
+        if application.is_deleted or kwargs.get('signal') is signals.post_delete:
+            index.remove(('application', application.pk))
+        else:
+            index.update(('application', application.pk), get_application_suggestions(application))
+
+    transaction.on_commit(update)
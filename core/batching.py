@@ -0,0 +1,190 @@
+"""
+This module contains a worker which collects items submitted from request handlers and processes them in batches.
+
+Processing happens in a background thread so that the cost of e.g. a database write is not added to the response time.
+"""
+
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+import typing
+
+from core import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class PartialBatchError(Exception):
+    """
+    Raised by a batch processing function when some of the items in a batch could not be processed.
+    """
+    def __init__(self, failed: int):
+        """
+        :param failed: Number of items which could not be processed
+        """
+        super().__init__('{0} items could not be processed'.format(failed))
+        self.failed = failed
+
+
+class BatchWorker:
+    """
+    Bounded in-process queue of items which are passed to a function in batches by a background thread.
+
+    A batch is processed when it reaches the batch size or when the oldest item has waited for the flush interval.
+    If the queue is full new items are dropped rather than blocking the caller.
+    Items remaining in the queue are processed when the process exits.
+
+    Queue depth and counts of processed, dropped and failed items are registered as metrics using the worker's name.
+    """
+    def __init__(self, name: str,
+                 func: typing.Callable[[typing.List[typing.Any]], None],
+                 max_size: int = 10000,
+                 batch_size: int = 100,
+                 flush_interval: float = 1.0):
+        """
+        :param name: Name of this worker - used as metric prefix
+        :param func: Function to be called with each batch of items - may raise :class:`PartialBatchError`
+        :param max_size: Maximum number of items waiting in the queue
+        :param batch_size: Maximum number of items in each batch
+        :param flush_interval: Maximum time in seconds for which an item waits before being processed
+        """
+        self.name = name
+        self.func = func
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.processed = 0
+        self.dropped = 0
+        self.failed = 0
+
+        self._pid = None
+        self._reset()
+
+        metrics.register_gauge(name + '.depth', self.depth)
+        metrics.register_gauge(name + '.processed', lambda: self.processed)
+        metrics.register_gauge(name + '.dropped', lambda: self.dropped)
+        metrics.register_gauge(name + '.failed', lambda: self.failed)
+
+        atexit.register(self.drain)
+
+    def _reset(self) -> None:
+        """
+        Create a new queue and lock - called on first use and after a fork, since threads are not inherited.
+        """
+        self._pid = os.getpid()
+        self._queue = queue.Queue(maxsize=self.max_size)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def depth(self) -> int:
+        """
+        Get the number of items waiting to be processed.
+        """
+        return self._queue.qsize()
+
+    def submit(self, item: typing.Any) -> bool:
+        """
+        Add an item to the queue to be processed.
+
+        :param item: Item to be processed
+        :return: Was the item accepted?  False if the queue is full
+        """
+        if self._pid != os.getpid():
+            self._reset()
+
+        try:
+            self._queue.put_nowait(item)
+
+        except queue.Full:
+            self.dropped += 1
+            logger.warning('Queue for %s is full - item dropped', self.name)
+            return False
+
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                    self._thread.start()
+
+        return True
+
+    def _process(self, batch: typing.List[typing.Any]) -> None:
+        try:
+            self.func(batch)
+
+        except PartialBatchError as exc:
+            self.failed += exc.failed
+            self.processed += len(batch) - exc.failed
+            logger.warning('Failed to process %d of %d items for %s', exc.failed, len(batch), self.name)
+
+        except Exception:
+            self.failed += len(batch)
+            logger.exception('Failed to process batch of %d items for %s', len(batch), self.name)
+
+        else:
+            self.processed += len(batch)
+
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+
+    def _get_batch(self, block: bool) -> typing.List[typing.Any]:
+        """
+        Take up to a batch of items from the queue.
+
+        :param block: Wait until the batch is full or the flush interval has passed since the first item?
+        :return: Batch of items - may be empty
+        """
+        batch = []
+        deadline = None
+
+        while len(batch) < self.batch_size:
+            try:
+                if not block:
+                    item = self._queue.get_nowait()
+
+                elif deadline is None:
+                    item = self._queue.get()
+                    deadline = time.monotonic() + self.flush_interval
+
+                else:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+
+            except queue.Empty:
+                break
+
+            batch.append(item)
+
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._get_batch(block=True)
+
+            # Do not allow a batch to be processed by this thread while being drained by another
+            with self._lock:
+                self._process(batch)
+
+    def drain(self) -> None:
+        """
+        Process all items currently in the queue in the calling thread.
+
+        Also waits for any batch already taken from the queue by the background thread.
+        """
+        if self._pid != os.getpid():
+            return
+
+        with self._lock:
+            while True:
+                batch = self._get_batch(block=False)
+                if not batch:
+                    break
+
+                self._process(batch)
+
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.join()
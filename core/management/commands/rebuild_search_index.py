@@ -0,0 +1,253 @@
+import concurrent.futures
+import glob
+import os
+import shutil
+import threading
+import time
+import urllib.parse
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+import requests.exceptions
+
+from haystack import connections
+
+from core.signals import REBUILD_LOG_SUFFIX, update_instances
+from datasources.models import DataSource, MetadataSnapshot
+
+#: Suffixes of files kept alongside an SQLite index, which must be moved and removed with it
+JOURNAL_SUFFIXES = ('-wal', '-shm')
+
+#: Number of times to try to replace an index created at the index path by another process during the swap
+SWAP_ATTEMPTS = 10
+
+
+class Command(BaseCommand):
+    help = ('Rebuild the search index at a new path, fetching data source metadata concurrently, '
+            'then swap it in place of the current index')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--using', default='default',
+                            help='Search connection to rebuild')
+        parser.add_argument('--workers', type=int, default=8,
+                            help='Number of data sources from which to fetch metadata concurrently')
+        parser.add_argument('--per-host', type=int, default=2,
+                            help='Number of concurrent metadata requests to a single host')
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Number of objects to add to the index at once')
+        parser.add_argument('--keep', type=int, default=1,
+                            help='Number of previous indexes to keep after the swap')
+        parser.add_argument('--no-refresh', action='store_false', dest='refresh',
+                            help='Index stored metadata snapshots without fetching metadata from data sources')
+
+    def _report(self, action: str, done: int, total: int, start: float) -> None:
+        elapsed = time.monotonic() - start
+        self.stdout.write('%s %d / %d (%.1f per second)' % (action, done, total, done / elapsed if elapsed else 0))
+
+    def _refresh_metadata(self, workers: int, per_host: int) -> None:
+        """
+        Fetch metadata from all data sources, limiting the number of concurrent requests to each host.
+        """
+        datasources = list(DataSource.objects.all())
+        host_semaphores = {}
+        lock = threading.Lock()
+
+        def refresh(datasource):
+            host = urllib.parse.urlparse(datasource.url).netloc.lower()
+            with lock:
+                semaphore = host_semaphores.setdefault(host, threading.BoundedSemaphore(per_host))
+
+            try:
+                with semaphore:
+                    MetadataSnapshot.refresh(datasource, update_index=False)
+
+            finally:
+                # Each worker thread has its own database connection
+                connection.close()
+
+        start = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(refresh, datasource): datasource for datasource in datasources}
+
+            for i, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+                try:
+                    future.result()
+
+                except requests.exceptions.RequestException as e:
+                    # Keep the existing snapshot
+                    self.stderr.write('Failed to fetch metadata for data source "%s": %s' % (futures[future].pk, e))
+
+                if self.verbosity > 1 or i == len(futures):
+                    self._report('Fetched metadata', i, len(futures), start)
+
+    @staticmethod
+    def _get_backend(using: str, path: str):
+        """
+        Get a search backend for a search connection, using the index at a different path.
+        """
+        search_connection = connections[using]
+        return type(search_connection.get_backend())(using, **dict(search_connection.options, PATH=path))
+
+    def _build_index(self, using: str, path: str, batch_size: int) -> None:
+        """
+        Index all objects into a new index at a path.
+        """
+        search_connection = connections[using]
+        backend = self._get_backend(using, path)
+
+        # Create the index even if there are no objects to add
+        backend.setup()
+
+        for index in search_connection.get_unified_index().collect_indexes():
+            queryset = index.build_queryset(using=using).order_by('pk')
+            total = queryset.count()
+            name = index.get_model().__name__
+
+            start = time.monotonic()
+            for offset in range(0, total, batch_size):
+                batch = list(queryset[offset:offset + batch_size])
+                backend.update(index, batch)
+
+                if self.verbosity > 1 or offset + batch_size >= total:
+                    self._report('Indexed ' + name, min(offset + batch_size, total), total, start)
+
+    def _apply_changes(self, using: str, path: str, log_path: str, offset: int) -> int:
+        """
+        Update a new index for objects which have changed since it began to be built.
+
+        Changes are logged by :class:`core.signals.QueuedSignalProcessor` in each process - see
+        :data:`core.signals.REBUILD_LOG_SUFFIX`.
+
+        :param using: Search connection alias
+        :param path: Path to new index
+        :param log_path: Path to change log
+        :param offset: Position in the log from which to read changes
+        :return: Position in the log up to which changes have been applied
+        """
+        changed = {}
+        with open(log_path, 'rb') as log:
+            log.seek(offset)
+
+            for line in log:
+                if not line.endswith(b'\n'):
+                    # Still being written - read it next time
+                    break
+
+                offset += len(line)
+                app_label, model_name, pk = line.decode('utf-8').strip().split('.', 2)
+                changed.setdefault(apps.get_model(app_label, model_name), set()).add(pk)
+
+        backend = self._get_backend(using, path)
+        for model, pks in changed.items():
+            update_instances(using, backend, model, pks)
+
+        if self.verbosity > 1 or changed:
+            self.stdout.write('Updated %d changed objects' % sum(len(pks) for pks in changed.values()))
+
+        return offset
+
+    @staticmethod
+    def _swap_index(path: str, new_path: str) -> None:
+        """
+        Replace the index at a path with a new index by pointing a symlink at it.
+
+        Replacing one symlink with another is atomic, so searches never see a missing or partial index.
+        An index created at the path by another process while the previous index is moved aside is removed -
+        changes written to it are in the change log so are applied to the new index after the swap.
+        """
+        swap_path = path + '.swap'
+        if os.path.lexists(swap_path):
+            os.remove(swap_path)
+
+        os.symlink(os.path.basename(new_path), swap_path)
+
+        if os.path.exists(path) and not os.path.islink(path):
+            # First rebuild - index is a directory or file rather than a symlink so has to be moved aside
+            # Named to sort before timestamped indexes
+            os.rename(path, path + '.0')
+
+            # Along with the journal of an SQLite index
+            for suffix in JOURNAL_SUFFIXES:
+                if os.path.exists(path + suffix):
+                    os.rename(path + suffix, path + '.0' + suffix)
+
+        for _ in range(SWAP_ATTEMPTS):
+            try:
+                os.replace(swap_path, path)
+                return
+
+            except IsADirectoryError:
+                # e.g. Whoosh setup in another process has created an empty index in place of the one moved aside
+                shutil.rmtree(path, ignore_errors=True)
+
+        raise CommandError('Index "%s" is repeatedly being created by another process' % path)
+
+    @staticmethod
+    def _remove_old_indexes(path: str, keep: int) -> None:
+        """
+        Remove previous indexes, except the current index and the most recent to be kept.
+
+        The journal of an SQLite index is removed with it.
+        """
+        current = os.path.realpath(path)
+        previous = sorted(
+            (other for other in glob.glob(glob.escape(path) + '.*')
+             if not other.endswith(('.swap', REBUILD_LOG_SUFFIX) + JOURNAL_SUFFIXES)
+             and os.path.realpath(other) != current),
+            reverse=True
+        )
+
+        for other in previous[keep:]:
+            if os.path.isdir(other):
+                shutil.rmtree(other)
+            else:
+                os.remove(other)
+
+            for suffix in JOURNAL_SUFFIXES:
+                if os.path.exists(other + suffix):
+                    os.remove(other + suffix)
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+
+        path = connections[options['using']].options.get('PATH')
+        if not path:
+            raise CommandError('Search connection "%s" does not store its index at a path' % options['using'])
+
+        path = os.path.abspath(path)
+        new_path = path + '.' + time.strftime('%Y%m%d%H%M%S', time.gmtime())
+        if os.path.exists(new_path):
+            raise CommandError('Index "%s" already exists' % new_path)
+
+        start = time.monotonic()
+
+        if options['refresh']:
+            self._refresh_metadata(options['workers'], options['per_host'])
+
+        # Objects which change during the rebuild are indexed in the current index rather than the new one,
+        # so processes log them to be applied to the new index
+        log_path = path + REBUILD_LOG_SUFFIX
+        try:
+            os.close(os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+
+        except FileExistsError:
+            raise CommandError('Index is already being rebuilt - if not, remove "%s"' % log_path)
+
+        try:
+            self._build_index(options['using'], new_path, options['batch_size'])
+            offset = self._apply_changes(options['using'], new_path, log_path, 0)
+
+            self._swap_index(path, new_path)
+
+            # Changes may have been written to the previous index up to the swap
+            self._apply_changes(options['using'], new_path, log_path, offset)
+
+        finally:
+            os.remove(log_path)
+
+        self._remove_old_indexes(path, options['keep'])
+
+        self.stdout.write(self.style.SUCCESS(
+            'Successfully rebuilt search index at "%s" in %.1f seconds' % (new_path, time.monotonic() - start)
+        ))
@@ -0,0 +1,134 @@
+import json
+import os
+import random
+import string
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from haystack import connections
+from haystack.query import SearchQuerySet
+
+from datasources.models import CatalogueItem
+
+#: Search engines to compare - with the name of their index within a temporary directory
+ENGINES = [
+    ('Whoosh', 'haystack.backends.whoosh_backend.WhooshEngine', 'whoosh_index'),
+    ('SQLite FTS5', 'core.search_backends.SqliteEngine', 'search_index.sqlite3'),
+]
+
+
+class Command(BaseCommand):
+    help = ('Measure the rate at which datasets are indexed and searched - by Whoosh and by SQLite full text search. '
+            'Uses temporary indexes containing generated datasets, so does not affect the search index.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--number', type=int, default=10000,
+                            help='Number of datasets to index')
+        parser.add_argument('--queries', type=int, default=1000,
+                            help='Number of queries of each type to run')
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Number of datasets to add to the index at once')
+        parser.add_argument('--readers', type=int, default=4,
+                            help='Number of threads searching while the index is being updated')
+
+    @staticmethod
+    def _generate_items(number: int, rng: random.Random):
+        """
+        Generate unsaved datasets with descriptions drawn from a vocabulary of random words.
+        """
+        words = [''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 10))) for _ in range(5000)]
+
+        items = []
+        for i in range(1, number + 1):
+            metadata = [{
+                'rel': 'urn:X-hypercat:rels:hasDescription:en',
+                'val': ' '.join(rng.choice(words) for _ in range(12)),
+            }]
+            items.append(CatalogueItem(pk=i, datasource_id=1, href='https://example.com/datasets/{0}'.format(i),
+                                       metadata=json.dumps(metadata)))
+
+        return words, items
+
+    def _report(self, name: str, action: str, number: int, elapsed: float, unit: str) -> None:
+        self.stdout.write('{0}: {1} {2:.0f} {3} per second'.format(name, action, number / elapsed, unit))
+
+    def _index(self, alias: str, items, batch_size: int) -> None:
+        search_connection = connections[alias]
+        backend = search_connection.get_backend()
+        index = search_connection.get_unified_index().get_index(CatalogueItem)
+
+        for offset in range(0, len(items), batch_size):
+            backend.update(index, items[offset:offset + batch_size])
+
+    @staticmethod
+    def _search(alias: str, queries) -> None:
+        for kwargs in queries:
+            list(SearchQuerySet(using=alias).models(CatalogueItem).filter(**kwargs)[:20])
+
+    def _benchmark(self, name: str, alias: str, items, query_types, batch_size: int, readers: int) -> None:
+        start = time.perf_counter()
+        self._index(alias, items, batch_size)
+        self._report(name, 'indexed', len(items), time.perf_counter() - start, 'datasets')
+
+        for query_type, queries in query_types:
+            start = time.perf_counter()
+            self._search(alias, queries)
+            self._report(name, query_type, len(queries), time.perf_counter() - start, 'queries')
+
+        # Search from several threads while the index is updated from another
+        n_queries = [0] * readers
+        writing = threading.Event()
+        writing.set()
+
+        def read(i):
+            while writing.is_set():
+                self._search(alias, query_types[0][1][:10])
+                n_queries[i] += 10
+
+        threads = [threading.Thread(target=read, args=(i,)) for i in range(readers)]
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+
+        try:
+            self._index(alias, items, batch_size)
+
+        finally:
+            writing.clear()
+            for thread in threads:
+                thread.join()
+
+        elapsed = time.perf_counter() - start
+        self._report(name, 'while searching, indexed', len(items), elapsed, 'datasets')
+        self._report(name, 'while indexing, ran', sum(n_queries), elapsed, 'queries')
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        words, items = self._generate_items(options['number'], rng)
+
+        query_types = [
+            ('single term', [{'content': rng.choice(words)} for _ in range(options['queries'])]),
+            ('two terms', [{'content': ' '.join(rng.sample(words, 2))} for _ in range(options['queries'])]),
+            ('prefix', [{'content__startswith': rng.choice(words)[:3]} for _ in range(options['queries'])]),
+        ]
+
+        with tempfile.TemporaryDirectory() as index_dir:
+            for name, engine, index_name in ENGINES:
+                alias = 'benchmark_' + index_name
+
+                # Connections are configured from the Haystack settings when first used
+                settings.HAYSTACK_CONNECTIONS[alias] = {
+                    'ENGINE': engine,
+                    'PATH': os.path.join(index_dir, index_name),
+                }
+
+                try:
+                    self._benchmark(name, alias, items, query_types, options['batch_size'], options['readers'])
+
+                finally:
+                    del settings.HAYSTACK_CONNECTIONS[alias]
@@ -0,0 +1,48 @@
+"""
+This module contains a registry of metrics describing the state of the running PEDASI process.
+
+Metrics are registered as functions returning their current value, which are called each time the metrics are collected.
+"""
+
+import logging
+import threading
+import typing
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+
+#: Registered metrics - maps metric name to function returning current value
+_gauges = {}
+
+
+def register_gauge(name: str, func: typing.Callable[[], typing.Any]) -> None:
+    """
+    Register a metric whose value is provided by a function.
+
+    :param name: Name of metric - registering a name a second time replaces the existing metric
+    :param func: Function returning the current value of the metric
+    """
+    with _lock:
+        _gauges[name] = func
+
+
+def collect() -> typing.Dict[str, typing.Any]:
+    """
+    Get the current value of all registered metrics.
+
+    :return: Dictionary mapping metric name to current value - None if the value could not be determined
+    """
+    with _lock:
+        gauges = dict(_gauges)
+
+    values = {}
+    for name, func in sorted(gauges.items()):
+        try:
+            values[name] = func()
+
+        except Exception:
+            logger.exception('Failed to collect metric %s', name)
+            values[name] = None
+
+    return values
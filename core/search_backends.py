@@ -0,0 +1,555 @@
+"""
+This module contains a Haystack search backend which stores the search index in an SQLite database using FTS5.
+
+Unlike Whoosh, an SQLite database in WAL mode allows searches to continue while the index is being updated,
+and writers wait briefly for each other rather than holding a lock on the whole index for the duration of a commit.
+Results are ranked by BM25 and terms ending in '*' are matched as prefixes.
+
+To use this backend set the search engine to 'core.search_backends.SqliteEngine' and PATH to the database file.
+"""
+
+import datetime
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import typing
+import warnings
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from haystack.backends import BaseEngine, BaseSearchBackend, BaseSearchQuery, log_query, SearchNode
+from haystack.constants import DJANGO_CT, DJANGO_ID, ID
+from haystack.exceptions import SearchBackendError, SkipDocument
+from haystack.inputs import Clean, PythonData
+from haystack.models import SearchResult
+from haystack.utils import get_identifier, get_model_ct
+from haystack.utils.app_loading import haystack_get_model
+
+logger = logging.getLogger(__name__)
+
+#: Table holding the identifier and stored fields of each document
+DOCUMENT_TABLE = 'haystack_document'
+
+#: FTS5 table holding the indexed fields of each document - with the same rowid as in the document table
+FTS_TABLE = 'haystack_document_fts'
+
+
+def _to_text(value: typing.Any) -> str:
+    """
+    Convert a field value to the text which is indexed.
+    """
+    if value is None:
+        return ''
+
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+
+    if isinstance(value, (list, tuple, set)):
+        return ' '.join(_to_text(item) for item in value)
+
+    return str(value)
+
+
+class SqliteSearchBackend(BaseSearchBackend):
+    """
+    Haystack search backend storing documents in an SQLite database with an FTS5 full text index.
+
+    Each thread holds its own connection to the database.  Connections are reopened if PATH is a symlink which
+    has been changed to point at a different database - e.g. by the `rebuild_search_index` command.
+    """
+    def __init__(self, connection_alias, **connection_options):
+        super().__init__(connection_alias, **connection_options)
+
+        if not connection_options.get('PATH'):
+            raise SearchBackendError(
+                "You must specify a 'PATH' in your settings for connection '%s'." % connection_alias
+            )
+
+        self.path = connection_options['PATH']
+        self.setup_complete = False
+        self.content_field_name = None
+
+        #: Names of indexed fields - one column of the FTS table each, after DJANGO_CT
+        self.columns = []
+
+        self._local = threading.local()
+
+    def _get_connection(self) -> sqlite3.Connection:
+        local = self._local
+        path = os.path.realpath(self.path)
+
+        if getattr(local, 'pid', None) != os.getpid() or getattr(local, 'path', None) != path:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            # Transactions are managed explicitly so writes can take the write lock at the start
+            connection = sqlite3.connect(path, timeout=self.timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+
+            local.pid = os.getpid()
+            local.path = path
+            local.connection = connection
+
+        return local.connection
+
+    def _write(self, statements: typing.Callable[[sqlite3.Connection], None]) -> None:
+        """
+        Run statements modifying the index within a single write transaction.
+        """
+        connection = self._get_connection()
+        connection.execute('BEGIN IMMEDIATE')
+
+        try:
+            statements(connection)
+
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+        connection.execute('COMMIT')
+
+    def setup(self) -> None:
+        """
+        Create the index tables if they do not exist.
+
+        :raises SearchBackendError: If the existing index has different fields than are registered with Haystack
+        """
+        from haystack import connections
+        unified_index = connections[self.connection_alias].get_unified_index()
+
+        self.content_field_name = unified_index.document_field
+        self.columns = sorted(name for name, field in unified_index.all_searchfields().items() if field.indexed)
+
+        def create(connection):
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS {0} ('
+                'rowid INTEGER PRIMARY KEY, '
+                'id TEXT NOT NULL UNIQUE, '
+                'django_ct TEXT NOT NULL, '
+                'django_id TEXT NOT NULL, '
+                'stored TEXT NOT NULL)'.format(DOCUMENT_TABLE)
+            )
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS {0}_django_ct ON {0} (django_ct)'.format(DOCUMENT_TABLE)
+            )
+
+            # Index prefixes of two and three characters so that prefix queries do not scan all terms
+            connection.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS {0} USING fts5({1}, tokenize='porter unicode61', "
+                "prefix='2 3')".format(FTS_TABLE, ', '.join([DJANGO_CT] + self.columns))
+            )
+
+        def get_columns():
+            return [row[1] for row in self._get_connection().execute('PRAGMA table_info({0})'.format(FTS_TABLE))]
+
+        # Only take the write lock if the index has not been created - so searches do not wait for updates
+        existing = get_columns()
+        if not existing:
+            self._write(create)
+            existing = get_columns()
+
+        if existing != [DJANGO_CT] + self.columns:
+            raise SearchBackendError(
+                'Fields of search index at "{0}" do not match the registered search indexes - '
+                'run the rebuild_search_index command'.format(self.path)
+            )
+
+        self.setup_complete = True
+
+    def update(self, index, iterable, commit=True):
+        if not self.setup_complete:
+            self.setup()
+
+        documents = []
+        for obj in iterable:
+            try:
+                prepared = index.full_prepare(obj)
+
+            except SkipDocument:
+                logger.debug('Indexing for object `%s` skipped', obj)
+                continue
+
+            except Exception:
+                if not self.silently_fail:
+                    raise
+
+                logger.exception('Failed to prepare object `%s` for search index', obj)
+                continue
+
+            stored = {
+                field.index_fieldname: prepared.get(field.index_fieldname)
+                for field in index.fields.values() if field.stored
+            }
+            documents.append((
+                prepared[ID], prepared[DJANGO_CT], prepared[DJANGO_ID],
+                json.dumps(stored, cls=DjangoJSONEncoder),
+                [prepared[DJANGO_CT]] + [_to_text(prepared.get(column)) for column in self.columns]
+            ))
+
+        if not documents:
+            return
+
+        fts_columns = ', '.join([DJANGO_CT] + self.columns)
+        placeholders = ', '.join('?' * (len(self.columns) + 2))
+
+        def write(connection):
+            for identifier, django_ct, django_id, stored, indexed in documents:
+                self._delete(connection, 'id = ?', [identifier])
+
+                cursor = connection.execute(
+                    'INSERT INTO {0} (id, django_ct, django_id, stored) VALUES (?, ?, ?, ?)'.format(DOCUMENT_TABLE),
+                    [identifier, django_ct, django_id, stored]
+                )
+                connection.execute(
+                    'INSERT INTO {0} (rowid, {1}) VALUES ({2})'.format(FTS_TABLE, fts_columns, placeholders),
+                    [cursor.lastrowid] + indexed
+                )
+
+        self._write(write)
+
+    @staticmethod
+    def _delete(connection: sqlite3.Connection, where: str, params: typing.List[typing.Any]) -> None:
+        connection.execute(
+            'DELETE FROM {0} WHERE rowid IN (SELECT rowid FROM {1} WHERE {2})'.format(FTS_TABLE, DOCUMENT_TABLE, where),
+            params
+        )
+        connection.execute('DELETE FROM {0} WHERE {1}'.format(DOCUMENT_TABLE, where), params)
+
+    def remove(self, obj_or_string, commit=True):
+        if not self.setup_complete:
+            self.setup()
+
+        identifier = get_identifier(obj_or_string)
+        self._write(lambda connection: self._delete(connection, 'id = ?', [identifier]))
+
+    def clear(self, models=None, commit=True):
+        if not self.setup_complete:
+            self.setup()
+
+        if models is None:
+            self._write(lambda connection: self._delete(connection, '1', []))
+            return
+
+        model_cts = [get_model_ct(model) for model in models]
+        self._write(lambda connection: self._delete(
+            connection, 'django_ct IN ({0})'.format(', '.join('?' * len(model_cts))), model_cts
+        ))
+
+    def _build_order_by(self, sort_by: typing.Optional[typing.Iterable[str]], ranked: bool) -> str:
+        """
+        Build the ORDER BY clause for a search - sorting by stored fields, then by score.
+        """
+        terms = []
+
+        for field_name in sort_by or []:
+            descending = field_name.startswith('-')
+            field_name = field_name.lstrip('-')
+
+            if field_name == 'score':
+                if ranked:
+                    terms.append('score' + (' DESC' if descending else ''))
+                continue
+
+            if not re.fullmatch(r'\w+', field_name):
+                raise SearchBackendError('Cannot sort search results by "{0}"'.format(field_name))
+
+            terms.append("json_extract(d.stored, '$.{0}'){1}".format(field_name, ' DESC' if descending else ''))
+
+        if ranked:
+            terms.append('score DESC')
+
+        terms.append('d.rowid')
+        return ', '.join(terms)
+
+    @log_query
+    def search(self, query_string, sort_by=None, start_offset=0, end_offset=None,
+               fields='', highlight=False, facets=None, date_facets=None, query_facets=None,
+               narrow_queries=None, spelling_query=None, within=None,
+               dwithin=None, distance_point=None, models=None,
+               limit_to_registered_models=None, result_class=None, **kwargs):
+        if not self.setup_complete:
+            self.setup()
+
+        # A zero length query should return no results
+        if not query_string:
+            return {
+                'results': [],
+                'hits': 0,
+            }
+
+        if facets is not None or date_facets is not None or query_facets is not None:
+            warnings.warn('SQLite search backend does not handle faceting.', Warning, stacklevel=2)
+
+        match = [query for query in [query_string] + list(narrow_queries or []) if query != '*']
+        where = []
+        params = []
+
+        if match:
+            where.append('{0} MATCH ?'.format(FTS_TABLE))
+            params.append(' AND '.join('({0})'.format(query) for query in match))
+
+        if limit_to_registered_models is None:
+            limit_to_registered_models = True
+
+        if models:
+            model_cts = sorted(get_model_ct(model) for model in models)
+        elif limit_to_registered_models:
+            model_cts = self.build_models_list()
+        else:
+            model_cts = []
+
+        if model_cts:
+            where.append('d.django_ct IN ({0})'.format(', '.join('?' * len(model_cts))))
+            params.extend(model_cts)
+
+        if match:
+            # Type of document should not affect ranking - BM25 is negated by SQLite so that best sorts first
+            weights = ', '.join(['0.0'] + ['1.0'] * len(self.columns))
+            # Cross join forces documents to be found from the full text index rather than checked one by one
+            from_clause = '{0} CROSS JOIN {1} d ON d.rowid = {0}.rowid'.format(FTS_TABLE, DOCUMENT_TABLE)
+            score = '-bm25({0}, {1})'.format(FTS_TABLE, weights)
+        else:
+            from_clause = '{0} d'.format(DOCUMENT_TABLE)
+            score = '0.0'
+
+        columns = ['d.django_ct', 'd.django_id', 'd.stored', score + ' AS score']
+        if highlight and match and self.content_field_name in self.columns:
+            column_index = self.columns.index(self.content_field_name) + 1
+            columns.append("snippet({0}, {1}, '<em>', '</em>', '...', 32)".format(FTS_TABLE, column_index))
+
+        where_clause = ' AND '.join(where) or '1'
+        limit = -1 if end_offset is None else max(end_offset - start_offset, 0)
+
+        connection = self._get_connection()
+        try:
+            hits = connection.execute(
+                'SELECT COUNT(*) FROM {0} WHERE {1}'.format(from_clause, where_clause), params
+            ).fetchone()[0]
+
+            rows = connection.execute(
+                'SELECT {0} FROM {1} WHERE {2} ORDER BY {3} LIMIT ? OFFSET ?'.format(
+                    ', '.join(columns), from_clause, where_clause, self._build_order_by(sort_by, bool(match))
+                ),
+                params + [limit, start_offset]
+            ).fetchall()
+
+        except sqlite3.OperationalError:
+            if not self.silently_fail:
+                raise
+
+            logger.exception('Failed to search for "%s"', query_string)
+            return {
+                'results': [],
+                'hits': 0,
+            }
+
+        return self._process_results(rows, hits, result_class)
+
+    def _process_results(self, rows: typing.List[tuple], hits: int, result_class=None) -> typing.Dict[str, typing.Any]:
+        from haystack import connections
+        unified_index = connections[self.connection_alias].get_unified_index()
+        indexed_models = unified_index.get_indexed_models()
+
+        if result_class is None:
+            result_class = SearchResult
+
+        results = []
+        for row in rows:
+            django_ct, django_id, stored, score = row[:4]
+            app_label, model_name = django_ct.split('.')
+            model = haystack_get_model(app_label, model_name)
+
+            if model is None or model not in indexed_models:
+                hits -= 1
+                continue
+
+            index = unified_index.get_index(model)
+            additional_fields = {}
+            for key, value in json.loads(stored).items():
+                if key in index.fields and value is not None:
+                    value = index.fields[key].convert(value)
+
+                additional_fields[key] = value
+
+            if len(row) > 4:
+                additional_fields['highlighted'] = {
+                    self.content_field_name: [row[4]],
+                }
+
+            results.append(result_class(app_label, model_name, django_id, score, **additional_fields))
+
+        return {
+            'results': results,
+            'hits': hits,
+            'facets': {},
+            'spelling_suggestion': None,
+        }
+
+
+class SqliteSearchQuery(BaseSearchQuery):
+    """
+    Builds FTS5 query expressions for :class:`SqliteSearchBackend`.
+
+    Each term is quoted, so user input cannot inject FTS5 syntax.  'contains' and 'fuzzy' filters match whole terms,
+    'startswith' matches prefixes of terms.  FTS5 does not support suffix or range queries.
+    """
+    #: Matches a quoted term or phrase - possibly negated or a prefix - within a prepared query
+    _term_re = re.compile(r'\s*(NOT\s+)?("(?:[^"]|"")*"\*?)\s*')
+
+    def _match_all(self) -> str:
+        """
+        Build an expression which matches any document, since FTS5 does not allow a query to start with NOT.
+        """
+        from haystack import connections
+        model_cts = sorted(get_model_ct(model)
+                           for model in connections[self._using].get_unified_index().get_indexed_models())
+
+        return '{%s} : (%s)' % (DJANGO_CT, ' OR '.join('"%s"' % model_ct for model_ct in model_cts))
+
+    def clean(self, query_fragment):
+        """
+        Quote each term, keeping a trailing '*' to indicate a prefix query.
+        """
+        cleaned_words = []
+
+        for word in query_fragment.split():
+            prefix = word.endswith('*') and len(word.rstrip('*')) > 0
+            cleaned_words.append('"%s"%s' % (word.rstrip('*').replace('"', '""'), '*' if prefix else ''))
+
+        return ' '.join(cleaned_words)
+
+    def build_exact_query(self, query_string):
+        # Terms may already be quoted by :meth:`clean`
+        return '"%s"' % query_string.replace('"', '').replace('*', ' ')
+
+    def build_not_query(self, query_string):
+        return 'NOT %s' % query_string
+
+    def _split_terms(self, prepared_value: str) -> typing.Optional[typing.Tuple[typing.List[str], typing.List[str]]]:
+        """
+        Split a prepared query into terms to be matched and terms to be excluded.
+
+        :return: Tuple of included and excluded terms - or None if the query is not a sequence of quoted terms
+        """
+        included = []
+        excluded = []
+
+        position = 0
+        while position < len(prepared_value):
+            term_match = self._term_re.match(prepared_value, position)
+            if term_match is None:
+                return None
+
+            (excluded if term_match.group(1) else included).append(term_match.group(2))
+            position = term_match.end()
+
+        return included, excluded
+
+    def _build_terms_query(self, column: str, included: typing.List[str], excluded: typing.List[str]) -> str:
+        """
+        Build an expression matching all included terms and no excluded terms within a single field.
+        """
+        if not included:
+            return '(%s NOT {%s} : (%s))' % (self._match_all(), column, ' OR '.join(excluded))
+
+        query = ' AND '.join(included)
+        if excluded:
+            query += ' NOT ' + ' NOT '.join(excluded)
+
+        return '{%s} : (%s)' % (column, query)
+
+    def build_query_fragment(self, field, filter_type, value):
+        from haystack import connections
+        unified_index = connections[self._using].get_unified_index()
+
+        if not hasattr(value, 'input_type_name'):
+            # Handle when we've got a ``ValuesListQuerySet``...
+            if hasattr(value, 'values_list'):
+                value = list(value)
+
+            if isinstance(value, str) and value != ' ':
+                # It's not an ``InputType``. Assume ``Clean``.
+                value = Clean(value)
+            else:
+                value = PythonData(value)
+
+        prepared_value = value.prepare(self)
+
+        # 'content' is a special reserved word, much like 'pk' in Django's ORM layer - it indicates the document field
+        if field == 'content':
+            column = unified_index.document_field
+        else:
+            column = unified_index.get_index_fieldname(field)
+
+        if value.input_type_name == 'raw':
+            return '{%s} : (%s)' % (column, prepared_value)
+
+        if filter_type == 'in':
+            return '{%s} : (%s)' % (
+                column, ' OR '.join(self.build_exact_query(_to_text(item)) for item in prepared_value)
+            )
+
+        if filter_type == 'exact' or value.input_type_name == 'exact':
+            if value.input_type_name != 'exact':
+                prepared_value = self.build_exact_query(_to_text(prepared_value))
+
+            return '{%s} : (%s)' % (column, prepared_value)
+
+        if filter_type not in {'content', 'contains', 'fuzzy', 'startswith'}:
+            raise SearchBackendError('SQLite search backend does not support "{0}" filters'.format(filter_type))
+
+        if not isinstance(prepared_value, str):
+            prepared_value = self.clean(_to_text(prepared_value))
+
+        terms = self._split_terms(prepared_value)
+        if terms is None:
+            return '{%s} : (%s)' % (column, prepared_value)
+
+        included, excluded = terms
+        if filter_type == 'startswith':
+            included = [term if term.endswith('*') else term + '*' for term in included]
+
+        return self._build_terms_query(column, included, excluded)
+
+    def _build_node(self, node: SearchNode) -> str:
+        """
+        Build the expression for a node of the query - as :meth:`SearchNode.as_query_string` but with negation
+        expressed relative to all documents.
+        """
+        result = []
+
+        for child in node.children:
+            if isinstance(child, SearchNode):
+                child_query = self._build_node(child)
+            else:
+                expression, value = child
+                field, filter_type = node.split_expression(expression)
+                child_query = self.build_query_fragment(field, filter_type, value)
+
+            if child_query:
+                result.append(child_query)
+
+        query_string = (' %s ' % node.connector).join(result)
+
+        if query_string:
+            if node.negated:
+                query_string = '(%s NOT (%s))' % (self._match_all(), query_string)
+            elif len(result) != 1:
+                query_string = '(%s)' % query_string
+
+        return query_string
+
+    def build_query(self):
+        # Boosts are not supported - ranking uses BM25 only
+        return self._build_node(self.query_filter) or self.matching_all_fragment()
+
+
+class SqliteEngine(BaseEngine):
+    backend = SqliteSearchBackend
+    query = SqliteSearchQuery
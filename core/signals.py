@@ -0,0 +1,259 @@
+"""
+This module contains a Haystack signal processor which updates the search index in batches from a background thread.
+
+Saving a model instance only records that it needs to be indexed, so the cost of writing to the search index -
+and waiting for the index lock - is not added to the response time.
+"""
+
+import atexit
+import logging
+import os
+import threading
+import time
+import typing
+
+from django.conf import settings
+from django.db import close_old_connections, models, transaction
+
+from haystack import connections, signals
+from haystack.exceptions import NotHandled
+from haystack.utils import get_model_ct
+
+from core import metrics
+
+logger = logging.getLogger(__name__)
+
+#: Maximum time in seconds to wait before retrying an instance which could not be indexed
+MAX_RETRY_DELAY = 60 * 60
+
+#: Suffix of the file alongside an index to which changed instances are logged while the index is being rebuilt
+#: - see the `rebuild_search_index` command
+REBUILD_LOG_SUFFIX = '.changes'
+
+
+def update_instances(using: str, backend, model: typing.Type[models.Model], pks: typing.Iterable) -> None:
+    """
+    Update a search index for a batch of instances of a single model.
+
+    Instances which are no longer returned by the search index queryset are removed from the index.
+
+    :param using: Search connection alias
+    :param backend: Search backend to update
+    :param model: Model of which the instances are to be updated
+    :param pks: Primary keys of instances to update
+    """
+    pks = list(pks)
+    index = connections[using].get_unified_index().get_index(model)
+
+    instances = list(index.index_queryset(using=using).filter(pk__in=pks))
+    if instances:
+        backend.update(index, instances)
+
+    # Primary keys read from a rebuild log are strings
+    found = {str(instance.pk) for instance in instances}
+    for pk in pks:
+        if str(pk) not in found:
+            backend.remove('{0}.{1}'.format(get_model_ct(model), pk))
+
+
+class QueuedSignalProcessor(signals.BaseSignalProcessor):
+    """
+    Records model instances which have been saved or deleted and updates the search index for them in batches.
+    Instances are recorded once the transaction in which they were modified has been committed.
+
+    Repeated updates to the same instance before a batch is processed are merged, and the instance is read from
+    the database when the batch is processed, so the index receives its latest state.
+    Instances which are no longer returned by the search index queryset - e.g. deleted - are removed from the index.
+
+    A batch is processed every SEARCH_INDEX_FLUSH_INTERVAL seconds and when the process exits.
+    If a batch fails, its instances are indexed one at a time, and any which still fail are retried on their own
+    after a delay which doubles with each failure.
+    Number of waiting instances and the time for which the oldest has waited are registered as metrics.
+
+    While an index is being rebuilt, changed instances are also logged so that the rebuild can apply them to the
+    new index before and after it is swapped into place - see :data:`REBUILD_LOG_SUFFIX`.
+    """
+    def setup(self):
+        self._pid = None
+        self._reset()
+
+        models.signals.post_save.connect(self.handle_save)
+        models.signals.post_delete.connect(self.handle_delete)
+
+        metrics.register_gauge('search_index.depth', self.depth)
+        metrics.register_gauge('search_index.lag', self.lag)
+
+        atexit.register(self.flush)
+
+    def teardown(self):
+        models.signals.post_save.disconnect(self.handle_save)
+        models.signals.post_delete.disconnect(self.handle_delete)
+
+    def _reset(self) -> None:
+        """
+        Discard state inherited from a parent process after a fork, since threads are not inherited.
+        """
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._thread = None
+
+        #: Maps (connection alias, model) to a dictionary mapping primary key to time at which it was first recorded
+        self._pending = {}
+
+        #: Maps (connection alias, model, primary key) of instances which could not be indexed to
+        #: number of failures and time before which they will not be retried
+        self._retries = {}
+
+    def depth(self) -> int:
+        """
+        Get the number of model instances waiting to be indexed.
+        """
+        with self._lock:
+            return sum(len(pks) for pks in self._pending.values())
+
+    def lag(self) -> float:
+        """
+        Get the time in seconds for which the oldest model instance has been waiting to be indexed.
+        """
+        with self._lock:
+            oldest = min((min(pks.values()) for pks in self._pending.values() if pks), default=None)
+
+        return 0 if oldest is None else time.monotonic() - oldest
+
+    def _add(self, sender, instance, pk, save_kwargs: typing.Optional[typing.Mapping] = None) -> None:
+        if self._pid != os.getpid():
+            self._reset()
+
+        for using in self.connection_router.for_write(instance=instance):
+            try:
+                index = self.connections[using].get_unified_index().get_index(sender)
+
+            except NotHandled:
+                continue
+
+            # Index may ignore saves which do not change its contents - see SearchIndex.should_update
+            if save_kwargs is not None and not index.should_update(instance, **save_kwargs):
+                continue
+
+            with self._lock:
+                self._pending.setdefault((using, sender), {}).setdefault(pk, time.monotonic())
+
+                # The instance has changed so may now be indexed successfully
+                self._retries.pop((using, sender, pk), None)
+
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name='search_index', daemon=True)
+                    self._thread.start()
+
+            self._log_change(using, sender, pk)
+
+    def handle_save(self, sender, instance, **kwargs):
+        # Changes cannot be read by the background thread until they have been committed
+        pk = instance.pk
+        transaction.on_commit(lambda: self._add(sender, instance, pk, kwargs))
+
+    def handle_delete(self, sender, instance, **kwargs):
+        # Primary key of a deleted instance is cleared before the transaction is committed
+        pk = instance.pk
+        transaction.on_commit(lambda: self._add(sender, instance, pk))
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(settings.SEARCH_INDEX_FLUSH_INTERVAL)
+            self.flush()
+
+            # This thread holds its own database connection
+            close_old_connections()
+
+    def _update_index(self, using: str, model: typing.Type[models.Model], pks: typing.Iterable) -> None:
+        """
+        Update the search index for a batch of instances of a single model.
+        """
+        update_instances(using, self.connections[using].get_backend(), model, pks)
+
+    def _log_change(self, using: str, model: typing.Type[models.Model], pk) -> None:
+        """
+        Record a changed instance if its index is being rebuilt, so that the change is also applied to the new index.
+
+        The log only exists while the `rebuild_search_index` command is running.
+        """
+        path = self.connections[using].options.get('PATH')
+        if not path:
+            return
+
+        try:
+            # Do not create the log if the rebuild has finished
+            log = os.open(os.path.abspath(path) + REBUILD_LOG_SUFFIX, os.O_WRONLY | os.O_APPEND)
+
+        except FileNotFoundError:
+            return
+
+        try:
+            # A single small append is not interleaved with appends from other processes
+            os.write(log, '{0}.{1}\n'.format(get_model_ct(model), pk).encode('utf-8'))
+
+        finally:
+            os.close(log)
+
+    def _defer(self, using: str, model: typing.Type[models.Model], pk, recorded: float) -> None:
+        """
+        Keep an instance which could not be indexed to be retried after a delay.
+        """
+        with self._lock:
+            failures, retry_at = self._retries.get((using, model, pk), (0, None))
+            delay = min(settings.SEARCH_INDEX_FLUSH_INTERVAL * 2 ** failures, MAX_RETRY_DELAY)
+            self._retries[(using, model, pk)] = (failures + 1, time.monotonic() + delay)
+
+            retry = self._pending.setdefault((using, model), {})
+            retry[pk] = min(recorded, retry.get(pk, recorded))
+
+    def flush(self) -> None:
+        """
+        Update the search index for all waiting model instances.
+
+        If the index cannot be updated the instances are kept to be retried - see :meth:`_defer`.
+        """
+        if self._pid != os.getpid():
+            return
+
+        now = time.monotonic()
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+            # Instances waiting for a retry stay pending
+            for (using, model), pks in pending.items():
+                for pk in list(pks):
+                    failures, retry_at = self._retries.get((using, model, pk), (0, now))
+                    if retry_at > now:
+                        self._pending.setdefault((using, model), {})[pk] = pks.pop(pk)
+
+        for (using, model), pks in pending.items():
+            if not pks:
+                continue
+
+            try:
+                self._update_index(using, model, list(pks))
+
+            except Exception:
+                logger.warning('Failed to update search index for %d instances of %s - retrying individually',
+                               len(pks), model.__name__)
+
+            else:
+                with self._lock:
+                    for pk in pks:
+                        self._retries.pop((using, model, pk), None)
+
+                continue
+
+            # Isolate the instances which cannot be indexed so that they do not hold up the others
+            for pk, recorded in pks.items():
+                try:
+                    self._update_index(using, model, [pk])
+
+                except Exception:
+                    logger.exception('Failed to update search index for %s %s', model.__name__, pk)
+                    self._defer(using, model, pk, recorded)
+
+                else:
+                    with self._lock:
+                        self._retries.pop((using, model, pk), None)
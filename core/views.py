@@ -4,8 +4,11 @@ This module contains views for behaviour common to both Application and DataSour
 
 from django.contrib.auth import get_user_model
 from django.http import JsonResponse, HttpResponseBadRequest, HttpResponseForbidden
+from django.views.generic import View
 from django.views.generic.detail import DetailView
 
+from core import autocomplete
+
 
 class ManageAccessView(DetailView):
     """
@@ -98,3 +101,37 @@ class ManageAccessView(DetailView):
                 },
             },
         })
+
+
+class AutocompleteView(View):
+    """
+    Suggest data sources, applications and metadata values matching the text typed into a search box.
+
+    Only data sources which the user may view, and their metadata values, are suggested.
+
+    Accepts GET requests with parameters 'q' - the text typed so far - and optionally 'limit'.
+    Request responses follow JSend specification (see http://labs.omniti.com/labs/jsend).
+    """
+    #: Maximum number of suggestions which may be requested
+    max_limit = 50
+
+    def get(self, request, *args, **kwargs):
+        try:
+            limit = min(int(request.GET.get('limit', 10)), self.max_limit)
+
+        except ValueError:
+            return HttpResponseBadRequest(
+                JsonResponse({
+                    'status': 'fail',
+                    'message': 'Parameter limit must be an integer',
+                })
+            )
+
+        suggestions = autocomplete.index.lookup(request.GET.get('q', ''), request.user, limit)
+
+        return JsonResponse({
+            'status': 'success',
+            'data': {
+                'results': [suggestion._asdict() for suggestion in suggestions],
+            },
+        })
@@ -18,6 +18,9 @@ class DatasourcesConfig(AppConfig):
 
     def ready(self):
         # Runs after app registry is populated - i.e. all models exist and are importable
+        # Connect signal handlers
+        from datasources import signals
+
         try:
             self.create_operational_metadata()
             logging.info('Loaded inline MetadataField fixtures')
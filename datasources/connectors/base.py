@@ -45,6 +45,24 @@ class AuthMethod(enum.IntEnum):
         return tuple((i.value, i.name) for i in cls)
 
 
+class WriteBufferMode(enum.IntEnum):
+    """
+    How single rows pushed to an internal data source are written.
+    """
+    # Write each row to the database before acknowledging it
+    DISABLED = 0
+
+    # Acknowledge rows once journalled locally - rows may be lost if the server loses power
+    BUFFERED = 1
+
+    # Acknowledge rows once journalled locally and flushed to disk
+    DURABLE = 2
+
+    @classmethod
+    def choices(cls):
+        return tuple((i.value, i.name) for i in cls)
+
+
 class HttpHeaderAuth(requests.auth.HTTPBasicAuth):
     """
     Requests Auth provider.
@@ -214,6 +232,30 @@ class InternalDataConnector(ReadOnlyInternalDataConnector):
         """
         raise NotImplementedError
 
+    def buffer_data(self, data: typing.MutableMapping[str, str], durable: bool = False):
+        """
+        Add a single row to this data source, allowing it to be written as part of a later batch.
+
+        Connectors should override this if they are able to acknowledge a row before it has been written.
+
+        :param data: Row to add
+        :param durable: Must the row be flushed to disk before returning?
+        """
+        self.post_data(data)
+
+    def replace_data(self, data: typing.Iterable[typing.MutableMapping[str, str]], **kwargs):
+        """
+        Replace all data in this data source.
+
+        Connectors should override this if they are able to replace data without leaving the
+        data source empty or partially loaded while the new data is added.
+
+        :param data: Data to replace existing data
+        """
+        self.clear_data()
+        self.post_data(list(data))
+        self.clean_data(**kwargs)
+
 
 class DataCatalogueConnector(BaseDataConnector, collections_abc.Mapping):
     """
@@ -2,15 +2,82 @@
 Connectors for handling CSV data.
 """
 
+import atexit
+from collections import OrderedDict
 import csv
+import datetime
+import enum
+import logging
+import os
+import random
+import threading
+import time
 import typing
+from urllib.parse import quote, unquote
+import uuid
 
+from django.conf import settings
 from django.http import JsonResponse
+from django.utils import timezone
 
+from bson import json_util
+from bson.errors import InvalidDocument
+from bson.objectid import ObjectId
+from bson.son import SON
 import mongoengine
 from mongoengine import context_managers
+from mongoengine.queryset import transform
+import pymongo
+import pymongo.collection
+import pymongo.errors
 
 from .base import DataSetConnector, InternalDataConnector
+from core import metrics
+from core.batching import BatchWorker
+
+logger = logging.getLogger(__name__)
+
+#: Minimum number of sampled queries using a field before an index is recommended
+INDEX_ADVISOR_MIN_QUERIES = 10
+
+#: Minimum ratio of documents examined to documents returned before an index is recommended
+INDEX_ADVISOR_MIN_SPEEDUP = 10
+
+#: Aggregation operators which may be requested using the 'metric' query parameter
+AGGREGATION_OPERATORS = {
+    'sum': '$sum',
+    'avg': '$avg',
+    'min': '$min',
+    'max': '$max',
+}
+
+#: Number of rows inserted in each batch when replacing the data in a collection
+REPLACE_BATCH_SIZE = 1000
+
+#: Time after which an index build which has not reported completion is assumed to have failed
+INDEX_BUILD_TIMEOUT = datetime.timedelta(hours=1)
+
+#: Number of seconds in each unit which may be used to define a time bucket - e.g. '15m'
+BUCKET_UNITS = {
+    's': 1,
+    'm': 60,
+    'h': 60 * 60,
+    'd': 24 * 60 * 60,
+}
+
+
+def _check_field_name(name: str) -> str:
+    """
+    Check that a field name given in a query parameter cannot be interpreted by MongoDB as an operator or path.
+
+    :param name: Field name
+    :return: Field name
+    :raises ValueError: Field name starts with '$' or contains '.'
+    """
+    if not name or name.startswith('$') or '.' in name:
+        raise ValueError('Invalid field name \'{0}\''.format(name))
+
+    return name
 
 
 class CsvConnector(DataSetConnector):
@@ -75,6 +142,230 @@ class CsvConnector(DataSetConnector):
             }, status=500)
 
 
+class QueryShapeStats(mongoengine.Document):
+    """
+    Statistics of sampled queries against a collection of internal data, grouped by the set of fields filtered on.
+
+    Used to recommend which fields should be indexed.
+    """
+    meta = {
+        'db_alias': 'internal_data',
+        'indexes': [
+            ('collection', 'fields'),
+        ],
+    }
+
+    #: Name of the collection which was queried
+    collection = mongoengine.fields.StringField(required=True)
+
+    #: Fields used to filter the query - sorted
+    fields = mongoengine.fields.ListField(mongoengine.fields.StringField())
+
+    #: Number of sampled queries
+    queries = mongoengine.fields.IntField(default=0)
+
+    #: Total time taken by sampled queries in seconds
+    total_time = mongoengine.fields.FloatField(default=0)
+
+    #: Number of sampled queries for which the query plan could be explained
+    explained = mongoengine.fields.IntField(default=0)
+
+    #: Total number of documents examined by explained queries
+    total_examined = mongoengine.fields.IntField(default=0)
+
+    #: Total number of documents returned by explained queries
+    total_returned = mongoengine.fields.IntField(default=0)
+
+    #: When this query shape was last seen
+    last_seen = mongoengine.fields.DateTimeField()
+
+
+def recommend_indexes(stats: typing.Iterable[QueryShapeStats],
+                      indexed_fields: typing.Collection[str],
+                      min_queries: int = INDEX_ADVISOR_MIN_QUERIES,
+                      min_speedup: float = INDEX_ADVISOR_MIN_SPEEDUP) -> typing.List[typing.Dict[str, typing.Any]]:
+    """
+    Recommend fields which should be indexed based on observed query patterns.
+
+    A field is recommended if it is not already indexed, is used to filter enough queries and the
+    queries which use it examine many more documents than they return.
+
+    :param stats: Sampled query statistics
+    :param indexed_fields: Fields which are already indexed
+    :param min_queries: Minimum number of sampled queries using a field before it is recommended
+    :param min_speedup: Minimum estimated speedup before a field is recommended
+    :return: Recommended fields with estimated speedup - most beneficial first
+    """
+    totals = {}
+    for stat in stats:
+        for field in stat.fields:
+            total = totals.setdefault(field, {
+                'queries': 0, 'time': 0, 'explained': 0, 'examined': 0, 'returned': 0
+            })
+            total['queries'] += stat.queries
+            total['time'] += stat.total_time
+            total['explained'] += stat.explained
+            total['examined'] += stat.total_examined
+            total['returned'] += stat.total_returned
+
+    recommendations = []
+    for field, total in totals.items():
+        if field in indexed_fields or total['queries'] < min_queries or not total['explained']:
+            continue
+
+        # Estimate the speedup as the ratio of documents examined to documents returned
+        speedup = total['examined'] / max(total['returned'], 1)
+        if speedup < min_speedup:
+            continue
+
+        recommendations.append({
+            'field': field,
+            'queries': total['queries'],
+            'mean_time': total['time'] / total['queries'],
+            'estimated_speedup': speedup,
+        })
+
+    recommendations.sort(key=lambda r: r['queries'] * r['estimated_speedup'], reverse=True)
+    return recommendations
+
+
+def _record_query_samples(batch: typing.List[typing.Tuple[str, typing.Dict[str, typing.Any],
+                                                         float, datetime.datetime]]) -> None:
+    """
+    Explain a batch of sampled queries and add them to the statistics used by the index advisor.
+
+    :param batch: Sampled queries - collection name, query filter, query time in seconds and time of query
+    """
+    db = CsvRow._get_db()
+
+    for location, query, query_time, seen in batch:
+        update = {
+            'inc__queries': 1,
+            'inc__total_time': query_time,
+            'set__last_seen': seen,
+        }
+
+        try:
+            explain = db.command(SON([
+                ('explain', SON([('find', location), ('filter', query)])),
+                ('verbosity', 'executionStats'),
+            ]))
+            execution_stats = explain['executionStats']
+
+            update.update({
+                'inc__explained': 1,
+                'inc__total_examined': execution_stats['totalDocsExamined'],
+                'inc__total_returned': execution_stats['nReturned'],
+            })
+
+        except (pymongo.errors.PyMongoError, KeyError, NotImplementedError):
+            # Query plan is not available - record timing only
+            pass
+
+        QueryShapeStats.objects(collection=location, fields=sorted(query)).update_one(upsert=True, **update)
+
+
+#: Explains and records sampled queries in the background, so they do not add to the response time
+query_sampler = BatchWorker('query_sampler', _record_query_samples, max_size=1000)
+
+
+def _sync_indexes(location: str) -> None:
+    """
+    Create and drop indexes on a collection to match the fields most recently requested to be indexed.
+
+    All single field indexes other than on '_id' are managed by PEDASI - those on fields which are not requested
+    are dropped, including any created before the requested fields were recorded.
+
+    :param location: Name of the collection
+    """
+    try:
+        state = CollectionIndexState.objects.get(collection=location)
+
+    except CollectionIndexState.DoesNotExist:
+        return
+
+    index_fields = set(state.fields)
+    collection = CsvRow._get_db()[location]
+
+    status, message = IndexStatus.READY, None
+    try:
+        existing = {
+            index['key'][0][0]: name for name, index in collection.index_information().items()
+            if len(index['key']) == 1 and index['key'][0][0] != '_id'
+        }
+
+        for index_field in index_fields - existing.keys():
+            collection.create_index(index_field, background=True)
+
+        for index_field in existing.keys() - index_fields:
+            collection.drop_index(existing[index_field])
+
+    except pymongo.errors.PyMongoError as exc:
+        status, message = IndexStatus.FAILED, str(exc)
+        logger.exception('Failed to update indexes on collection %s', location)
+
+    # If different fields were requested while building, another build has been queued - leave its state
+    CollectionIndexState.objects(collection=location, updated=state.updated).update_one(
+        set__status=status.value,
+        set__message=message,
+        set__updated=timezone.now()
+    )
+
+
+def _sync_index_batch(locations: typing.List[str]) -> None:
+    """
+    Update the indexes on each collection in a batch - once per collection however many times it was queued.
+    """
+    for location in OrderedDict.fromkeys(locations):
+        _sync_indexes(location)
+
+
+#: Builds indexes on internal data sources in the background - one collection at a time
+index_builder = BatchWorker('index_builder', _sync_index_batch, max_size=1000)
+
+
+@enum.unique
+class IndexStatus(enum.Enum):
+    """
+    State of the indexes managed by PEDASI on a collection of internal data.
+    """
+    #: All requested indexes have been built
+    READY = 'ready'
+
+    #: Indexes are being built or dropped in the background
+    BUILDING = 'building'
+
+    #: The last attempt to build or drop indexes failed
+    FAILED = 'failed'
+
+
+class CollectionIndexState(mongoengine.Document):
+    """
+    Record of the indexes which PEDASI manages on a collection of internal data.
+
+    Allows index changes to be made only when the requested indexes change, rather than on every push of data.
+    """
+    meta = {
+        'db_alias': 'internal_data',
+    }
+
+    #: Name of the collection to which these indexes belong
+    collection = mongoengine.fields.StringField(required=True, unique=True)
+
+    #: Fields which should be indexed
+    fields = mongoengine.fields.ListField(mongoengine.fields.StringField())
+
+    #: Current state of the indexes - from :class:`IndexStatus`
+    status = mongoengine.fields.StringField(choices=[status.value for status in IndexStatus],
+                                            default=IndexStatus.READY.value)
+
+    #: Error message if the last index build failed
+    message = mongoengine.fields.StringField()
+
+    #: When this state was last changed
+    updated = mongoengine.fields.DateTimeField()
+
+
 class CsvRow(mongoengine.DynamicDocument):
     """
     MongoDB dynamic document to store CSV data.
@@ -104,6 +395,364 @@ def _type_convert(val):
     return val
 
 
+def _parse_bucket(bucket: str) -> int:
+    """
+    Convert a time bucket definition - e.g. '1h', '15m' - into a number of seconds.
+
+    :param bucket: Time bucket definition
+    :return: Bucket width in seconds
+    :raises ValueError: Time bucket definition is not valid
+    """
+    try:
+        width = int(bucket[:-1]) * BUCKET_UNITS[bucket[-1]]
+
+    except (IndexError, KeyError, ValueError) as exc:
+        raise ValueError('Invalid time bucket \'{0}\''.format(bucket)) from exc
+
+    if width <= 0:
+        raise ValueError('Time bucket must be positive')
+
+    return width
+
+
+def _process_exists(pid: int) -> bool:
+    """
+    Is there a running process with this process id?
+    """
+    try:
+        os.kill(pid, 0)
+
+    except ProcessLookupError:
+        return False
+
+    except PermissionError:
+        # Process exists but belongs to another user
+        pass
+
+    return True
+
+
+def _process_start_time(pid: int) -> typing.Optional[int]:
+    """
+    Get the time at which a process started, in clock ticks since boot.
+
+    :return: Start time, or None if it cannot be read - e.g. not running on Linux or process has exited
+    """
+    try:
+        with open('/proc/{0}/stat'.format(pid)) as f:
+            stat = f.read()
+
+    except OSError:
+        return None
+
+    # Process name is in parentheses and may contain spaces - start time is the 20th field after it
+    return int(stat.rsplit(')', 1)[1].split()[19])
+
+
+def _process_owner_id(pid: int) -> str:
+    """
+    Get an identifier for a process which is not shared with a later process reusing its process id.
+    """
+    start_time = _process_start_time(pid)
+    if start_time is None:
+        return str(pid)
+
+    return '{0}-{1}'.format(pid, start_time)
+
+
+def _process_owner_exists(owner: str) -> bool:
+    """
+    Is the process identified by :func:`_process_owner_id` still running?
+
+    :raises ValueError: Not a process identifier
+    """
+    pid, _, start_time = owner.partition('-')
+    pid = int(pid)
+
+    if not _process_exists(pid):
+        return False
+
+    # Process id may have been reused by a later process
+    return not start_time or _process_start_time(pid) in {None, int(start_time)}
+
+
+class WriteBuffer:
+    """
+    Buffer of single rows pushed to internal data sources, waiting to be written to MongoDB in batches.
+
+    Rows are appended to a journal file per collection and process before being acknowledged.
+    A background thread writes journals to MongoDB when they reach the batch size or flush interval.
+
+    Each row is assigned its ObjectId when it is journalled, so replaying a journal which was partially
+    written before a crash does not duplicate rows.
+    Journals left behind by processes which have exited are claimed and written by the next flush.
+    Journals are named by process id and start time, so a journal is still claimed if its process id has been reused.
+    """
+    def __init__(self):
+        self._pid = None
+
+        #: Identifies this process in journal filenames - see :func:`_process_owner_id`
+        self._owner = None
+
+        #: Protects the journals currently being appended to
+        self._lock = threading.Lock()
+
+        #: Only one flush may be in progress at a time
+        self._flush_lock = threading.Lock()
+
+        self._flush_event = threading.Event()
+        self._thread = None
+
+        #: Open journal file for each collection
+        self._journals = {}
+
+        #: Number of rows in the open journal for each collection
+        self._journal_depth = {}
+
+        #: Number of rows in each journal which has been closed but not yet written
+        self._closed_depth = {}
+
+    @staticmethod
+    def _journal_name(collection: str, owner: str, suffix: str) -> str:
+        # Escape '.' so that the collection name can be split from the rest of the filename
+        return os.path.join(settings.WRITE_BUFFER_DIR,
+                            '.'.join([quote(collection, safe='').replace('.', '%2E'), owner, suffix]))
+
+    @staticmethod
+    def _rejected_path(path: str) -> str:
+        """
+        Get the path within the 'rejected' directory to which rows from a journal which can never be written to
+        MongoDB are moved, so that they are not retried but are kept for inspection.
+        """
+        rejected_dir = os.path.join(settings.WRITE_BUFFER_DIR, 'rejected')
+        os.makedirs(rejected_dir, exist_ok=True)
+
+        return os.path.join(rejected_dir, os.path.basename(path))
+
+    def _reject_documents(self, path: str, documents: typing.List[typing.Dict]) -> None:
+        rejected_path = self._rejected_path(path)
+        with open(rejected_path, 'a') as rejected:
+            for document in documents:
+                rejected.write(json_util.dumps(document) + '\n')
+
+        logger.error('Rejected %d buffered rows which could not be written - see %s', len(documents), rejected_path)
+
+    def _reset(self) -> None:
+        """
+        Discard the state inherited from a parent process after a fork.
+
+        Journals belonging to the parent process are left for the parent to write.
+        """
+        self._pid = os.getpid()
+        self._owner = _process_owner_id(self._pid)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flush_event = threading.Event()
+        self._thread = None
+        self._journals = {}
+        self._journal_depth = {}
+        self._closed_depth = {}
+
+    def _ensure_worker(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            self._flush_event.wait(settings.WRITE_BUFFER_FLUSH_INTERVAL)
+            self._flush_event.clear()
+
+            try:
+                self.flush()
+
+            except Exception:
+                logger.exception('Failed to flush write buffer')
+
+    def depth(self) -> int:
+        """
+        Get the number of rows buffered by this process which have not yet been written to MongoDB.
+        """
+        with self._lock:
+            return sum(self._journal_depth.values()) + sum(self._closed_depth.values())
+
+    def append(self, collection: str, document: typing.Dict, durable: bool = False) -> None:
+        """
+        Add a document to the buffer for a collection.
+
+        :param collection: Name of collection to which the document will be written
+        :param document: Document to write
+        :param durable: Must the document be flushed to disk before returning?
+        """
+        document.setdefault('_id', ObjectId())
+        line = json_util.dumps(document) + '\n'
+
+        if self._pid != os.getpid():
+            self._reset()
+
+        with self._lock:
+            journal = self._journals.get(collection)
+            if journal is None:
+                os.makedirs(settings.WRITE_BUFFER_DIR, exist_ok=True)
+                journal = open(self._journal_name(collection, self._owner, 'journal'), 'a')
+                self._journals[collection] = journal
+                self._journal_depth[collection] = 0
+
+            journal.write(line)
+            journal.flush()
+            if durable:
+                os.fsync(journal.fileno())
+
+            self._journal_depth[collection] += 1
+            batch_full = self._journal_depth[collection] >= settings.WRITE_BUFFER_BATCH_SIZE
+
+            self._ensure_worker()
+
+        if batch_full:
+            self._flush_event.set()
+
+    def _close_journals(self) -> None:
+        """
+        Close the journals currently being appended to so that they can be written.
+        """
+        with self._lock:
+            for collection, journal in self._journals.items():
+                journal.close()
+
+                closed_name = self._journal_name(collection, self._owner, uuid.uuid4().hex + '.flushing')
+                os.rename(journal.name, closed_name)
+                self._closed_depth[closed_name] = self._journal_depth[collection]
+
+            self._journals = {}
+            self._journal_depth = {}
+
+    def _claim_journals(self) -> typing.List[typing.Tuple[str, str]]:
+        """
+        Find all closed journals belonging to this process and claim journals belonging to exited processes.
+
+        :return: List of (collection, journal filename) pairs
+        """
+        try:
+            filenames = os.listdir(settings.WRITE_BUFFER_DIR)
+
+        except FileNotFoundError:
+            return []
+
+        claimed = []
+        for filename in filenames:
+            parts = filename.split('.')
+            if len(parts) < 3 or parts[-1] not in {'journal', 'flushing'}:
+                continue
+
+            collection = unquote(parts[0])
+            path = os.path.join(settings.WRITE_BUFFER_DIR, filename)
+
+            owner = parts[1]
+            if owner == self._owner:
+                if parts[-1] == 'flushing':
+                    claimed.append((collection, path))
+                continue
+
+            try:
+                owner_exists = _process_owner_exists(owner)
+            except ValueError:
+                continue
+
+            if not owner_exists:
+                claimed_name = self._journal_name(collection, self._owner, uuid.uuid4().hex + '.flushing')
+                try:
+                    # Rename is atomic - if two processes try to claim the same journal only one will succeed
+                    os.rename(path, claimed_name)
+
+                except FileNotFoundError:
+                    continue
+
+                claimed.append((collection, claimed_name))
+
+        return claimed
+
+    def _write_journal(self, collection: str, path: str) -> None:
+        """
+        Write all documents in a closed journal to MongoDB, then delete the journal.
+
+        Documents which MongoDB cannot store are moved to the rejected directory - see :meth:`_rejected_path`.
+
+        :param collection: Name of collection to which documents will be written
+        :param path: Path to journal file
+        """
+        documents = []
+        with open(path) as journal:
+            for line in journal:
+                try:
+                    documents.append(json_util.loads(line))
+
+                except ValueError:
+                    # Incomplete final line if the process died while appending - the row was never acknowledged
+                    logger.warning('Skipping invalid row in write buffer journal %s', path)
+
+        if documents:
+            try:
+                CsvRow._get_db()[collection].insert_many(documents, ordered=False)
+
+            except pymongo.errors.BulkWriteError as exc:
+                # Documents which were already written before a crash are rejected as duplicates
+                if any(error['code'] != 11000 for error in exc.details['writeErrors']):
+                    raise
+
+            except InvalidDocument:
+                # A single invalid document prevents the whole batch being sent - write the others one at a time
+                rejected = []
+                for document in documents:
+                    try:
+                        CsvRow._get_db()[collection].insert_one(document)
+
+                    except pymongo.errors.DuplicateKeyError:
+                        pass
+
+                    except InvalidDocument:
+                        rejected.append(document)
+
+                self._reject_documents(path, rejected)
+
+        os.remove(path)
+
+    def flush(self) -> None:
+        """
+        Write all buffered rows to MongoDB, including rows left behind by processes which have exited.
+
+        Journals which could not be written because MongoDB is unavailable are retained and retried on the next flush.
+        Journals which fail for any other reason are moved to the rejected directory so that they are not retried.
+        """
+        if self._pid != os.getpid():
+            self._reset()
+
+        with self._flush_lock:
+            self._close_journals()
+
+            for collection, path in self._claim_journals():
+                try:
+                    self._write_journal(collection, path)
+
+                except (pymongo.errors.PyMongoError, OSError):
+                    logger.exception('Failed to write buffered rows to collection %s', collection)
+                    continue
+
+                except Exception:
+                    logger.exception('Failed to write buffered rows to collection %s - journal rejected', collection)
+                    os.rename(path, self._rejected_path(path))
+
+                with self._lock:
+                    self._closed_depth.pop(path, None)
+
+
+#: Buffer for rows pushed to internal data sources with write buffering enabled
+write_buffer = WriteBuffer()
+
+metrics.register_gauge('write_buffer.depth', write_buffer.depth)
+
+atexit.register(write_buffer.flush)
+
+
 class CsvToMongoConnector(InternalDataConnector, DataSetConnector):
     """
     Data connector representing an internally hosted data source, backed by MongoDB.
@@ -112,7 +761,65 @@ class CsvToMongoConnector(InternalDataConnector, DataSetConnector):
     """
     id_field_alias = '__id'
 
+    #: Query parameters used to define an aggregation - all others are used as filters
+    aggregation_params = {'group_by', 'metric', 'bucket', 'bucket_field'}
+
+    #: Key holding the time bucket in aggregation results - reserved so that it cannot clash with a group_by field
+    bucket_key = '__bucket'
+
+    def _get_collection(self) -> pymongo.collection.Collection:
+        """
+        Get the MongoDB collection belonging to this data source.
+
+        Unlike :func:`context_managers.switch_collection` this does not modify :class:`CsvRow`,
+        so is safe to use from background threads.
+        """
+        return CsvRow._get_db()[self.location]
+
+    def _set_index_state(self, fields: typing.Iterable[str], status: IndexStatus,
+                         message: typing.Optional[str] = None) -> None:
+        CollectionIndexState.objects(collection=self.location).update_one(
+            set__fields=sorted(fields),
+            set__status=status.value,
+            set__message=message,
+            set__updated=timezone.now(),
+            upsert=True
+        )
+
+    def get_index_state(self) -> typing.Dict[str, typing.Any]:
+        """
+        Get the state of the indexes managed by PEDASI on this data source.
+
+        :return: Requested index fields and the status of the latest index build
+        """
+        try:
+            state = CollectionIndexState.objects.get(collection=self.location)
+
+        except CollectionIndexState.DoesNotExist:
+            return {
+                'fields': [],
+                'status': IndexStatus.READY.value,
+                'message': None,
+                'updated': None,
+            }
+
+        return {
+            'fields': state.fields,
+            'status': state.status,
+            'message': state.message,
+            'updated': state.updated,
+        }
+
     def clean_data(self, **kwargs):
+        """
+        Make sure that the indexes on this data source match the requested index fields.
+
+        Indexes are only changed if the requested fields differ from those previously requested,
+        and are built by :data:`index_builder` unless 'background' is False.
+
+        :param index_fields: Fields which should be indexed
+        :param background: Build indexes in the background?  Default True
+        """
         index_fields = kwargs.get('index_fields', None)
 
         if index_fields is None:
@@ -120,39 +827,128 @@ class CsvToMongoConnector(InternalDataConnector, DataSetConnector):
 
         if isinstance(index_fields, str):
             index_fields = [index_fields]
+        index_fields = set(index_fields)
 
-        with context_managers.switch_collection(CsvRow, self.location) as collection:
-            for index_field in index_fields:
-                collection.create_index(index_field, background=True)
+        state = self.get_index_state()
+        previous_fields = set(state['fields'])
+        if index_fields == previous_fields:
+            if state['status'] == IndexStatus.READY.value:
+                # Indexes are up to date
+                return
+
+            if (state['status'] == IndexStatus.BUILDING.value and
+                    timezone.now() - state['updated'].replace(tzinfo=datetime.timezone.utc) < INDEX_BUILD_TIMEOUT):
+                # Indexes are already being built
+                return
+
+        self._set_index_state(index_fields, IndexStatus.BUILDING)
+
+        if not kwargs.get('background', True):
+            _sync_indexes(self.location)
+
+        elif not index_builder.submit(self.location):
+            # Allow the next push to try again
+            self._set_index_state(index_fields, IndexStatus.FAILED, 'Index build queue is full')
 
     def clear_data(self):
         with context_managers.switch_collection(CsvRow, self.location) as collection:
             collection.objects.delete()
 
-    def post_data(self, data: typing.Union[typing.MutableMapping[str, str],
-                                           typing.List[typing.MutableMapping[str, str]]]):
-        def create_document(row: typing.MutableMapping[str, str]):
-            kwargs = {key: _type_convert(val) for key, val in row.items()}
+    def _create_document(self, row: typing.MutableMapping[str, str]) -> typing.Dict:
+        """
+        Convert a row of pushed data into a document to be stored in MongoDB.
+
+        :param row: Row of pushed data
+        :return: Document to be stored
+        :raises ValueError: Row contains a field name which cannot be stored
+        """
+        kwargs = {_check_field_name(key): _type_convert(val) for key, val in row.items()}
 
-            # Can't store field 'id' in document - rename it
-            if 'id' in kwargs:
-                kwargs[self.id_field_alias] = kwargs.pop('id')
+        # Can't store field 'id' in document - rename it
+        if 'id' in kwargs:
+            kwargs[self.id_field_alias] = kwargs.pop('id')
 
-            return kwargs
+        return kwargs
 
+    def post_data(self, data: typing.Union[typing.MutableMapping[str, str],
+                                           typing.List[typing.MutableMapping[str, str]]]):
         # Put data in collection belonging to this data source
         with context_managers.switch_collection(CsvRow, self.location) as collection:
             collection = collection._get_collection()
 
             try:
                 # Data is a dictionary - a single row
-                collection.insert_one(create_document(data))
+                collection.insert_one(self._create_document(data))
 
             except AttributeError:
                 # Data is a list of dictionaries - multiple rows
-                documents = (create_document(row) for row in data)
+                documents = (self._create_document(row) for row in data)
                 collection.insert_many(documents)
 
+    def buffer_data(self, data: typing.MutableMapping[str, str], durable: bool = False):
+        """
+        Add a single row to this data source via the write buffer.
+
+        The row is journalled locally and written to MongoDB as part of a later batch.
+
+        :param data: Row to add
+        :param durable: Must the row be flushed to disk before returning?
+        """
+        write_buffer.append(self.location, self._create_document(data), durable=durable)
+
+    def replace_data(self, data: typing.Iterable[typing.MutableMapping[str, str]], **kwargs):
+        """
+        Replace all data in this data source.
+
+        New data is loaded into a shadow collection and indexed, then renamed over the live collection
+        in a single operation which also drops the old collection.
+        Readers see the old data until the new data is fully loaded, and are never shown a partial load.
+
+        Rows added via the write buffer before this call are written to the old collection before the swap,
+        so they are replaced along with the rest of the old data.
+        Rows still buffered by other running processes are written when those processes next flush.
+
+        :param data: Data to replace existing data
+        :param index_fields: Fields to index in the new collection
+        """
+        index_fields = kwargs.get('index_fields', None) or []
+        if isinstance(index_fields, str):
+            index_fields = [index_fields]
+
+        shadow_location = '{0}__shadow_{1}'.format(self.location, uuid.uuid4().hex)
+
+        with context_managers.switch_collection(CsvRow, shadow_location) as collection:
+            collection = collection._get_collection()
+
+            try:
+                # Cannot insert an empty list but we still need a collection to rename
+                collection.database.create_collection(shadow_location)
+
+                # Insert as rows are read so that the whole upload is never held in memory
+                documents = []
+                for row in data:
+                    documents.append(self._create_document(row))
+                    if len(documents) >= REPLACE_BATCH_SIZE:
+                        collection.insert_many(documents)
+                        documents = []
+
+                if documents:
+                    collection.insert_many(documents)
+
+                # Index while nothing is reading the collection - no need for background build
+                for index_field in index_fields:
+                    collection.create_index(index_field)
+
+                # Buffered rows must not be written to the new collection after the swap
+                write_buffer.flush()
+
+                collection.rename(self.location, dropTarget=True)
+                self._set_index_state(index_fields, IndexStatus.READY)
+
+            except Exception:
+                collection.drop()
+                raise
+
     def get_response(self,
                      params: typing.Optional[typing.Mapping[str, str]] = None):
         # TODO accept parameters provided twice as an inclusive OR
@@ -161,10 +957,14 @@ class CsvToMongoConnector(InternalDataConnector, DataSetConnector):
         params = {key: _type_convert(val) for key, val in params.items()}
 
         with context_managers.switch_collection(CsvRow, self.location) as collection:
+            start = time.perf_counter()
+
             records = collection.objects.filter(**params).exclude('_id')
 
             data = list(records.as_pymongo())
 
+            self._sample_query(params, time.perf_counter() - start)
+
             # Couldn't store field 'id' in document - recover it
             for item in data:
                 try:
@@ -177,3 +977,140 @@ class CsvToMongoConnector(InternalDataConnector, DataSetConnector):
                 'status': 'success',
                 'data': data,
             })
+
+    def _build_aggregation_pipeline(self, params: typing.Mapping[str, str]) -> typing.List[typing.Mapping]:
+        """
+        Compile aggregation query parameters into a MongoDB aggregation pipeline.
+
+        Accepted parameters are:
+
+        group_by
+          Comma separated list of fields by which to group records
+        metric
+          Comma separated list of metrics to calculate - either 'count' or '<operator>:<field>'
+          where operator is one of sum, avg, min or max
+        bucket
+          Width of time bucket by which to group records - e.g. '1h', '15m' - returned as field '__bucket'
+        bucket_field
+          Field containing a numeric timestamp in seconds to use for time buckets - default 'time'
+
+        Any other parameters are used to filter records before aggregation.
+
+        :param params: Query parameters defining the aggregation
+        :return: MongoDB aggregation pipeline
+        :raises ValueError: Query parameters do not define a valid aggregation
+        """
+        filters = {}
+        for key, value in params.items():
+            if key not in self.aggregation_params:
+                if key == 'id':
+                    key = self.id_field_alias
+                filters[_check_field_name(key)] = _type_convert(value)
+
+        group_id = {}
+        for field in filter(None, params.get('group_by', '').split(',')):
+            if field == self.bucket_key:
+                raise ValueError('Cannot group by reserved field \'{0}\''.format(field))
+
+            group_id[_check_field_name(field)] = '$' + (self.id_field_alias if field == 'id' else field)
+
+        if 'bucket' in params:
+            width = _parse_bucket(params['bucket'])
+            bucket_field = '$' + _check_field_name(params.get('bucket_field', 'time'))
+            group_id[self.bucket_key] = {
+                '$subtract': [bucket_field, {'$mod': [bucket_field, width]}]
+            }
+
+        group = {'_id': group_id}
+        for metric in filter(None, params.get('metric', 'count').split(',')):
+            if metric == 'count':
+                group['count'] = {'$sum': 1}
+                continue
+
+            try:
+                operator, field = metric.split(':', 1)
+                _check_field_name(field)
+                group[operator + '_' + field] = {AGGREGATION_OPERATORS[operator]: '$' + field}
+
+            except (KeyError, ValueError) as exc:
+                raise ValueError('Invalid metric \'{0}\''.format(metric)) from exc
+
+        pipeline = [
+            {'$match': filters},
+            {'$group': group},
+        ]
+
+        if group_id:
+            pipeline.append({'$sort': OrderedDict(('_id.' + key, 1) for key in group_id)})
+
+        return pipeline
+
+    def _sample_query(self, params: typing.Mapping[str, typing.Any], query_time: float) -> None:
+        """
+        Queue a query to be recorded for use by the index advisor.
+
+        Only one in every INDEX_ADVISOR_SAMPLE_RATE queries is recorded.
+        The query plan is explained and the statistics updated by :data:`query_sampler`.
+
+        :param params: Query parameters used to filter records - after type conversion
+        :param query_time: Time taken by the query in seconds
+        """
+        sample_rate = settings.INDEX_ADVISOR_SAMPLE_RATE
+        if not sample_rate or random.randrange(sample_rate):
+            return
+
+        # Translate MongoEngine operators - e.g. 'temp__gt' - into the filter MongoDB received
+        query = transform.query(CsvRow, **params)
+        query_sampler.submit((self.location, query, query_time, timezone.now()))
+
+    def get_index_recommendations(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        """
+        Recommend fields which should be indexed based on observed query patterns.
+
+        See :func:`recommend_indexes`.
+
+        :return: Recommended fields with estimated speedup - most beneficial first
+        """
+        indexed_fields = {
+            index['key'][0][0] for index in self._get_collection().index_information().values()
+        }
+
+        return recommend_indexes(QueryShapeStats.objects(collection=self.location), indexed_fields)
+
+    def get_aggregate(self,
+                      params: typing.Optional[typing.Mapping[str, str]] = None):
+        """
+        Return the result of an aggregation calculated within MongoDB.
+
+        See :meth:`_build_aggregation_pipeline` for the accepted query parameters.
+
+        :param params: Query parameters defining the aggregation
+        :return: Aggregation result
+        :raises ValueError: Query parameters do not define a valid aggregation
+        """
+        if params is None:
+            params = {}
+
+        pipeline = self._build_aggregation_pipeline(params)
+
+        with context_managers.switch_collection(CsvRow, self.location) as collection:
+            collection = collection._get_collection()
+
+            try:
+                results = list(collection.aggregate(pipeline))
+
+            except pymongo.errors.OperationFailure as exc:
+                # Query parameters are valid but cannot be applied to the data - e.g. bucket field is not numeric
+                raise ValueError('Invalid aggregation - {0}'.format((exc.details or {}).get('errmsg', exc))) from exc
+
+            data = []
+            for result in results:
+                # Flatten the group key into the result record
+                row = result.pop('_id')
+                row.update(result)
+                data.append(row)
+
+        return JsonResponse({
+            'status': 'success',
+            'data': data,
+        })
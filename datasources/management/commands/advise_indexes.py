@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from datasources.models import DataSource, MetadataField
+
+
+class Command(BaseCommand):
+    help = 'Report index recommendations for internal data sources, optionally applying them where enabled'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--apply', action='store_true',
+                            help='Create recommended indexes on data sources which have automatic indexing enabled')
+
+    def handle(self, *args, **options):
+        indexed_field = MetadataField.objects.get(short_name='indexed_field')
+
+        for datasource in DataSource.objects.all():
+            recommendations = datasource.index_recommendations
+
+            for recommendation in recommendations:
+                self.stdout.write('Data source "{0}": index field "{1}" - estimated speedup {2:.0f}x'.format(
+                    datasource.pk, recommendation['field'], recommendation['estimated_speedup']
+                ))
+
+            if not (options['apply'] and datasource.auto_index and recommendations):
+                continue
+
+            for recommendation in recommendations:
+                datasource.metadata_items.get_or_create(field=indexed_field, value=recommendation['field'])
+
+            index_fields = datasource.metadata_items.filter(field=indexed_field).values_list('value', flat=True)
+            datasource._get_data_connector().clean_data(index_fields=list(index_fields), background=False)
+
+            self.stdout.write(self.style.SUCCESS(
+                'Successfully applied index recommendations for data source "%s"' % datasource.pk
+            ))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from datasources.models import DataSource, DataSourceFacet, FacetCount
+
+
+class Command(BaseCommand):
+    help = ('Rebuild the facets of all data sources and recount them - '
+            'required only if data sources have been changed without sending signals e.g. by a bulk update')
+
+    def handle(self, *args, **options):
+        for datasource in DataSource._base_manager.select_related('licence'):
+            DataSourceFacet.sync(datasource)
+
+        FacetCount.rebuild()
+
+        self.stdout.write(self.style.SUCCESS(
+            'Successfully rebuilt facets - %d facet values' % FacetCount.objects.filter(count__gt=0).count()
+        ))
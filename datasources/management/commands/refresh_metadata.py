@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+import requests.exceptions
+
+from datasources.models import DataSource, MetadataSnapshot
+
+
+class Command(BaseCommand):
+    help = 'Fetch metadata from data sources and update the search index for those whose metadata has changed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--datasource', type=int, action='append', dest='datasources',
+                            help='Primary key of data source to refresh - may be repeated.  Default is all')
+
+    def handle(self, *args, **options):
+        datasources = DataSource.objects.all()
+        if options['datasources']:
+            datasources = datasources.filter(pk__in=options['datasources'])
+
+        n_changed = 0
+        for datasource in datasources:
+            try:
+                snapshot, changed = MetadataSnapshot.refresh(datasource)
+
+            except requests.exceptions.RequestException as e:
+                self.stderr.write('Failed to fetch metadata for data source "%s": %s' % (datasource.pk, e))
+                continue
+
+            if changed:
+                n_changed += 1
+
+                if options['verbosity'] > 1:
+                    self.stdout.write('Metadata changed for data source "%s"' % datasource.pk)
+
+        self.stdout.write(self.style.SUCCESS('Successfully refreshed metadata - %d changed' % n_changed))
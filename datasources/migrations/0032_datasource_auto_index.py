@@ -0,0 +1,21 @@
+# Generated by Django 2.0.8 on 2019-03-04 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datasources', '0031_default_connector_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datasource',
+            name='auto_index',
+            field=models.BooleanField(default=False,
+                                      help_text='Should fields be indexed automatically when PEDASI observes that '
+                                                'queries against them would be faster with an index? '
+                                                'This only applies to data sources hosted within PEDASI.'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.0.8 on 2019-03-06 14:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datasources', '0032_datasource_auto_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datasource',
+            name='write_buffer',
+            field=models.IntegerField(choices=[(0, 'DISABLED'), (1, 'BUFFERED'), (2, 'DURABLE')], default=0,
+                                      help_text='Should single rows pushed to this data source be buffered and '
+                                                'written in batches?  This is useful for devices which push '
+                                                'frequent readings. BUFFERED may lose recently acknowledged rows '
+                                                'if the server loses power, DURABLE is slower but does not. '
+                                                'This only applies to data sources hosted within PEDASI.'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.0.8 on 2019-03-11 11:02
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datasources', '0033_datasource_write_buffer'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datasource',
+            name='prov_coalesce_window',
+            field=models.PositiveIntegerField(default=0,
+                                              help_text='Merge repeated accesses to this data source by the same '
+                                                        'user and application within this many seconds into a '
+                                                        'single record with a count.  '
+                                                        'Set to 0 to record each access separately.',
+                                              verbose_name='PROV coalesce window (seconds)'),
+        ),
+        migrations.AddField(
+            model_name='datasource',
+            name='prov_sample_rate',
+            field=models.PositiveIntegerField(default=1,
+                                              help_text='Record only one in this many accesses to this data '
+                                                        'source, chosen at random.  Usage statistics are scaled '
+                                                        'to match. Set to 1 to record every access.',
+                                              validators=[django.core.validators.MinValueValidator(1)]),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 2.0.8 on 2019-03-12 10:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datasources', '0034_datasource_prov_sampling'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MetadataSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('metadata', models.TextField(blank=True, null=True)),
+                ('content_hash', models.CharField(blank=True, max_length=64)),
+                ('fetched_at', models.DateTimeField()),
+                ('datasource', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE,
+                                                    related_name='metadata_snapshot',
+                                                    to='datasources.DataSource')),
+            ],
+        ),
+    ]
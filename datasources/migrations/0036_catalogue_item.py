@@ -0,0 +1,29 @@
+# Generated by Django 2.0.8 on 2019-03-13 14:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datasources', '0035_metadata_snapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogueItem',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('href', models.CharField(max_length=1023)),
+                ('metadata', models.TextField(blank=True, null=True)),
+                ('content_hash', models.CharField(blank=True, max_length=64)),
+                ('datasource', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE,
+                                                 related_name='catalogue_items',
+                                                 to='datasources.DataSource')),
+            ],
+            options={
+                'unique_together': {('datasource', 'href')},
+            },
+        ),
+    ]
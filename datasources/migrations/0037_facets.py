@@ -0,0 +1,69 @@
+# Generated by Django 2.0.8 on 2019-03-14 10:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_facets(apps, schema_editor):
+    """
+    Create facets and facet counts for existing data sources - as :meth:`DataSourceFacet.sync`.
+    """
+    DataSource = apps.get_model('datasources', 'DataSource')
+    DataSourceFacet = apps.get_model('datasources', 'DataSourceFacet')
+    FacetCount = apps.get_model('datasources', 'FacetCount')
+
+    facets = []
+    for datasource in DataSource.objects.filter(is_deleted=False).select_related('licence'):
+        facet_values = {('plugin_name', datasource.plugin_name)}
+
+        if datasource.licence is not None:
+            facet_values.add(('licence', '{0} {1}'.format(datasource.licence.name, datasource.licence.version)))
+
+        for short_name, value in datasource.metadata_items.values_list('field__short_name', 'value'):
+            if value:
+                facet_values.add(('metadata.' + short_name, value))
+
+        facets.extend(DataSourceFacet(datasource=datasource, facet=facet, value=value)
+                      for facet, value in facet_values)
+
+    DataSourceFacet.objects.bulk_create(facets)
+
+    counts = DataSourceFacet.objects.values('facet', 'value').annotate(count=models.Count('pk'))
+    FacetCount.objects.bulk_create(FacetCount(**count) for count in counts)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datasources', '0036_catalogue_item'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FacetCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('facet', models.CharField(max_length=72)),
+                ('value', models.CharField(max_length=511)),
+                ('count', models.IntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('facet', 'value')},
+            },
+        ),
+        migrations.CreateModel(
+            name='DataSourceFacet',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('facet', models.CharField(max_length=72)),
+                ('value', models.CharField(max_length=511)),
+                ('datasource', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE,
+                                                 related_name='facets',
+                                                 to='datasources.DataSource')),
+            ],
+            options={
+                'unique_together': {('facet', 'value', 'datasource')},
+            },
+        ),
+        migrations.RunPython(create_facets, migrations.RunPython.noop),
+    ]
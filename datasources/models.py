@@ -4,21 +4,28 @@ This module contains the Django models necessary to manage the set of data sourc
 
 import contextlib
 import enum
+import hashlib
 import json
 import typing
+import urllib.parse
 
+from django.apps import apps
 from django.conf import settings
 from django.core import validators
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.urls import reverse
+from django.utils import timezone
 
 from core.models import BaseAppDataModel, MAX_LENGTH_API_KEY, MAX_LENGTH_NAME, MAX_LENGTH_PATH, SoftDeletionManager
-from datasources.connectors.base import AuthMethod, BaseDataConnector, REQUEST_AUTH_FUNCTIONS
+from datasources.connectors.base import AuthMethod, BaseDataConnector, REQUEST_AUTH_FUNCTIONS, WriteBufferMode
 from provenance.models import ProvAbleModel
 
 #: Length of request reason field - must include brief description of project
 MAX_LENGTH_REASON = 511
 
+#: Length of catalogue item identifier field - usually a URL
+MAX_LENGTH_HREF = 1023
+
 
 class Licence(models.Model):
     """
@@ -278,6 +285,49 @@ class DataSource(ProvAbleModel, BaseAppDataModel):
                                       ),
                                       blank=False, null=False)
 
+    #: Record only one in this many accesses in PROV - each record is weighted so that usage counts remain accurate
+    prov_sample_rate = models.PositiveIntegerField(default=1,
+                                                   validators=[validators.MinValueValidator(1)],
+                                                   help_text=(
+                                                       'Record only one in this many accesses to this data source, '
+                                                       'chosen at random.  Usage statistics are scaled to match. '
+                                                       'Set to 1 to record every access.'
+                                                   ),
+                                                   blank=False, null=False)
+
+    #: Merge repeated accesses by the same user and application within this many seconds into a single PROV record
+    prov_coalesce_window = models.PositiveIntegerField('PROV coalesce window (seconds)',
+                                                       default=0,
+                                                       help_text=(
+                                                           'Merge repeated accesses to this data source by the same '
+                                                           'user and application within this many seconds into a '
+                                                           'single record with a count.  Set to 0 to record each '
+                                                           'access separately.'
+                                                       ),
+                                                       blank=False, null=False)
+
+    #: Should fields recommended by the index advisor be indexed automatically - only for internal data sources
+    auto_index = models.BooleanField(default=False,
+                                     help_text=(
+                                         'Should fields be indexed automatically when PEDASI observes that '
+                                         'queries against them would be faster with an index? '
+                                         'This only applies to data sources hosted within PEDASI.'
+                                     ),
+                                     blank=False, null=False)
+
+    #: How single rows pushed to this data source are written
+    #: - defined in :class:`datasources.connectors.base.WriteBufferMode` enum
+    write_buffer = models.IntegerField(choices=WriteBufferMode.choices(),
+                                       default=WriteBufferMode.DISABLED.value,
+                                       help_text=(
+                                           'Should single rows pushed to this data source be buffered and written '
+                                           'in batches?  This is useful for devices which push frequent readings. '
+                                           'BUFFERED may lose recently acknowledged rows if the server loses power, '
+                                           'DURABLE is slower but does not. '
+                                           'This only applies to data sources hosted within PEDASI.'
+                                       ),
+                                       blank=False, null=False)
+
     #: Which licence is this data published under
     licence = models.ForeignKey(Licence,
                                 related_name='datasources',
@@ -300,6 +350,9 @@ class DataSource(ProvAbleModel, BaseAppDataModel):
         super().__init__(*args, **kwargs)
         self._data_connector = None
 
+    #: Request counters are usage statistics rather than changes to the data source
+    prov_exclude_fields = frozenset({'external_requests', 'external_requests_total'})
+
     def save(self, *args, **kwargs):
         # TODO avoid determining auth method if existing one still works
         self.auth_method = self.data_connector_class.determine_auth_method(self.url, self.api_key)
@@ -348,6 +401,31 @@ class DataSource(ProvAbleModel, BaseAppDataModel):
 
         return permission.granted >= level
 
+    @staticmethod
+    def permission_level_filter(user: settings.AUTH_USER_MODEL, level: UserPermissionLevels) -> models.Q:
+        """
+        Get a query filter selecting the data sources on which a user has a particular permission level.
+
+        Equivalent to :meth:`has_permission_level` but may be applied to many data sources in a single query.
+
+        :param user: User to check
+        :param level: Permission level to check for
+        :return: Query filter for use with DataSource querysets
+        """
+        if user.is_superuser:
+            return models.Q()
+
+        permitted = models.Q(public_permission_level__gte=level)
+
+        if user.is_authenticated:
+            permitted |= models.Q(owner=user)
+            permitted |= models.Q(pk__in=UserPermissionLink.objects.filter(
+                user=user,
+                granted__gte=level
+            ).values('datasource'))
+
+        return permitted
+
     def has_edit_permission(self, user: settings.AUTH_USER_MODEL) -> bool:
         """
         Does a given user have permission to edit this data source?
@@ -439,10 +517,30 @@ class DataSource(ProvAbleModel, BaseAppDataModel):
 
         finally:
             # Executed after the context manager is closed
-            self.external_requests += self._data_connector.request_count
-            self.external_requests_total += self._data_connector.request_count
+            if self._data_connector.request_count:
+                self.external_requests += self._data_connector.request_count
+                self.external_requests_total += self._data_connector.request_count
 
-            self.save()
+                self.save(update_fields=['external_requests', 'external_requests_total'])
+
+    @property
+    def index_recommendations(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        """
+        Fields which the index advisor recommends should be indexed - only for internal data sources.
+
+        :return: Recommended fields with estimated speedup - most beneficial first
+        """
+        try:
+            if not hasattr(self.data_connector_class, 'get_index_recommendations'):
+                # Connector is not an internal data source
+                return []
+
+        except (KeyError, ValueError):
+            # KeyError: Plugin was not found
+            # ValueError: Plugin was not set
+            return []
+
+        return self._get_data_connector().get_index_recommendations()
 
     @property
     def search_representation(self) -> str:
@@ -457,30 +555,379 @@ class DataSource(ProvAbleModel, BaseAppDataModel):
             self.description,
         ]
 
+        # Metadata is read from a stored snapshot rather than fetched from the data source on each indexing
+        # Without a snapshot index local fields only - metadata is indexed once refresh_metadata creates one
+        try:
+            snapshot = self.metadata_snapshot
+
+        except MetadataSnapshot.DoesNotExist:
+            snapshot = None
+
+        if snapshot is not None and snapshot.metadata is not None:
+            lines.append(snapshot.metadata)
+
+        result = '\n'.join(lines)
+        return result
+
+    def get_absolute_url(self):
+        return reverse('datasources:datasource.detail',
+                       kwargs={'pk': self.pk})
+
+
+class MetadataSnapshot(models.Model):
+    """
+    Copy of the metadata provided by a data source, used when indexing the data source for search.
+
+    Snapshots are updated by the `refresh_metadata` management command, which also updates the
+    :class:`CatalogueItem`\ s of data catalogues.
+    The search index is only updated for a data source when its metadata has changed.
+    """
+    #: Data source which provided the metadata
+    datasource = models.OneToOneField(DataSource,
+                                      related_name='metadata_snapshot',
+                                      on_delete=models.CASCADE,
+                                      blank=False, null=False)
+
+    #: Metadata serialized as JSON - null if the data source does not provide metadata
+    metadata = models.TextField(blank=True, null=True)
+
+    #: SHA-256 hash of the serialized metadata
+    content_hash = models.CharField(max_length=64,
+                                    blank=True, null=False)
+
+    #: Time at which the metadata was fetched from the data source
+    fetched_at = models.DateTimeField(blank=False, null=False)
+
+    def __str__(self):
+        return '{0} metadata at {1}'.format(self.datasource, self.fetched_at)
+
+    @classmethod
+    def refresh(cls, datasource: DataSource, update_index: bool = True) -> typing.Tuple['MetadataSnapshot', bool]:
+        """
+        Fetch metadata from a data source and store it if it has changed.
+
+        :param datasource: Data source from which to fetch metadata
+        :param update_index: Mark the data source to be updated in the search index if its metadata has changed?
+        :return: Snapshot and whether the metadata has changed
+        :raises requests.exceptions.RequestException: Metadata could not be fetched from the data source
+        """
         try:
-            # Using the data_connector context manager results in an infinite recursion:
-            #   1. Save data source
-            #   2. Get search representation (this function)
-            #   3. Close data connector context manager
-            #   4. Save data source -> ...
+            # Using the data_connector context manager here would save the data source
+            data_connector = datasource._get_data_connector()
+
+            with contextlib.ExitStack() as stack:
+                if data_connector.is_catalogue:
+                    # Fetch the catalogue once for both its metadata and its items
+                    stack.enter_context(data_connector)
+                    CatalogueItem.refresh(datasource, data_connector.items())
 
-            data_connector = self._get_data_connector()
-            metadata = data_connector.get_metadata()
+                metadata = data_connector.get_metadata()
 
-            lines.append(json.dumps(
-                metadata,
-                indent=4
-            ))
+            serialized = json.dumps(metadata, indent=4, sort_keys=True)
 
         except (KeyError, NotImplementedError, ValueError):
             # KeyError: Plugin was not found
             # NotImplementedError: Plugin does not support metadata
             # ValueError: Plugin was not set
-            pass
+            serialized = None
 
-        result = '\n'.join(lines)
-        return result
+        content_hash = '' if serialized is None else hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+        snapshot, created = cls.objects.get_or_create(datasource=datasource, defaults={
+            'metadata': serialized,
+            'content_hash': content_hash,
+            'fetched_at': timezone.now(),
+        })
+
+        changed = created or snapshot.content_hash != content_hash
+        if not created:
+            snapshot.metadata = serialized
+            snapshot.content_hash = content_hash
+            snapshot.fetched_at = timezone.now()
+            snapshot.save()
+
+        if changed and update_index:
+            # Data source is not saved, so the search index must be told that it has changed
+            apps.get_app_config('haystack').signal_processor.handle_save(DataSource, datasource)
+
+        return snapshot, changed
+
+
+class CatalogueItem(models.Model):
+    """
+    A single dataset within a data catalogue, stored so that datasets can be searched without querying the catalogue.
+
+    Items are updated from the catalogue by :meth:`MetadataSnapshot.refresh`.
+    """
+    #: Data catalogue containing the dataset
+    datasource = models.ForeignKey(DataSource,
+                                   related_name='catalogue_items',
+                                   on_delete=models.CASCADE,
+                                   blank=False, null=False)
+
+    #: Identifier of the dataset within the catalogue
+    href = models.CharField(max_length=MAX_LENGTH_HREF,
+                            blank=False, null=False)
+
+    #: Dataset metadata serialized as JSON - null if the catalogue does not provide metadata for the dataset
+    metadata = models.TextField(blank=True, null=True)
+
+    #: SHA-256 hash of the serialized metadata
+    content_hash = models.CharField(max_length=64,
+                                    blank=True, null=False)
+
+    class Meta:
+        unique_together = (('datasource', 'href'),)
+
+    def __str__(self):
+        return self.href
+
+    @property
+    def name(self) -> str:
+        """
+        Name to be shown in search results.
+        """
+        return self.href
+
+    @classmethod
+    def refresh(cls, datasource: DataSource,
+                items: typing.Iterable[typing.Tuple[str, BaseDataConnector]]) -> typing.Tuple[int, int, int]:
+        """
+        Update the stored items of a data catalogue, changing only those which have been added, modified or removed.
+
+        Items are saved individually so that the search index is updated for each of them.
+
+        :param datasource: Data catalogue containing the items
+        :param items: Pairs of dataset identifier and dataset connector - as from a catalogue connector
+        :return: Numbers of items created, updated and deleted
+        """
+        existing = {
+            href: (pk, content_hash)
+            for pk, href, content_hash in cls.objects.filter(datasource=datasource).values_list(
+                'pk', 'href', 'content_hash'
+            )
+        }
+
+        n_created = n_updated = 0
+        with transaction.atomic():
+            for href, dataset in items:
+                try:
+                    serialized = json.dumps(dataset.get_metadata(), sort_keys=True)
+
+                except NotImplementedError:
+                    serialized = None
+
+                content_hash = '' if serialized is None else hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+                item = cls(datasource=datasource, href=href, metadata=serialized, content_hash=content_hash)
+
+                if href not in existing:
+                    item.save()
+                    n_created += 1
+
+                else:
+                    pk, existing_hash = existing.pop(href)
+                    if existing_hash != content_hash:
+                        item.pk = pk
+                        item.save()
+                        n_updated += 1
+
+            # Items which are no longer in the catalogue
+            removed = [pk for pk, content_hash in existing.values()]
+            if removed:
+                cls.objects.filter(pk__in=removed).delete()
+
+        return n_created, n_updated, len(removed)
+
+    @property
+    def search_representation(self) -> str:
+        """
+        Provide a text representation of this dataset to be entered into a search index.
+
+        :return: Text representation of this dataset
+        """
+        lines = [self.href]
+
+        metadata = None if self.metadata is None else json.loads(self.metadata)
+
+        if isinstance(metadata, list):
+            # HyperCat item metadata is a list of relation / value pairs
+            for pair in metadata:
+                try:
+                    lines.append('{0} {1}'.format(pair['rel'], pair['val']))
+
+                except (KeyError, TypeError):
+                    lines.append(json.dumps(pair))
+
+        elif isinstance(metadata, dict):
+            for key, value in metadata.items():
+                lines.append('{0} {1}'.format(key, value))
+
+        elif metadata is not None:
+            lines.append(json.dumps(metadata))
+
+        return '\n'.join(lines)
 
     def get_absolute_url(self):
-        return reverse('datasources:datasource.detail',
-                       kwargs={'pk': self.pk})
+        return reverse('datasources:datasource.dataset.search',
+                       kwargs={'pk': self.datasource_id}) + '?' + urllib.parse.urlencode({'q': self.href})
+
+
+class DataSourceFacet(models.Model):
+    """
+    A value of a facet by which data sources can be filtered - their licence, connector plugin or metadata values.
+
+    Facets are updated when a data source, its metadata, its licence or a metadata field is saved -
+    see :mod:`datasources.signals`.  Soft deleted data sources have no facets.
+    Number of data sources with each facet value is kept in :class:`FacetCount`.
+    """
+    #: Facet holding the licence of a data source
+    LICENCE = 'licence'
+
+    #: Facet holding the connector plugin of a data source
+    PLUGIN_NAME = 'plugin_name'
+
+    #: Prefix of facets holding metadata values - followed by the short name of the metadata field
+    METADATA_PREFIX = 'metadata.'
+
+    #: Data source which has this facet value
+    datasource = models.ForeignKey(DataSource,
+                                   related_name='facets',
+                                   on_delete=models.CASCADE,
+                                   blank=False, null=False)
+
+    #: Name of the facet - e.g. 'licence' or 'metadata.topic'
+    facet = models.CharField(max_length=MAX_LENGTH_NAME + len(METADATA_PREFIX),
+                             blank=False, null=False)
+
+    #: Value of the facet for this data source
+    value = models.CharField(max_length=MAX_LENGTH_REASON,
+                             blank=False, null=False)
+
+    class Meta:
+        # Also indexes lookup of data sources by facet value
+        unique_together = (('facet', 'value', 'datasource'),)
+
+    def __str__(self):
+        return '{0}={1}'.format(self.facet, self.value)
+
+    @classmethod
+    def get_label(cls, facet: str) -> str:
+        """
+        Get the name of a facet to be shown to users.
+        """
+        if facet.startswith(cls.METADATA_PREFIX):
+            return facet[len(cls.METADATA_PREFIX):].replace('_', ' ').capitalize()
+
+        return {
+            cls.LICENCE: 'Licence',
+            cls.PLUGIN_NAME: 'Connector',
+        }.get(facet, facet)
+
+    @classmethod
+    def get_facet_values(cls, datasource: DataSource) -> typing.Set[typing.Tuple[str, str]]:
+        """
+        Get the facet values which a data source should have.
+
+        :return: Set of facet name and value pairs
+        """
+        if datasource.is_deleted:
+            return set()
+
+        facet_values = {(cls.PLUGIN_NAME, datasource.plugin_name)}
+
+        if datasource.licence is not None:
+            facet_values.add((cls.LICENCE, '{0} {1}'.format(datasource.licence.name, datasource.licence.version)))
+
+        for short_name, value in datasource.metadata_items.values_list('field__short_name', 'value'):
+            if value:
+                facet_values.add((cls.METADATA_PREFIX + short_name, value))
+
+        return facet_values
+
+    @classmethod
+    def sync(cls, datasource: DataSource) -> None:
+        """
+        Update the facet values of a data source, changing only those which have been added or removed.
+        """
+        facet_values = cls.get_facet_values(datasource)
+        existing = {
+            (facet, value): pk
+            for pk, facet, value in cls.objects.filter(datasource=datasource).values_list('pk', 'facet', 'value')
+        }
+
+        with transaction.atomic():
+            for facet, value in facet_values - existing.keys():
+                cls.objects.create(datasource=datasource, facet=facet, value=value)
+
+            removed = [pk for facet_value, pk in existing.items() if facet_value not in facet_values]
+            if removed:
+                # Deleted individually so that counts are updated
+                cls.objects.filter(pk__in=removed).delete()
+
+    @classmethod
+    def filter_datasources(cls, facet_values: typing.Iterable[typing.Tuple[str, str]]) -> models.QuerySet:
+        """
+        Get the primary keys of data sources which have all of a set of facet values.
+
+        :param facet_values: Facet name and value pairs
+        :return: Queryset of data source primary keys - for use as a subquery
+        """
+        facet_values = set(facet_values)
+
+        query = models.Q()
+        for facet, value in facet_values:
+            query |= models.Q(facet=facet, value=value)
+
+        return cls.objects.filter(query).values('datasource').annotate(
+            n_matched=models.Count('pk')
+        ).filter(n_matched=len(facet_values)).values('datasource')
+
+
+class FacetCount(models.Model):
+    """
+    Number of data sources which have a facet value - kept up to date as :class:`DataSourceFacet`\ s are changed.
+    """
+    #: Name of the facet - e.g. 'licence' or 'metadata.topic'
+    facet = models.CharField(max_length=MAX_LENGTH_NAME + len(DataSourceFacet.METADATA_PREFIX),
+                             blank=False, null=False)
+
+    #: Value of the facet
+    value = models.CharField(max_length=MAX_LENGTH_REASON,
+                             blank=False, null=False)
+
+    #: Number of data sources with this facet value
+    count = models.IntegerField(default=0,
+                                blank=False, null=False)
+
+    class Meta:
+        unique_together = (('facet', 'value'),)
+
+    def __str__(self):
+        return '{0}={1}: {2}'.format(self.facet, self.value, self.count)
+
+    @classmethod
+    def increment(cls, facet: str, value: str, amount: int = 1) -> None:
+        """
+        Add to the number of data sources which have a facet value - decrement if amount is negative.
+        """
+        if cls.objects.filter(facet=facet, value=value).update(count=models.F('count') + amount):
+            return
+
+        try:
+            with transaction.atomic():
+                cls.objects.create(facet=facet, value=value, count=amount)
+
+        except IntegrityError:
+            # Created concurrently
+            cls.objects.filter(facet=facet, value=value).update(count=models.F('count') + amount)
+
+    @classmethod
+    def rebuild(cls) -> None:
+        """
+        Recount data sources for all facet values.
+        """
+        counts = DataSourceFacet.objects.values('facet', 'value').annotate(count=models.Count('pk'))
+
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create(cls(**count) for count in counts)
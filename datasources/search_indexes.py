@@ -19,5 +19,36 @@ class DataSourceIndex(indexes.SearchIndex, indexes.Indexable):
     """
     text = indexes.CharField(document=True, use_template=True)
 
+    #: Fields of a data source which are included in the index or determine whether it is indexed
+    indexed_fields = {'name', 'owner', 'description', 'is_deleted'}
+
     def get_model(self):
         return models.DataSource
+
+    def index_queryset(self, using=None):
+        return self.get_model().objects.select_related('owner', 'metadata_snapshot')
+
+    def should_update(self, instance, **kwargs):
+        # e.g. request counters are saved on each access to an external data source
+        update_fields = kwargs.get('update_fields')
+        return update_fields is None or bool(self.indexed_fields.intersection(update_fields))
+
+
+class CatalogueItemIndex(indexes.SearchIndex, indexes.Indexable):
+    """
+    The search index definition for a single dataset within a data catalogue.
+
+    Uses templates/search/indexes/datasources/catalogueitem_text.txt and
+    :meth:`datasources.models.CatalogueItem.search_representation`.
+    """
+    text = indexes.CharField(document=True, use_template=True)
+
+    #: Data catalogue containing the dataset - to restrict results to a single catalogue
+    datasource = indexes.IntegerField(model_attr='datasource_id')
+
+    def get_model(self):
+        return models.CatalogueItem
+
+    def index_queryset(self, using=None):
+        # Exclude datasets of deleted data catalogues
+        return self.get_model().objects.filter(datasource__is_deleted=False)
@@ -0,0 +1,66 @@
+"""
+This module contains signal handlers which keep the facets of data sources up to date.
+
+See :class:`datasources.models.DataSourceFacet`.
+"""
+
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import models
+
+#: Fields of a data source which affect its facets
+FACET_FIELDS = {'licence', 'plugin_name', 'is_deleted'}
+
+
+@receiver(post_save, sender=models.DataSource)
+def datasource_saved(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or FACET_FIELDS.intersection(update_fields):
+        models.DataSourceFacet.sync(instance)
+
+
+@receiver(post_save, sender=models.MetadataItem)
+def metadata_item_saved(sender, instance, **kwargs):
+    models.DataSourceFacet.sync(instance.datasource)
+
+
+@receiver(post_delete, sender=models.MetadataItem)
+def metadata_item_deleted(sender, instance, **kwargs):
+    # May be deleted along with its data source - so the data source must not be saved or read
+    models.DataSourceFacet.objects.filter(
+        datasource_id=instance.datasource_id,
+        facet=models.DataSourceFacet.METADATA_PREFIX + instance.field.short_name,
+        value=instance.value
+    ).delete()
+
+
+@receiver(post_save, sender=models.Licence)
+def licence_saved(sender, instance, created=False, **kwargs):
+    if not created:
+        for datasource in instance.datasources.all():
+            models.DataSourceFacet.sync(datasource)
+
+
+@receiver(post_save, sender=models.MetadataField)
+def metadata_field_saved(sender, instance, created=False, **kwargs):
+    if not created:
+        # Only data sources whose facets do not match - i.e. the field's short name has changed
+        datasources = models.DataSource.objects.filter(
+            metadata_items__field=instance
+        ).exclude(
+            facets__facet=models.DataSourceFacet.METADATA_PREFIX + instance.short_name
+        ).distinct()
+
+        for datasource in datasources:
+            models.DataSourceFacet.sync(datasource)
+
+
+@receiver(post_save, sender=models.DataSourceFacet)
+def facet_saved(sender, instance, created=False, **kwargs):
+    if created:
+        models.FacetCount.increment(instance.facet, instance.value)
+
+
+@receiver(post_delete, sender=models.DataSourceFacet)
+def facet_deleted(sender, instance, **kwargs):
+    models.FacetCount.increment(instance.facet, instance.value, -1)
@@ -1,6 +1,7 @@
 from django.test import TestCase
 
 from datasources.connectors.base import AuthMethod, BaseDataConnector
+from datasources.connectors.csv import QueryShapeStats, recommend_indexes
 
 
 class ConnectorPluginTest(TestCase):
@@ -130,3 +131,67 @@ class ConnectorRestApiTest(TestCase):
 
         self.assertIn('data', result)
         self.assertGreater(len(result['data']), 0)
+
+
+class ConnectorCsvToMongoTest(TestCase):
+    def setUp(self):
+        BaseDataConnector.load_plugins('datasources/connectors')
+        self.plugin = BaseDataConnector.get_plugin('CsvToMongoConnector')
+
+    def test_aggregation_pipeline(self):
+        """
+        Test that aggregation query parameters are compiled into the expected pipeline.
+        """
+        connection = self.plugin('test_aggregation')
+
+        pipeline = connection._build_aggregation_pipeline({
+            'group_by': 'sensor',
+            'metric': 'count,avg:temp',
+            'bucket': '1h',
+            'site': '3',
+        })
+
+        self.assertEqual(pipeline[0], {'$match': {'site': 3}})
+        self.assertEqual(pipeline[1]['$group']['_id'], {
+            'sensor': '$sensor',
+            '__bucket': {'$subtract': ['$time', {'$mod': ['$time', 3600]}]},
+        })
+        self.assertEqual(pipeline[1]['$group']['count'], {'$sum': 1})
+        self.assertEqual(pipeline[1]['$group']['avg_temp'], {'$avg': '$temp'})
+
+    def test_aggregation_pipeline_invalid(self):
+        """
+        Test that invalid aggregation query parameters are rejected.
+        """
+        connection = self.plugin('test_aggregation')
+
+        with self.assertRaises(ValueError):
+            connection._build_aggregation_pipeline({'metric': 'median:temp'})
+
+        with self.assertRaises(ValueError):
+            connection._build_aggregation_pipeline({'bucket': '1y'})
+
+        with self.assertRaises(ValueError):
+            connection._build_aggregation_pipeline({'group_by': '__bucket', 'bucket': '1h'})
+
+    def test_index_recommendations(self):
+        """
+        Test that frequently queried, unselective fields are recommended for indexing.
+        """
+        stats = [
+            # Full collection scan for each query - should be indexed
+            QueryShapeStats(fields=['sensor'], queries=20, total_time=2,
+                            explained=20, total_examined=20000, total_returned=200),
+            # Already indexed
+            QueryShapeStats(fields=['site'], queries=20, total_time=2,
+                            explained=20, total_examined=20000, total_returned=200),
+            # Too few queries to be worth indexing
+            QueryShapeStats(fields=['rare'], queries=1, total_time=1,
+                            explained=1, total_examined=1000, total_returned=1),
+        ]
+
+        recommendations = recommend_indexes(stats, indexed_fields={'_id', 'site'})
+
+        self.assertEqual(len(recommendations), 1)
+        self.assertEqual(recommendations[0]['field'], 'sensor')
+        self.assertEqual(recommendations[0]['estimated_speedup'], 100)
@@ -1,5 +1,29 @@
-from django.test import TestCase
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from unittest import mock
 
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from haystack import connections
+from haystack.inputs import AutoQuery
+from haystack.query import SearchQuerySet
+
+from core.management.commands import rebuild_search_index
+from core.signals import REBUILD_LOG_SUFFIX
 from datasources import models
 
 
@@ -7,3 +31,640 @@ class DataSourceModelTest(TestCase):
     def test_string_representation(self):
         datasource = models.DataSource(name='Test Data Source')
         self.assertEqual(str(datasource), datasource.name)
+
+
+@override_settings(SEARCH_INDEX_FLUSH_INTERVAL=3600)
+class DataSourceSearchIndexTest(TestCase):
+    """
+    Test that data sources are indexed in batches by :class:`core.signals.QueuedSignalProcessor`.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('Test Search User')
+
+    def setUp(self):
+        self.processor = apps.get_app_config('haystack').signal_processor
+
+        # Transactions are never committed within a test case
+        patcher = mock.patch('core.signals.transaction.on_commit', lambda func: func())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # Do not leave instances to be indexed after the test database has been destroyed
+        self.addCleanup(self.processor.flush)
+
+    @staticmethod
+    def _search(text: str):
+        return list(SearchQuerySet().models(models.DataSource).filter(content=text))
+
+    @staticmethod
+    def _search_items(datasource: models.DataSource, text: str):
+        items = {str(item.pk): item.href for item in datasource.catalogue_items.all()}
+        results = SearchQuerySet().models(models.CatalogueItem).filter(content=text, datasource=datasource.pk)
+
+        # Index is not cleared between test runs so may contain items which no longer exist
+        return sorted(items[result.pk] for result in results if result.pk in items)
+
+    def test_queued_index_update(self):
+        """
+        Test that repeated updates are merged and applied when the queue is flushed.
+        """
+        datasource = models.DataSource.objects.create(
+            name='Xylophone Data Source',
+            owner=self.user,
+            url='test_search_index',
+            plugin_name='CsvToMongoConnector'
+        )
+
+        datasource.description = 'Test description'
+        datasource.save()
+
+        self.assertEqual(self.processor.depth(), 1)
+        self.assertGreaterEqual(self.processor.lag(), 0)
+        self.assertFalse(self._search('Xylophone'))
+
+        self.processor.flush()
+
+        self.assertEqual(self.processor.depth(), 0)
+        self.assertEqual(self.processor.lag(), 0)
+        self.assertEqual([result.pk for result in self._search('Xylophone')], [str(datasource.pk)])
+
+        # Saves of fields which are not indexed are ignored
+        datasource.save(update_fields=['external_requests', 'external_requests_total'])
+        self.assertEqual(self.processor.depth(), 0)
+
+        # Soft deleted data sources are removed from the index
+        datasource.delete()
+        self.processor.flush()
+
+        self.assertFalse(self._search('Xylophone'))
+
+    def test_index_update_retry(self):
+        """
+        Test that an instance which cannot be indexed is retried on its own after a delay without blocking others.
+        """
+        good = models.DataSource.objects.create(name='Tambourine Data Source', owner=self.user,
+                                                url='test_search_retry', plugin_name='CsvToMongoConnector')
+        bad = models.DataSource.objects.create(name='Broken Tambourine Data Source', owner=self.user,
+                                               url='test_search_retry', plugin_name='CsvToMongoConnector')
+
+        update_index = self.processor._update_index
+        attempted = []
+
+        def fail_bad(using, model, pks):
+            attempted.append(list(pks))
+            if bad.pk in pks:
+                raise ValueError('Cannot index')
+
+            update_index(using, model, pks)
+
+        with mock.patch.object(self.processor, '_update_index', side_effect=fail_bad):
+            self.processor.flush()
+            self.assertEqual([result.pk for result in self._search('Tambourine')], [str(good.pk)])
+            self.assertEqual(self.processor.depth(), 1)
+
+            # Not retried until the delay has passed
+            attempted.clear()
+            self.processor.flush()
+            self.assertEqual(attempted, [])
+            self.assertEqual(self.processor.depth(), 1)
+
+        # Retried as soon as the instance changes
+        bad.description = 'Fixed'
+        bad.save()
+        self.processor.flush()
+        self.assertEqual(self.processor.depth(), 0)
+        self.assertEqual(len(self._search('Tambourine')), 2)
+
+        good.delete()
+        bad.delete()
+
+    def test_metadata_snapshot(self):
+        """
+        Test that metadata is indexed from a snapshot which is only marked for indexing when it changes.
+        """
+        datasource = models.DataSource.objects.create(
+            name='Snapshot Data Source',
+            owner=self.user,
+            url='test_search_snapshot',
+            plugin_name='CsvToMongoConnector'
+        )
+        self.processor.flush()
+
+        connector_class = type(datasource._get_data_connector())
+        with mock.patch.object(connector_class, 'get_metadata', return_value={'marimba': 1}) as get_metadata:
+            snapshot, changed = models.MetadataSnapshot.refresh(datasource)
+            self.assertTrue(changed)
+            self.assertEqual(snapshot.content_hash, hashlib.sha256(snapshot.metadata.encode('utf-8')).hexdigest())
+            self.assertEqual(self.processor.depth(), 1)
+
+            self.processor.flush()
+            self.assertEqual(len(self._search('marimba')), 1)
+
+            # Unchanged metadata does not need to be indexed again
+            snapshot, changed = models.MetadataSnapshot.refresh(datasource)
+            self.assertFalse(changed)
+            self.assertEqual(self.processor.depth(), 0)
+
+            get_metadata.return_value = {'marimba': 2}
+            snapshot, changed = models.MetadataSnapshot.refresh(datasource)
+            self.assertTrue(changed)
+
+            self.processor.flush()
+            self.assertEqual(get_metadata.call_count, 3)
+
+        datasource = models.DataSource.objects.get(pk=datasource.pk)
+        self.assertIn('"marimba": 2', datasource.search_representation)
+
+        datasource.delete()
+        self.processor.flush()
+
+    def test_metadata_not_fetched(self):
+        """
+        Test that a data source without a metadata snapshot is indexed without fetching its metadata.
+        """
+        datasource = models.DataSource.objects.create(
+            name='Unreachable Ocarina Data Source',
+            owner=self.user,
+            url='test_search_unavailable',
+            plugin_name='CsvToMongoConnector'
+        )
+
+        connector_class = type(datasource._get_data_connector())
+        with mock.patch.object(connector_class, 'get_metadata') as get_metadata:
+            self.processor.flush()
+
+        get_metadata.assert_not_called()
+        self.assertFalse(models.MetadataSnapshot.objects.filter(datasource=datasource).exists())
+        self.assertEqual(self.processor.depth(), 0)
+        self.assertEqual(len(self._search('Ocarina')), 1)
+
+        datasource.delete()
+        self.processor.flush()
+
+    def test_rebuild_search_index(self):
+        """
+        Test that a rebuilt index is swapped in place of the current index.
+        """
+        datasource = models.DataSource.objects.create(
+            name='Glockenspiel Data Source',
+            owner=self.user,
+            url='test_search_rebuild',
+            plugin_name='CsvToMongoConnector'
+        )
+
+        search_connection = connections['default']
+        with tempfile.TemporaryDirectory() as index_dir:
+            path = os.path.join(index_dir, 'index')
+            os.makedirs(path)
+
+            with mock.patch.dict(search_connection.options, PATH=path):
+                call_command('rebuild_search_index', refresh=False, stdout=io.StringIO())
+                self.assertTrue(os.path.islink(path))
+
+                backend = type(search_connection.get_backend())('default', **search_connection.options)
+                results = backend.search('Glockenspiel')
+                self.assertEqual([result.pk for result in results['results']], [str(datasource.pk)])
+
+                # Original directory is kept as the previous index
+                self.assertEqual(len(os.listdir(index_dir)), 3)
+
+                time.sleep(1)
+                call_command('rebuild_search_index', refresh=False, keep=0, stdout=io.StringIO())
+                self.assertCountEqual(os.listdir(index_dir), ['index', os.path.basename(os.path.realpath(path))])
+
+    def test_rebuild_search_index_changes(self):
+        """
+        Test that objects which change while an index is being rebuilt are updated in the new index.
+        """
+        removed = models.DataSource.objects.create(name='Marimba Data Source', owner=self.user,
+                                                   url='test_search_rebuild', plugin_name='CsvToMongoConnector')
+
+        command = rebuild_search_index.Command
+        build_index = command._build_index
+        added = []
+
+        def build_and_change(instance, *args, **kwargs):
+            build_index(instance, *args, **kwargs)
+
+            added.append(models.DataSource.objects.create(name='Celesta Data Source', owner=self.user,
+                                                          url='test_search_rebuild',
+                                                          plugin_name='CsvToMongoConnector'))
+            removed.delete()
+
+        search_connection = connections['default']
+        with tempfile.TemporaryDirectory() as index_dir:
+            path = os.path.join(index_dir, 'index')
+
+            with mock.patch.dict(search_connection.options, PATH=path), \
+                    mock.patch.object(command, '_build_index', build_and_change):
+                call_command('rebuild_search_index', refresh=False, stdout=io.StringIO())
+
+                backend = type(search_connection.get_backend())('default', **search_connection.options)
+                results = backend.search('Celesta')
+                self.assertEqual([result.pk for result in results['results']], [str(added[0].pk)])
+                self.assertEqual(backend.search('Marimba')['hits'], 0)
+
+                # Change log only exists during a rebuild
+                self.assertNotIn('index' + REBUILD_LOG_SUFFIX, os.listdir(index_dir))
+
+                self.processor.flush()
+                added[0].delete()
+
+    def test_rebuild_search_index_swap(self):
+        """
+        Test that an index created at the index path by another process during the first swap is replaced.
+        """
+        search_connection = connections['default']
+        with tempfile.TemporaryDirectory() as index_dir:
+            path = os.path.join(index_dir, 'index')
+            os.makedirs(path)
+
+            rename = os.rename
+
+            def rename_and_setup(src, dst):
+                rename(src, dst)
+
+                # Another process sets up an index in place of the one which has been moved aside
+                if src == path:
+                    os.makedirs(path)
+                    open(os.path.join(path, '_MAIN_1.toc'), 'w').close()
+
+            with mock.patch.dict(search_connection.options, PATH=path), \
+                    mock.patch('os.rename', rename_and_setup):
+                call_command('rebuild_search_index', refresh=False, stdout=io.StringIO())
+
+            self.assertTrue(os.path.islink(path))
+            self.assertTrue(os.path.isdir(path + '.0'))
+
+    def test_catalogue_items(self):
+        """
+        Test that datasets within a catalogue are stored and indexed, updating only those which have changed.
+        """
+        datasource = models.DataSource.objects.create(
+            name='Catalogue Data Source',
+            owner=self.user,
+            url='https://api.example.com/cat',
+            plugin_name='HyperCat'
+        )
+
+        def get_catalogue(items):
+            return {
+                'catalogue-metadata': [],
+                'items': [
+                    {
+                        'href': href,
+                        'item-metadata': [{'rel': 'urn:X-hypercat:rels:hasDescription:en', 'val': description}],
+                    } for href, description in items
+                ],
+            }
+
+        response = mock.Mock()
+        response.json.return_value = get_catalogue([
+            ('https://api.example.com/cat/a', 'Vibraphone readings'),
+            ('https://api.example.com/cat/b', 'Other readings'),
+        ])
+
+        connector_class = type(datasource._get_data_connector())
+        with mock.patch.object(connector_class, '_get_auth_request', return_value=response) as get_request:
+            models.MetadataSnapshot.refresh(datasource)
+
+            # Catalogue is fetched once for its metadata and items
+            self.assertEqual(get_request.call_count, 1)
+            self.assertEqual(datasource.catalogue_items.count(), 2)
+
+            # Data source and both items
+            self.assertEqual(self.processor.depth(), 3)
+
+            self.processor.flush()
+            self.assertEqual(self._search_items(datasource, 'Vibraphone'), ['https://api.example.com/cat/a'])
+
+            response.json.return_value = get_catalogue([
+                ('https://api.example.com/cat/a', 'Vibraphone readings'),
+                ('https://api.example.com/cat/c', 'Vibraphone calibration'),
+            ])
+            models.MetadataSnapshot.refresh(datasource)
+
+            # Only the added and removed items - unchanged item and data source are not indexed again
+            self.assertEqual(self.processor.depth(), 2)
+            self.assertCountEqual(datasource.catalogue_items.values_list('href', flat=True),
+                                  ['https://api.example.com/cat/a', 'https://api.example.com/cat/c'])
+
+            self.processor.flush()
+            self.assertEqual(self._search_items(datasource, 'Vibraphone'),
+                             ['https://api.example.com/cat/a', 'https://api.example.com/cat/c'])
+
+        datasource.catalogue_items.all().delete()
+        datasource.delete()
+
+
+class SqliteSearchBackendTest(TestCase):
+    """
+    Test the search backend in :mod:`core.search_backends`.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('Test Sqlite Search User')
+
+    def setUp(self):
+        index_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(index_dir.cleanup)
+        self.path = os.path.join(index_dir.name, 'index.sqlite3')
+
+        patcher = mock.patch.dict(settings.HAYSTACK_CONNECTIONS, sqlite={
+            'ENGINE': 'core.search_backends.SqliteEngine',
+            'PATH': self.path,
+        })
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # Connections are cached per thread
+        self.addCleanup(lambda: connections.thread_local.connections.pop('sqlite', None))
+
+        self.backend = connections['sqlite'].get_backend()
+        self.index = connections['sqlite'].get_unified_index().get_index(models.CatalogueItem)
+
+        self.items = [
+            models.CatalogueItem(pk=pk, datasource_id=datasource_id, href='https://api.example.com/cat/' + description,
+                                 metadata=json.dumps({'description': description}))
+            for pk, datasource_id, description in [
+                (1, 1, 'Vibraphone readings'),
+                (2, 1, 'Vibraphone vibraphone calibration'),
+                (3, 2, 'Marimba readings'),
+            ]
+        ]
+        self.backend.update(self.index, self.items)
+
+    @staticmethod
+    def _search(**kwargs):
+        return [result.pk for result in SearchQuerySet(using='sqlite').filter(**kwargs)]
+
+    def test_search(self):
+        """
+        Test ranking, prefix queries, excluded terms and field filters.
+        """
+        self.assertEqual(self._search(content='vibraphone'), ['2', '1'])
+        self.assertEqual(self._search(content='vib*'), ['2', '1'])
+        self.assertEqual(self._search(content__startswith='calib'), ['2'])
+        self.assertEqual(self._search(content='readings', datasource=2), ['3'])
+        self.assertEqual(self._search(content=AutoQuery('readings -marimba')), ['1'])
+        self.assertCountEqual(self._search(content=AutoQuery('-calibration')), ['1', '3'])
+        self.assertEqual(self._search(content=AutoQuery('"marimba readings"')), ['3'])
+
+        # User input is not interpreted as query syntax
+        self.assertEqual(self._search(content='readings OR calibration'), [])
+
+        results = SearchQuerySet(using='sqlite').filter(content='calibration').highlight()
+        self.assertIn('<em>calibration</em>', results[0].highlighted['text'][0])
+
+        self.backend.remove(self.items[0])
+        self.assertEqual(self._search(content='vibraphone'), ['2'])
+
+        self.backend.clear(models=[models.CatalogueItem])
+        self.assertEqual(SearchQuerySet(using='sqlite').count(), 0)
+
+    def test_search_during_write(self):
+        """
+        Test that a search is not blocked by an uncommitted write from another connection.
+        """
+        writer = sqlite3.connect(self.path, isolation_level=None)
+        self.addCleanup(writer.close)
+
+        writer.execute('BEGIN IMMEDIATE')
+        writer.execute('DELETE FROM haystack_document_fts')
+
+        results = []
+        thread = threading.Thread(target=lambda: results.append(self._search(content='readings')))
+        thread.start()
+        thread.join(timeout=5)
+
+        writer.execute('ROLLBACK')
+        self.assertEqual(len(results), 1)
+        self.assertCountEqual(results[0], ['1', '3'])
+
+    def test_rebuild_search_index(self):
+        """
+        Test that searches use a rebuilt index once it has been swapped in place of the current index.
+        """
+        datasource = models.DataSource.objects.create(
+            name='Glockenspiel Data Source',
+            owner=self.user,
+            url='test_sqlite_search_rebuild',
+            plugin_name='CsvToMongoConnector'
+        )
+        self.assertEqual(self._search(content='glockenspiel'), [])
+
+        call_command('rebuild_search_index', using='sqlite', refresh=False, keep=0, stdout=io.StringIO())
+        self.assertTrue(os.path.islink(self.path))
+        self.assertEqual(self._search(content='glockenspiel'), [str(datasource.pk)])
+
+        # Datasets indexed before the rebuild are not in the database so are no longer indexed
+        self.assertEqual(self._search(content='vibraphone'), [])
+        # Previous index has been removed - along with its journal
+        current = os.path.basename(os.path.realpath(self.path))
+        self.assertEqual({name for name in os.listdir(os.path.dirname(self.path)) if not name.startswith(current)},
+                         {os.path.basename(self.path)})
+
+
+class DataSourceFacetTest(TestCase):
+    """
+    Test that facets and facet counts of data sources are kept up to date.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('Test Facet User')
+        cls.licence = models.Licence.objects.create(name='Test Licence', short_name='TL', version='1.0',
+                                                    owner=cls.user)
+        cls.field = models.MetadataField.objects.create(name='Test Facet Topic', short_name='test_facet_topic')
+
+    def _create_datasource(self, name: str, **kwargs) -> models.DataSource:
+        return models.DataSource.objects.create(
+            name=name,
+            owner=self.user,
+            url='test_facets',
+            plugin_name='CsvToMongoConnector',
+            **kwargs
+        )
+
+    @staticmethod
+    def _get_counts():
+        return {
+            (facet, value): count
+            for facet, value, count in models.FacetCount.objects.filter(
+                count__gt=0
+            ).values_list('facet', 'value', 'count')
+        }
+
+    def test_facet_counts(self):
+        datasource = self._create_datasource('Facet Data Source', licence=self.licence)
+        other = self._create_datasource('Other Facet Data Source')
+
+        item = models.MetadataItem.objects.create(datasource=datasource, field=self.field, value='traffic')
+        models.MetadataItem.objects.create(datasource=other, field=self.field, value='traffic')
+
+        self.assertEqual(self._get_counts(), {
+            ('licence', 'Test Licence 1.0'): 1,
+            ('plugin_name', 'CsvToMongoConnector'): 2,
+            ('metadata.test_facet_topic', 'traffic'): 2,
+        })
+
+        item.value = 'air quality'
+        item.save()
+        self.assertEqual(self._get_counts()[('metadata.test_facet_topic', 'traffic')], 1)
+        self.assertEqual(self._get_counts()[('metadata.test_facet_topic', 'air quality')], 1)
+
+        item.delete()
+        self.assertNotIn(('metadata.test_facet_topic', 'air quality'), self._get_counts())
+
+        licence = models.Licence.objects.get(pk=self.licence.pk)
+        licence.version = '2.0'
+        licence.save()
+        self.assertEqual(self._get_counts()[('licence', 'Test Licence 2.0')], 1)
+
+        # Soft deleted data sources are not counted
+        datasource.delete()
+        self.assertEqual(self._get_counts(), {
+            ('plugin_name', 'CsvToMongoConnector'): 1,
+            ('metadata.test_facet_topic', 'traffic'): 1,
+        })
+
+        models.DataSource._base_manager.filter(pk=other.pk).delete()
+        self.assertEqual(self._get_counts(), {})
+
+    def test_search_view(self):
+        """
+        Test that data sources are filtered by facet values, and that counts are read without joins.
+        """
+        datasource = self._create_datasource('Facet Data Source', licence=self.licence)
+        other = self._create_datasource('Other Facet Data Source')
+        models.MetadataItem.objects.create(datasource=datasource, field=self.field, value='traffic')
+        models.MetadataItem.objects.create(datasource=other, field=self.field, value='traffic')
+
+        url = reverse('datasources:datasource.search')
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([query for query in queries if 'datasources_metadataitem' in query['sql']])
+        self.assertIn(('Test facet topic', [{
+            'value': 'traffic',
+            'count': 2,
+            'selected': False,
+            'url': '?facet=metadata.test_facet_topic%3Atraffic',
+        }]), response.context['facets'])
+
+        response = self.client.get(url, {'facet': ['metadata.test_facet_topic:traffic', 'licence:Test Licence 1.0']})
+        self.assertEqual(list(response.context['datasources']), [datasource])
+        self.assertEqual(dict(response.context['facets'])['Connector'][0]['count'], 1)
+
+
+class AutocompleteTest(TestCase):
+    """
+    Test that the autocomplete index suggests data sources and metadata values and is kept up to date.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('autocomplete', first_name='Ada', last_name='Lovelace')
+        cls.field = models.MetadataField.objects.create(name='Test Autocomplete Topic',
+                                                        short_name='test_autocomplete_topic')
+
+    def setUp(self):
+        from core import autocomplete
+
+        # Changes are applied to the index once committed - but the test transaction is never committed
+        patcher = mock.patch('core.autocomplete.transaction.on_commit', lambda func: func())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # Patching on_commit also queues search index updates - do not leave them for other tests
+        self.addCleanup(apps.get_app_config('haystack').signal_processor.flush)
+
+        self.index = autocomplete.index
+        self.index.build()
+
+    def _lookup(self, query: str, user=None):
+        suggestions = self.index.lookup(query, user or self.user, limit=50)
+        return [(suggestion.kind, suggestion.label) for suggestion in suggestions]
+
+    def test_lookup(self):
+        datasource = models.DataSource.objects.create(name='Southampton Traffic Counts', owner=self.user,
+                                                      plugin_name='CsvToMongoConnector')
+        models.MetadataItem.objects.create(datasource=datasource, field=self.field, value='Road Traffic')
+
+        self.assertEqual(self._lookup('southampton traf')[0], ('datasource', 'Southampton Traffic Counts'))
+        self.assertIn(('metadata', 'Road Traffic'), self._lookup('traf'))
+
+        # Owners' names are not suggested
+        self.assertEqual(self._lookup('lovel'), [])
+        self.assertNotIn(('datasource', 'Southampton Traffic Counts'), self._lookup('traffic xyz'))
+
+        # Suggestions starting with the query are ranked first
+        self.assertEqual(self._lookup('road')[0], ('metadata', 'Road Traffic'))
+
+        datasource = models.DataSource.objects.get(pk=datasource.pk)
+        datasource.name = 'Southampton Cycle Counts'
+        datasource.save()
+        self.assertIn(('datasource', 'Southampton Cycle Counts'), self._lookup('cyc'))
+        self.assertNotIn(('datasource', 'Southampton Traffic Counts'), self._lookup('southampton'))
+
+        # Saves which do not change suggestions do not update the index
+        with mock.patch('core.autocomplete._update_datasource') as update:
+            datasource.save(update_fields=['external_requests', 'external_requests_total'])
+        update.assert_not_called()
+
+        # Soft deleted data sources are not suggested
+        datasource.delete()
+        self.assertEqual(self._lookup('southampton'), [])
+        self.assertEqual(self._lookup('road'), [])
+
+    def test_lookup_permissions(self):
+        owner = get_user_model().objects.create_user('autocomplete owner')
+        datasource = models.DataSource.objects.create(name='Private Autocomplete Source', owner=owner,
+                                                      plugin_name='CsvToMongoConnector',
+                                                      public_permission_level=models.UserPermissionLevels.NONE)
+        models.MetadataItem.objects.create(datasource=datasource, field=self.field, value='Secret Topic')
+
+        self.assertEqual(self._lookup('private'), [])
+        self.assertEqual(self._lookup('secret'), [])
+        self.assertEqual(self._lookup('private', AnonymousUser()), [])
+
+        self.assertEqual(self._lookup('private', owner), [('datasource', 'Private Autocomplete Source')])
+        self.assertEqual(self._lookup('secret', owner), [('metadata', 'Secret Topic')])
+
+        # Metadata values are suggested if any data source contributing them may be viewed
+        public = models.DataSource.objects.create(name='Public Autocomplete Source', owner=owner,
+                                                  plugin_name='CsvToMongoConnector')
+        models.MetadataItem.objects.create(datasource=public, field=self.field, value='Secret Topic')
+        self.assertEqual(self._lookup('secret'), [('metadata', 'Secret Topic')])
+
+    def test_lookup_not_built(self):
+        from core import autocomplete
+
+        index = autocomplete.AutocompleteIndex()
+        with mock.patch('core.autocomplete.threading.Thread') as thread:
+            self.assertEqual(index.lookup('autocompl', self.user), [])
+
+        # Built in the background rather than during the request
+        thread.assert_called_once()
+        self.assertIsNone(index.age())
+
+    def test_view(self):
+        datasource = models.DataSource.objects.create(name='Autocomplete Data Source', owner=self.user,
+                                                      plugin_name='CsvToMongoConnector')
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('autocomplete'), {'q': 'autocompl'})
+
+        self.assertEqual(response.status_code, 200)
+
+        # Permissions of all suggested data sources are checked in a single query
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(response.json()['data']['results'], [{
+            'kind': 'datasource',
+            'label': 'Autocomplete Data Source',
+            'url': datasource.get_absolute_url(),
+        }])
+
+        response = self.client.get(reverse('autocomplete'), {'q': 'autocompl', 'limit': 'x'})
+        self.assertEqual(response.status_code, 400)
@@ -13,6 +13,10 @@ urlpatterns = [
          views.datasource.DataSourceCreateView.as_view(),
          name='datasource.add'),
 
+    path('search',
+         views.datasource.DataSourceSearchView.as_view(),
+         name='datasource.search'),
+
     path('<int:pk>/',
          views.datasource.DataSourceDetailView.as_view(),
          name='datasource.detail'),
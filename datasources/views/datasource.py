@@ -1,5 +1,8 @@
+import urllib.parse
+
 from django.contrib import messages
 from django.contrib.auth.mixins import PermissionRequiredMixin
+from django.db.models import Count
 from django.http import HttpResponse
 from django.urls import reverse_lazy
 from django.views.generic.detail import DetailView
@@ -9,12 +12,16 @@ from django.views.generic.list import ListView
 from rest_framework.response import Response
 from rest_framework import serializers
 from rest_framework.views import APIView
+from haystack.query import SearchQuerySet
 import requests.exceptions
 
 from datasources import forms, models
 from datasources.permissions import HasPermissionLevelMixin
 from profiles.permissions import OwnerPermissionMixin
 
+#: Maximum number of data sources matching a text query in the faceted search
+SEARCH_MAX_RESULTS = 1000
+
 
 class DataSourceListView(ListView):
     model = models.DataSource
@@ -22,6 +29,105 @@ class DataSourceListView(ListView):
     context_object_name = 'datasources'
 
 
+class DataSourceSearchView(ListView):
+    """
+    Search data sources by text and filter them by facet values - licence, connector plugin and metadata values.
+
+    Facet values are selected by repeated 'facet' query parameters of the form 'name:value'.
+    Counts of data sources with each facet value are read from :class:`datasources.models.FacetCount`
+    when there is no filter, otherwise they are counted for the matching data sources.
+    """
+    model = models.DataSource
+    template_name = 'datasources/datasource/search.html'
+    context_object_name = 'datasources'
+    paginate_by = 20
+
+    def get_selected_facets(self):
+        selected = set()
+        for param in self.request.GET.getlist('facet'):
+            facet, separator, value = param.partition(':')
+            if separator:
+                selected.add((facet, value))
+
+        return selected
+
+    def get_queryset(self):
+        self.query = self.request.GET.get('q', '').strip()
+        self.selected_facets = self.get_selected_facets()
+
+        queryset = super().get_queryset().select_related('licence', 'owner')
+        if self.selected_facets:
+            queryset = queryset.filter(pk__in=models.DataSourceFacet.filter_datasources(self.selected_facets))
+
+        if not self.query:
+            return queryset.order_by('name')
+
+        # Keep the order given by the search index
+        results = SearchQuerySet().models(models.DataSource).auto_query(self.query)[:SEARCH_MAX_RESULTS]
+        ranks = {int(result.pk): rank for rank, result in enumerate(results)}
+
+        return sorted(queryset.filter(pk__in=ranks), key=lambda datasource: ranks[datasource.pk])
+
+    def _get_url(self, selected_facets):
+        params = [('q', self.query)] if self.query else []
+        params.extend(('facet', '{0}:{1}'.format(facet, value)) for facet, value in sorted(selected_facets))
+
+        return '?' + urllib.parse.urlencode(params)
+
+    def get_facet_counts(self):
+        """
+        Get the number of matching data sources with each facet value.
+
+        :return: List of facet name, value and count tuples
+        """
+        if not self.query and not self.selected_facets:
+            return models.FacetCount.objects.filter(count__gt=0).values_list('facet', 'value', 'count')
+
+        if isinstance(self.object_list, list):
+            datasources = [datasource.pk for datasource in self.object_list]
+        else:
+            datasources = self.object_list.values('pk')
+
+        return models.DataSourceFacet.objects.filter(
+            datasource__in=datasources
+        ).values('facet', 'value').annotate(count=Count('pk')).values_list('facet', 'value', 'count')
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+
+        # Facets of operational metadata fields are of no interest to users
+        hidden = {
+            models.DataSourceFacet.METADATA_PREFIX + short_name
+            for short_name in models.MetadataField.objects.filter(operational=True).values_list('short_name',
+                                                                                               flat=True)
+        }
+
+        facets = {}
+        for facet, value, count in self.get_facet_counts():
+            if facet in hidden:
+                continue
+
+            facets.setdefault(facet, []).append({
+                'value': value,
+                'count': count,
+                'selected': (facet, value) in self.selected_facets,
+                'url': self._get_url(self.selected_facets ^ {(facet, value)}),
+            })
+
+        # Licence and connector first, then metadata fields - values with most data sources first
+        order = [models.DataSourceFacet.LICENCE, models.DataSourceFacet.PLUGIN_NAME]
+        context['facets'] = [
+            (models.DataSourceFacet.get_label(facet),
+             sorted(facets[facet], key=lambda facet_value: (-facet_value['count'], facet_value['value'])))
+            for facet in sorted(facets, key=lambda facet: (order.index(facet) if facet in order else len(order), facet))
+        ]
+
+        context['query'] = self.query
+        context['selected_facets'] = sorted('{0}:{1}'.format(facet, value) for facet, value in self.selected_facets)
+        context['page_url'] = self._get_url(self.selected_facets)
+        return context
+
+
 class DataSourceDetailView(DetailView):
     model = models.DataSource
     template_name = 'datasources/datasource/detail.html'
@@ -38,6 +144,7 @@ class DataSourceDetailView(DetailView):
         context['has_edit_permission'] = self.request.user.is_superuser or self.request.user == self.object.owner
         if context['has_edit_permission']:
             context['metadata_field_form'] = forms.MetadataFieldForm()
+            context['index_recommendations'] = self.object.index_recommendations
 
         try:
             context['is_catalogue'] = self.object.is_catalogue
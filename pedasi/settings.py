@@ -38,6 +38,78 @@ PROV_DATABASE_NAME
   Name of MongoDB database in which to store PROV data.
   Default is 'prov'.
 
+PROV_ASYNC_WRITES
+  Write PROV records for API requests from a background queue rather than during the request?
+  Default is 'true'.
+
+PROV_QUEUE_SIZE
+  Maximum number of PROV records waiting to be written.  Records are dropped when the queue is full.
+  Default is 10000.
+
+PROV_BATCH_SIZE
+  Maximum number of queued PROV records written to MongoDB at once.
+  Default is 100.
+
+PROV_FLUSH_INTERVAL
+  Maximum time in seconds for which a PROV record waits in the queue before being written.
+  Default is 1.
+
+PROV_RETENTION_DAYS
+  Number of days for which PROV records are kept in the database before being archived to files.
+  Usage counts are kept indefinitely.  Set to 0 to keep all PROV records in the database.
+  Default is 0.
+
+PROV_ARCHIVE_DIR
+  Directory in which to write archived PROV records.
+  Default is 'prov_archive' in project root directory.
+
+PROV_ARCHIVE_BATCH_SIZE
+  Number of PROV records to archive and delete at once.
+  Default is 1000.
+
+PROV_ARCHIVE_DELAY
+  Time in seconds to wait between batches when archiving PROV records, to limit load on the database.
+  Default is 0.1.
+
+INDEX_ADVISOR_SAMPLE_RATE
+  Record statistics for one in every this many queries against internal data sources.
+  These are used to recommend which fields should be indexed.  Set to 0 to disable.
+  Default is 1000.
+
+WRITE_BUFFER_DIR
+  Directory in which rows pushed to buffered internal data sources are journalled before being written to MongoDB.
+  Default is 'write_buffer' in project root directory.
+
+WRITE_BUFFER_BATCH_SIZE
+  Number of buffered rows for a single data source which triggers a write to MongoDB.
+  Default is 500.
+
+WRITE_BUFFER_FLUSH_INTERVAL
+  Maximum time in seconds for which rows remain buffered before being written to MongoDB.
+  Default is 1.
+
+SEARCH_INDEX_FLUSH_INTERVAL
+  Time in seconds between updates of the search index with data sources and applications which have been modified.
+  Default is 5.
+
+SEARCH_ENGINE
+  Search index backend - 'whoosh' or 'sqlite'.
+  The SQLite backend allows searches during index updates and does not block other processes for the duration
+  of an update, so is better suited to running multiple server processes.
+  Default is 'whoosh'.
+
+SEARCH_INDEX_PATH
+  Location of the search index - a directory for Whoosh or a database file for SQLite.
+  Default is 'whoosh_index' or 'search_index.sqlite3' in project root directory.
+
+SEARCH_CACHE_TIMEOUT
+  Time in seconds for which results of the search API are cached - each server process has its own cache.
+  Default is 30.
+
+AUTOCOMPLETE_REFRESH_INTERVAL
+  Time in seconds after which the search autocomplete index is rebuilt to include changes made by other processes.
+  Default is 300.
+
 """
 
 
@@ -154,17 +226,52 @@ mongoengine.register_connection(
     alias='internal_data',
 )
 
+# Write PROV records for API requests in batches from a background thread
+PROV_ASYNC_WRITES = config('PROV_ASYNC_WRITES', cast=bool, default=True)
+PROV_QUEUE_SIZE = config('PROV_QUEUE_SIZE', cast=int, default=10000)
+PROV_BATCH_SIZE = config('PROV_BATCH_SIZE', cast=int, default=100)
+PROV_FLUSH_INTERVAL = config('PROV_FLUSH_INTERVAL', cast=float, default=1.0)
+
+# Archive old PROV records to compressed files
+PROV_RETENTION_DAYS = config('PROV_RETENTION_DAYS', cast=int, default=0)
+PROV_ARCHIVE_DIR = config('PROV_ARCHIVE_DIR', default=os.path.join(BASE_DIR, 'prov_archive'))
+PROV_ARCHIVE_BATCH_SIZE = config('PROV_ARCHIVE_BATCH_SIZE', cast=int, default=1000)
+PROV_ARCHIVE_DELAY = config('PROV_ARCHIVE_DELAY', cast=float, default=0.1)
+
+# Sample queries against internal data sources to recommend indexes
+INDEX_ADVISOR_SAMPLE_RATE = config('INDEX_ADVISOR_SAMPLE_RATE', cast=int, default=1000)
+
+# Buffer single row pushes to internal data sources and write them to MongoDB in batches
+WRITE_BUFFER_DIR = config('WRITE_BUFFER_DIR', default=os.path.join(BASE_DIR, 'write_buffer'))
+WRITE_BUFFER_BATCH_SIZE = config('WRITE_BUFFER_BATCH_SIZE', cast=int, default=500)
+WRITE_BUFFER_FLUSH_INTERVAL = config('WRITE_BUFFER_FLUSH_INTERVAL', cast=float, default=1.0)
+
+
 
 # Search backend
 
+SEARCH_ENGINE = config('SEARCH_ENGINE', default='whoosh')
+
 HAYSTACK_CONNECTIONS = {
     'default': {
-        'ENGINE': 'haystack.backends.whoosh_backend.WhooshEngine',
-        'PATH': os.path.join(BASE_DIR, 'whoosh_index'),
-    }
+        'whoosh': {
+            'ENGINE': 'haystack.backends.whoosh_backend.WhooshEngine',
+            'PATH': config('SEARCH_INDEX_PATH', default=os.path.join(BASE_DIR, 'whoosh_index')),
+        },
+        'sqlite': {
+            'ENGINE': 'core.search_backends.SqliteEngine',
+            'PATH': config('SEARCH_INDEX_PATH', default=os.path.join(BASE_DIR, 'search_index.sqlite3')),
+        },
+    }[SEARCH_ENGINE]
 }
 
-HAYSTACK_SIGNAL_PROCESSOR = 'haystack.signals.RealtimeSignalProcessor'
+HAYSTACK_SIGNAL_PROCESSOR = 'core.signals.QueuedSignalProcessor'
+
+SEARCH_INDEX_FLUSH_INTERVAL = config('SEARCH_INDEX_FLUSH_INTERVAL', cast=float, default=5.0)
+
+SEARCH_CACHE_TIMEOUT = config('SEARCH_CACHE_TIMEOUT', cast=float, default=30.0)
+
+AUTOCOMPLETE_REFRESH_INTERVAL = config('AUTOCOMPLETE_REFRESH_INTERVAL', cast=float, default=300.0)
 
 
 # Password validation
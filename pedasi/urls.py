@@ -16,6 +16,7 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import include, path
 
+from core.views import AutocompleteView
 from profiles.views import IndexView
 
 
@@ -45,6 +46,10 @@ urlpatterns = [
          include('api.urls',
                  namespace='api')),
 
+    path('search/autocomplete/',
+         AutocompleteView.as_view(),
+         name='autocomplete'),
+
     path('search/',
          include('haystack.urls')),
 
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "pedasi.settings")
 
 application = get_wsgi_application()
+
+# Build before the server forks worker processes so they share a copy - see core.autocomplete
+from core import autocomplete  # noqa: E402
+
+autocomplete.index.build_at_startup()
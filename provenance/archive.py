@@ -0,0 +1,212 @@
+"""
+This module contains functions for archiving old PROV records to compressed files and removing them from the database.
+
+Archive files contain one JSON object per line, holding a :class:`ProvWrapper` and its :class:`ProvEntry`,
+and are partitioned by the day on which the activity started - e.g. '2019/03/prov-2019-03-07.jsonl.gz'.
+"""
+
+import argparse
+import datetime
+import gzip
+import os
+import time
+import typing
+import zlib
+
+from bson import json_util
+from django.utils import dateparse, timezone
+
+from provenance.models import ProvArchiveDay, ProvEntry, ProvRollup, ProvWrapper, RollupGranularity
+
+
+def parse_date(value: str) -> datetime.datetime:
+    """
+    Parse a day given as a command line argument - e.g. '2019-03-07'.
+
+    :param value: Date in ISO format
+    :return: Midnight at the start of the day
+    :raises argparse.ArgumentTypeError: Value is not a valid date
+    """
+    date = dateparse.parse_date(value)
+    if date is None:
+        raise argparse.ArgumentTypeError('Invalid date \'{0}\''.format(value))
+
+    return datetime.datetime.combine(date, datetime.time())
+
+
+def get_archive_path(archive_dir: str, day: datetime.date) -> str:
+    """
+    Get the path of the archive file for PROV records of activities which started on a particular day.
+    """
+    return os.path.join(archive_dir,
+                        '{0:%Y}'.format(day), '{0:%m}'.format(day),
+                        'prov-{0:%Y-%m-%d}.jsonl.gz'.format(day))
+
+
+def _ensure_rollups(archive_dir: str, day: datetime.datetime) -> None:
+    """
+    Make sure that PROV records of activities which started on a day are counted in rollups before they are deleted.
+
+    Rollups are rebuilt from the day's records the first time the day is archived, then the day is marked
+    so that they are never rebuilt once some of its records have been deleted - a rebuild would undercount.
+    """
+    if ProvArchiveDay.objects(day=day).count():
+        return
+
+    # Days partly archived before they were marked - records already deleted cannot be counted again
+    if not os.path.exists(get_archive_path(archive_dir, day)):
+        ProvRollup.rebuild(since=day, until=day + datetime.timedelta(days=1))
+
+    ProvArchiveDay.objects(day=day).update_one(upsert=True, set__rolled_up=timezone.now())
+
+
+def _read_archived_ids(path: str) -> typing.Set[typing.Any]:
+    """
+    Get the ids of PROV records already written to an archive file.
+
+    If the file was left incomplete by an interrupted write, it is replaced by the records which can be read.
+    Records lost from the incomplete end of the file have not been deleted, so will be archived again.
+
+    :param path: Path of archive file
+    :return: Set of :class:`ProvWrapper` ids
+    """
+    if not os.path.exists(path):
+        return set()
+
+    lines = []
+    complete = True
+    try:
+        with gzip.open(path, 'rb') as gzip_file:
+            for line in gzip_file:
+                if not line.endswith(b'\n'):
+                    complete = False
+                    break
+
+                lines.append(line)
+
+    except (EOFError, OSError, zlib.error):
+        complete = False
+
+    records = []
+    for line in lines:
+        try:
+            records.append(json_util.loads(line.decode('utf-8')))
+
+        except ValueError:
+            complete = False
+
+    if not complete:
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as archive_file:
+            with gzip.GzipFile(fileobj=archive_file, mode='wb') as gzip_file:
+                for record in records:
+                    gzip_file.write((json_util.dumps(record) + '\n').encode('utf-8'))
+
+            archive_file.flush()
+            os.fsync(archive_file.fileno())
+
+        os.replace(tmp_path, path)
+
+    return {record['wrapper']['_id'] for record in records}
+
+
+def _write_archive(archive_dir: str,
+                   wrappers: typing.List[typing.Dict[str, typing.Any]],
+                   entries: typing.Mapping[typing.Any, typing.Dict[str, typing.Any]],
+                   archived_ids: typing.Dict[datetime.date, typing.Set[typing.Any]]) -> None:
+    """
+    Append PROV records to the archive files for the days on which their activities started.
+
+    Records already in an archive file - left by a run interrupted before they were deleted - are not written again.
+    Files are flushed to disk before returning so that records are never deleted before being archived.
+
+    :param archive_dir: Directory in which to write archive files
+    :param wrappers: Raw :class:`ProvWrapper` documents to archive
+    :param entries: Raw :class:`ProvEntry` documents by id
+    :param archived_ids: Ids of records already archived by day - read from the archive file on first use and updated
+    """
+    by_day = {}
+    for wrapper in wrappers:
+        by_day.setdefault(wrapper['timestamp'].date(), []).append(wrapper)
+
+    for day, day_wrappers in by_day.items():
+        path = get_archive_path(archive_dir, day)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        if day not in archived_ids:
+            archived_ids[day] = _read_archived_ids(path)
+        day_ids = archived_ids[day]
+
+        day_wrappers = [wrapper for wrapper in day_wrappers if wrapper['_id'] not in day_ids]
+        if not day_wrappers:
+            continue
+
+        # Appending to a gzip file adds a new member - the file remains readable as a single stream
+        with open(path, 'ab') as archive_file:
+            with gzip.GzipFile(fileobj=archive_file, mode='ab') as gzip_file:
+                for wrapper in day_wrappers:
+                    record = {
+                        'wrapper': wrapper,
+                        'entry': entries.get(wrapper.get('entry')),
+                    }
+                    gzip_file.write((json_util.dumps(record) + '\n').encode('utf-8'))
+
+            archive_file.flush()
+            os.fsync(archive_file.fileno())
+
+        day_ids.update(wrapper['_id'] for wrapper in day_wrappers)
+
+
+def archive_records(cutoff: datetime.datetime, archive_dir: str,
+                    batch_size: int = 1000, delay: float = 0,
+                    progress: typing.Optional[typing.Callable[[int], None]] = None) -> int:
+    """
+    Archive and delete PROV records of activities which started before a cutoff time, oldest first.
+
+    Rollups are built for each day before any of its records are deleted, then each batch of records is written to
+    archive files and deleted.  An interrupted run may safely be repeated - records already written to an archive file
+    are not written again.
+    The delay between batches limits the load this places on the database.
+
+    :param cutoff: Archive records of activities which started before this time
+    :param archive_dir: Directory in which to write archive files
+    :param batch_size: Number of records to archive and delete at once
+    :param delay: Time in seconds to wait between batches
+    :param progress: Function called with the total number of records archived after each batch
+    :return: Number of records archived
+    """
+    wrapper_collection = ProvWrapper._get_collection()
+    entry_collection = ProvEntry._get_collection()
+
+    rolled_up_days = set()
+    archived_ids = {}
+    n_archived = 0
+
+    while True:
+        wrappers = list(
+            wrapper_collection.find({'timestamp': {'$lt': cutoff}}).sort('timestamp', 1).limit(batch_size)
+        )
+        if not wrappers:
+            break
+
+        for wrapper in wrappers:
+            day = RollupGranularity.DAY.truncate(wrapper['timestamp'])
+            if day not in rolled_up_days:
+                _ensure_rollups(archive_dir, day)
+                rolled_up_days.add(day)
+
+        entry_ids = [wrapper['entry'] for wrapper in wrappers if 'entry' in wrapper]
+        entries = {entry['_id']: entry for entry in entry_collection.find({'_id': {'$in': entry_ids}})}
+
+        _write_archive(archive_dir, wrappers, entries, archived_ids)
+
+        ProvWrapper.delete_documents(wrappers)
+
+        n_archived += len(wrappers)
+        if progress is not None:
+            progress(n_archived)
+
+        if delay:
+            time.sleep(delay)
+
+    return n_archived
@@ -0,0 +1,43 @@
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from provenance.archive import archive_records
+
+
+class Command(BaseCommand):
+    help = 'Archive PROV records older than the retention period to compressed files and delete them from the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.PROV_RETENTION_DAYS,
+                            help='Number of whole days of PROV records to keep in the database - 0 to keep all')
+        parser.add_argument('--archive-dir', default=settings.PROV_ARCHIVE_DIR,
+                            help='Directory in which to write archive files')
+        parser.add_argument('--batch-size', type=int, default=settings.PROV_ARCHIVE_BATCH_SIZE,
+                            help='Number of records to archive and delete at once')
+        parser.add_argument('--delay', type=float, default=settings.PROV_ARCHIVE_DELAY,
+                            help='Time in seconds to wait between batches')
+
+    def handle(self, *args, **options):
+        if options['days'] <= 0:
+            self.stdout.write('PROV retention is disabled')
+            return
+
+        # Archive whole days so that each archive file is complete
+        today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        cutoff = today - datetime.timedelta(days=options['days'])
+
+        def progress(n_archived):
+            if options['verbosity'] > 1:
+                self.stdout.write('Archived %d PROV records' % n_archived)
+
+        n_archived = archive_records(cutoff, options['archive_dir'],
+                                     batch_size=options['batch_size'],
+                                     delay=options['delay'],
+                                     progress=progress)
+
+        self.stdout.write(self.style.SUCCESS(
+            'Successfully archived %d PROV records from before %s' % (n_archived, cutoff.date().isoformat())
+        ))
@@ -0,0 +1,63 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from applications.models import Application
+from datasources.models import DataSource
+from provenance.archive import parse_date
+from provenance.models import ProvWrapper
+
+
+class Command(BaseCommand):
+    help = 'Delete PROV records related to a data source or application and / or within a range of days'
+
+    def add_arguments(self, parser):
+        instance_group = parser.add_mutually_exclusive_group()
+        instance_group.add_argument('--datasource', type=int,
+                                    help='Primary key of data source - soft deleted data sources are included')
+        instance_group.add_argument('--application', type=int,
+                                    help='Primary key of application - soft deleted applications are included')
+
+        parser.add_argument('--since', type=parse_date,
+                            help='First day of PROV records to delete')
+        parser.add_argument('--until', type=parse_date,
+                            help='Day after last day of PROV records to delete')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of records to delete at once')
+        parser.add_argument('--delay', type=float, default=0,
+                            help='Time in seconds to wait between batches')
+        parser.add_argument('--noinput', '--no-input', action='store_false', dest='interactive',
+                            help='Do not prompt for confirmation')
+
+    def handle(self, *args, **options):
+        instance = None
+        try:
+            # Base manager includes soft deleted objects - which are the usual reason for deleting PROV records
+            if options['datasource'] is not None:
+                instance = DataSource._base_manager.get(pk=options['datasource'])
+
+            elif options['application'] is not None:
+                instance = Application._base_manager.get(pk=options['application'])
+
+        except (DataSource.DoesNotExist, Application.DoesNotExist) as e:
+            raise CommandError(str(e))
+
+        if instance is None and options['since'] is None and options['until'] is None:
+            raise CommandError('Provide a data source, application or range of days')
+
+        if options['interactive']:
+            confirm = input('This will permanently delete the selected PROV records.  Type \'yes\' to continue: ')
+            if confirm != 'yes':
+                self.stdout.write('Deletion cancelled')
+                return
+
+        def progress(n_deleted):
+            if options['verbosity'] > 1:
+                self.stdout.write('Deleted %d PROV records' % n_deleted)
+
+        n_deleted = ProvWrapper.delete_records(instance=instance,
+                                               since=options['since'],
+                                               until=options['until'],
+                                               batch_size=options['batch_size'],
+                                               delay=options['delay'],
+                                               progress=progress)
+
+        self.stdout.write(self.style.SUCCESS('Successfully deleted %d PROV records' % n_deleted))
@@ -0,0 +1,37 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from datasources.models import DataSource
+from provenance.models import ProvActivity, ProvEntry
+
+
+class Command(BaseCommand):
+    help = 'Measure the rate at which PROV-JSON records are built - by the PROV library and by the fast path'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--number', type=int, default=10000,
+                            help='Number of PROV records to build using each method')
+
+    def handle(self, *args, **options):
+        datasource = DataSource.objects.first()
+        if datasource is None:
+            raise CommandError('At least one data source is required to build PROV records')
+
+        user_uri = datasource.owner.get_uri()
+
+        builders = [
+            ('PROV library', lambda params: json.loads(ProvEntry.build_prov_document(params).serialize())),
+            ('Fast path', ProvEntry.build_prov_json),
+        ]
+
+        for name, builder in builders:
+            start = time.perf_counter()
+
+            for _ in range(options['number']):
+                params = ProvEntry.get_prov_params(datasource, user_uri, activity_type=ProvActivity.ACCESS)
+                builder(params)
+
+            elapsed = time.perf_counter() - start
+            self.stdout.write('{0}: {1:.0f} records per second'.format(name, options['number'] / elapsed))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from provenance.models import ProvEdge
+
+
+class Command(BaseCommand):
+    help = 'Recalculate the PROV lineage graph from existing PROV records, replacing existing edges'
+
+    def handle(self, *args, **options):
+        n_edges = ProvEdge.rebuild()
+
+        self.stdout.write(self.style.SUCCESS('Successfully wrote %d PROV lineage edges' % n_edges))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from provenance.models import ProvWrapper
+
+
+class Command(BaseCommand):
+    help = 'Copy the user, application, activity type and timestamp of old PROV records into their wrappers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of records to update at once')
+
+    def handle(self, *args, **options):
+        n_updated = ProvWrapper.backfill_query_fields(batch_size=options['batch_size'])
+
+        self.stdout.write(self.style.SUCCESS('Successfully updated %d PROV records' % n_updated))
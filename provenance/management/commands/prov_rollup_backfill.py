@@ -0,0 +1,24 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from provenance.archive import parse_date
+from provenance.models import ProvRollup
+
+
+class Command(BaseCommand):
+    help = 'Recalculate PROV rollups from existing PROV records, replacing existing counts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=parse_date,
+                            help='First day to recalculate')
+        parser.add_argument('--until', type=parse_date,
+                            help='Day after last day to recalculate - default is today, which is still in progress')
+
+    def handle(self, *args, **options):
+        until = options['until'] or datetime.datetime.combine(timezone.now().date(), datetime.time())
+
+        n_records = ProvRollup.rebuild(since=options['since'], until=until)
+
+        self.stdout.write(self.style.SUCCESS('Successfully counted %d PROV records' % n_records))
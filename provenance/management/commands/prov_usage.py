@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from datasources.models import DataSource
+from provenance.archive import parse_date
+from provenance.models import ProvActivity, ProvRollup, RollupGranularity
+
+
+class Command(BaseCommand):
+    help = 'Report usage of a data source from PROV rollups'
+
+    def add_arguments(self, parser):
+        parser.add_argument('datasource', type=int,
+                            help='Id of data source')
+        parser.add_argument('--granularity', choices=[item.value for item in RollupGranularity], default='day',
+                            help='Size of time buckets')
+        parser.add_argument('--since', type=parse_date,
+                            help='Start date of report')
+        parser.add_argument('--until', type=parse_date,
+                            help='End date of report - exclusive')
+        parser.add_argument('--activity', choices=[item.name.lower() for item in ProvActivity],
+                            help='Only report activities of this type')
+        parser.add_argument('--application',
+                            help='Only report activities performed using the application with this id')
+
+    def handle(self, *args, **options):
+        try:
+            datasource = DataSource.objects.get(pk=options['datasource'])
+
+        except DataSource.DoesNotExist:
+            raise CommandError('Data source "%s" does not exist' % options['datasource'])
+
+        filters = {option: options[option] for option in ('since', 'until') if options[option] is not None}
+
+        if options['activity'] is not None:
+            filters['activity_type'] = ProvActivity[options['activity'].upper()]
+
+        if options['application'] is not None:
+            filters['application_id'] = 'piot:app-' + options['application']
+
+        rollups = ProvRollup.filter_model_instance(datasource,
+                                                   granularity=RollupGranularity(options['granularity']),
+                                                   **filters)
+
+        for rollup in rollups:
+            self.stdout.write('{0}\t{1}\t{2}\t{3}'.format(
+                rollup.bucket.isoformat(), rollup.application_id, rollup.activity_type, rollup.count
+            ))
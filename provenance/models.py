@@ -6,25 +6,51 @@ These PROV documents describe actions made by users and applications, allowing u
 For details on PROV see https://www.w3.org/TR/2013/NOTE-prov-overview-20130430/
 """
 
+import atexit
+import collections
+import datetime
 import enum
 import json
+import os
+import random
+import threading
+import time
 import typing
 import uuid
 
+from bson.objectid import ObjectId
 from django import apps
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.db.models import QuerySet
-from django.utils import timezone
+from django.utils import dateparse, timezone
 from django.utils.text import slugify
 
 import mongoengine
 from mongoengine.queryset.visitor import Q
+import networkx
 import prov.model
+import pymongo
 
+from core import metrics
+from core.batching import BatchWorker, PartialBatchError
 from core.models import BaseAppDataModel
 
 MAX_LENGTH_NAME_FIELD = 100
 
+#: Namespaces used in PEDASI PROV records
+PROV_NAMESPACES = {
+    # TODO set PEDASI PROV namespace
+    'piot': 'http://www.pedasi-iot.org/',
+    'foaf': 'http://xmlns.com/foaf/0.1/',
+    'xsd': 'http://www.w3.org/2001/XMLSchema#',
+}
+
+#: Namespace prefixes as serialized in PROV-JSON - the PROV library omits the built-in 'xsd' namespace
+PROV_JSON_PREFIXES = {
+    key: value for key, value in PROV_NAMESPACES.items() if key != 'xsd'
+}
+
 
 class ProvApplicationModel:
     """
@@ -63,67 +89,92 @@ class ProvEntry(mongoengine.DynamicDocument):
 
     These will be referred to by a :class:`ProvWrapper` document.
     """
-    @classmethod
-    def create_prov(cls,
-                    instance: BaseAppDataModel,
-                    user_uri: str,
-                    application: typing.Optional[ProvApplicationModel] = None,
-                    activity_type: typing.Optional[ProvActivity] = ProvActivity.UPDATE) -> 'ProvEntry':
+    @staticmethod
+    def get_entity_id(model_name: str, pk: typing.Any) -> str:
         """
-        Build a PROV document representing a particular activity within PEDASI.
+        Get the PROV identifier of a Django model instance.
+
+        :param model_name: Name of the model - as in :class:`ContentType`
+        :param pk: Primary key of the model instance
+        """
+        # TODO unique identifier for instance
+        return 'piot:e-' + slugify(model_name) + str(pk)
+
+    @staticmethod
+    def get_prov_params(instance: BaseAppDataModel,
+                        user_uri: str,
+                        application: typing.Optional[ProvApplicationModel] = None,
+                        activity_type: typing.Optional[ProvActivity] = ProvActivity.UPDATE
+                        ) -> typing.Dict[str, typing.Any]:
+        """
+        Get the values which identify a particular activity within PEDASI and differ between PROV records.
 
         :param instance: Application or DataSource which is the object of the activity
         :param user_uri: URI of user who performed the activity
         :param application: Application which the user used to perform the activity
         :param activity_type: Type of the activity - from :class:`ProvActivity`
-        :return: PROV document in PROV-JSON form
+        :return: Dictionary of PROV record parameters
         """
         instance_type = ContentType.objects.get_for_model(instance)
 
-        document = prov.model.ProvDocument(namespaces={
-            # TODO set PEDASI PROV namespace
-            'piot': 'http://www.pedasi-iot.org/',
-            'foaf': 'http://xmlns.com/foaf/0.1/',
-            'xsd': 'http://www.w3.org/2001/XMLSchema#',
-        })
+        if application is None:
+            application = ProvApplicationModel()
+
+        return {
+            'entity_id': ProvEntry.get_entity_id(instance_type.model, instance.pk),
+            'entity_type': 'piot:' + slugify(instance_type.model),
+            'entity_uri': instance.get_absolute_url(),
+            'activity_id': 'piot:a-' + str(uuid.uuid4()),
+            'activity_type': activity_type.value,
+            'start_time': timezone.now(),
+            # Generate a UUID so we can lookup records belonging to a user
+            # But not identify the user from a given record
+            # TODO how strongly do we want to prevent user identification?
+            # See https://github.com/PEDASI/PEDASI/issues/10
+            'user_id': 'piot:u-' + str(uuid.uuid5(uuid.NAMESPACE_URL, user_uri)),
+            'application_id': 'piot:app-' + str(application.pk),
+            'application_uri': application.get_absolute_url(),
+        }
 
-        entity = document.entity(
-            # TODO unique identifier for instance
-            'piot:e-' + slugify(instance_type.model) + str(instance.pk),
+    @staticmethod
+    def build_prov_document(params: typing.Mapping[str, typing.Any]) -> prov.model.ProvDocument:
+        """
+        Build a PROV document representing a particular activity within PEDASI using the PROV library.
+
+        :param params: PROV record parameters from :meth:`get_prov_params`
+        :return: PROV document
+        """
+        document = prov.model.ProvDocument(namespaces=PROV_NAMESPACES)
+
+        document.entity(
+            params['entity_id'],
             other_attributes={
-                prov.model.PROV_TYPE: 'piot:' + slugify(instance_type.model),
-                'xsd:anyURI': instance.get_absolute_url(),
+                prov.model.PROV_TYPE: params['entity_type'],
+                'xsd:anyURI': params['entity_uri'],
             }
         )
 
         activity = document.activity(
-            'piot:a-' + str(uuid.uuid4()),
-            timezone.now(),
+            params['activity_id'],
+            params['start_time'],
             None,
             other_attributes={
-                prov.model.PROV_TYPE: activity_type.value
+                prov.model.PROV_TYPE: params['activity_type'],
             }
         )
 
         agent_user = document.agent(
-            # Generate a UUID so we can lookup records belonging to a user
-            # But not identify the user from a given record
-            # TODO how strongly do we want to prevent user identification?
-            # See https://github.com/PEDASI/PEDASI/issues/10
-            'piot:u-' + str(uuid.uuid5(uuid.NAMESPACE_URL, user_uri)),
+            params['user_id'],
             other_attributes={
                 prov.model.PROV_TYPE: 'prov:Person',
             }
         )
 
-        if application is None:
-            application = ProvApplicationModel()
-
         agent_application = document.agent(
-            'piot:app-' + str(application.pk),
+            params['application_id'],
             other_attributes={
                 prov.model.PROV_TYPE: 'prov:SoftwareAgent',
-                'xsd:anyURI': application.get_absolute_url(),
+                'xsd:anyURI': params['application_uri'],
             }
         )
 
@@ -136,8 +187,73 @@ class ProvEntry(mongoengine.DynamicDocument):
             }
         )
 
-        # PROV library does not appear to be able to give a Python dictionary directly - have to go via string
-        return cls.deserialize(content=document.serialize())
+        return document
+
+    @staticmethod
+    def build_prov_json(params: typing.Mapping[str, typing.Any]) -> typing.Dict[str, typing.Any]:
+        """
+        Build a PROV-JSON dictionary representing a particular activity within PEDASI.
+
+        Gives the same result as serializing the document from :meth:`build_prov_document`,
+        but fills the fixed structure of a PEDASI PROV record directly, which is much faster.
+
+        :param params: PROV record parameters from :meth:`get_prov_params`
+        :return: PROV document in PROV-JSON form
+        """
+        return {
+            'prefix': dict(PROV_JSON_PREFIXES),
+            'entity': {
+                params['entity_id']: {
+                    'prov:type': params['entity_type'],
+                    'xsd:anyURI': params['entity_uri'],
+                },
+            },
+            'activity': {
+                params['activity_id']: {
+                    'prov:startTime': params['start_time'].isoformat(),
+                    'prov:type': params['activity_type'],
+                },
+            },
+            'agent': {
+                params['user_id']: {
+                    'prov:type': 'prov:Person',
+                },
+                params['application_id']: {
+                    'prov:type': 'prov:SoftwareAgent',
+                    'xsd:anyURI': params['application_uri'],
+                },
+            },
+            'actedOnBehalfOf': {
+                # Blank node identifier as generated by the PROV library
+                '_:id1': {
+                    'prov:delegate': params['application_id'],
+                    'prov:responsible': params['user_id'],
+                    'prov:activity': params['activity_id'],
+                    'prov:type': 'piot:ApplicationAction',
+                },
+            },
+        }
+
+    @classmethod
+    def create_prov(cls,
+                    instance: BaseAppDataModel,
+                    user_uri: str,
+                    application: typing.Optional[ProvApplicationModel] = None,
+                    activity_type: typing.Optional[ProvActivity] = ProvActivity.UPDATE) -> 'ProvEntry':
+        """
+        Build a PROV document representing a particular activity within PEDASI.
+
+        :param instance: Application or DataSource which is the object of the activity
+        :param user_uri: URI of user who performed the activity
+        :param application: Application which the user used to perform the activity
+        :param activity_type: Type of the activity - from :class:`ProvActivity`
+        :return: PROV document in PROV-JSON form
+        """
+        params = cls.get_prov_params(instance, user_uri,
+                                     application=application,
+                                     activity_type=activity_type)
+
+        return cls(**cls.build_prov_json(params))
 
     @classmethod
     def deserialize(cls, source=None, content: str = None, format: str = 'json', **kwargs):
@@ -190,6 +306,39 @@ class ProvWrapper(mongoengine.Document):
         document_type=ProvEntry
     )
 
+    # The following fields duplicate parts of the PROV entry so that records can be queried using indexes
+
+    #: PROV identifier of the user who performed the activity - a hash, so does not identify the user
+    user_id = mongoengine.fields.StringField(max_length=MAX_LENGTH_NAME_FIELD)
+
+    #: PROV identifier of the application used to perform the activity
+    application_id = mongoengine.fields.StringField(max_length=MAX_LENGTH_NAME_FIELD)
+
+    #: Type of the activity - from :class:`ProvActivity`
+    activity_type = mongoengine.fields.StringField(max_length=MAX_LENGTH_NAME_FIELD)
+
+    #: Time at which the activity started
+    timestamp = mongoengine.fields.DateTimeField()
+
+    #: Number of activities represented by this record - more than one if repeated activities were coalesced
+    count = mongoengine.fields.IntField(default=1)
+
+    #: Number of activities represented by each recorded activity - more than one if activities were sampled
+    sample_weight = mongoengine.fields.IntField(default=1)
+
+    meta = {
+        'indexes': [
+            # Records for a model instance - optionally filtered by time - id breaks ties for pagination
+            ('app_label', 'model_name', 'related_pk', '-timestamp', '-id'),
+            # Records by application, user or activity type - optionally filtered by time
+            ('application_id', '-timestamp'),
+            ('user_id', '-timestamp'),
+            ('activity_type', '-timestamp'),
+            # Records by time - used to archive old records
+            'timestamp',
+        ],
+    }
+
     @property
     def instance(self):
         """
@@ -214,34 +363,150 @@ class ProvWrapper(mongoengine.Document):
             Q(related_pk=instance.pk)
         ).values_list('entry')
 
+    @classmethod
+    def filter_records(cls, instance: BaseAppDataModel,
+                       since: typing.Optional[datetime.datetime] = None,
+                       until: typing.Optional[datetime.datetime] = None,
+                       activity_type: typing.Optional[ProvActivity] = None,
+                       application_id: typing.Optional[str] = None,
+                       after: typing.Optional[typing.Tuple[datetime.datetime, ObjectId]] = None) -> QuerySet:
+        """
+        Get :class:`ProvWrapper`\ s related to a particular Django model instance, newest first.
+
+        :param instance: Model instance for which to get :class:`ProvWrapper`\ s
+        :param since: Only include activities which started at or after this time
+        :param until: Only include activities which started before this time
+        :param activity_type: Only include activities of this type
+        :param application_id: Only include activities performed using the application with this PROV identifier
+        :param after: Timestamp and id of a wrapper - only include wrappers which come after it in the ordering
+        :return: Queryset of :class:`ProvWrapper`\ s
+        """
+        instance_type = ContentType.objects.get_for_model(instance)
+
+        query = (
+            Q(app_label=instance_type.app_label) &
+            Q(model_name=instance_type.model) &
+            Q(related_pk=instance.pk)
+        )
+
+        if since is not None:
+            query &= Q(timestamp__gte=since)
+
+        if until is not None:
+            query &= Q(timestamp__lt=until)
+
+        if activity_type is not None:
+            query &= Q(activity_type=activity_type.value)
+
+        if application_id is not None:
+            query &= Q(application_id=application_id)
+
+        if after is not None:
+            timestamp, id = after
+            query &= Q(timestamp__lt=timestamp) | (Q(timestamp=timestamp) & Q(id__lt=id))
+
+        return cls.objects(query).order_by('-timestamp', '-id')
+
+    @staticmethod
+    def get_entries(entry_ids: typing.List[ObjectId]) -> typing.List[typing.Dict[str, typing.Any]]:
+        """
+        Get raw :class:`ProvEntry` documents in a single query.
+
+        :param entry_ids: Ids of :class:`ProvEntry` documents to get
+        :return: List of raw documents in the same order as the ids
+        """
+        entries = {
+            entry['_id']: entry for entry in ProvEntry._get_collection().find({'_id': {'$in': entry_ids}})
+        }
+
+        return [entries[entry_id] for entry_id in entry_ids if entry_id in entries]
+
+    @staticmethod
+    def _get_query_fields(instance_type: ContentType, instance: BaseAppDataModel,
+                          params: typing.Mapping[str, typing.Any]) -> typing.Dict[str, typing.Any]:
+        """
+        Get the fields used to query wrappers for a PROV record.
+
+        :param instance_type: Content type of the model instance
+        :param instance: Model instance which is the object of the activity
+        :param params: PROV record parameters from :meth:`ProvEntry.get_prov_params`
+        :return: Dictionary of field values
+        """
+        return {
+            'app_label': instance_type.app_label,
+            'model_name': instance_type.model,
+            'related_pk': instance.pk,
+            'user_id': params['user_id'],
+            'application_id': params['application_id'],
+            'activity_type': params['activity_type'],
+            'timestamp': params['start_time'],
+        }
+
     @classmethod
     def create_prov(cls,
                     instance: BaseAppDataModel,
                     user_uri: str,
                     application: typing.Optional[ProvApplicationModel] = None,
-                    activity_type: typing.Optional[ProvActivity] = ProvActivity.UPDATE) -> ProvEntry:
+                    activity_type: typing.Optional[ProvActivity] = ProvActivity.UPDATE,
+                    asynchronous: bool = False,
+                    sample_rate: int = 1,
+                    coalesce_window: int = 0) -> typing.Optional[ProvEntry]:
         """
         Create a PROV record for a single action.
 
         e.g. Update a model's metadata, use a model.
 
         These will create and return a :class:`ProvEntry` document.
+
+        :param asynchronous: Queue the record to be written by :data:`prov_writer` rather than writing it now?
+            Ignored if the PROV_ASYNC_WRITES setting is False.
+        :param sample_rate: Record only one in this many actions, chosen at random - the record is weighted to match
+        :param coalesce_window: Merge identical actions within this many seconds into a single record with a count.
+            Only applies to queued records.
+        :return: New :class:`ProvEntry` - or None if the record was queued or not sampled
         """
-        prov_entry = ProvEntry.create_prov(instance, user_uri,
+        if sample_rate > 1 and random.randrange(sample_rate) != 0:
+            return None
+
+        instance_type = ContentType.objects.get_for_model(instance)
+        params = ProvEntry.get_prov_params(instance, user_uri,
                                            application=application,
                                            activity_type=activity_type)
-        prov_entry.save()
 
-        instance_type = ContentType.objects.get_for_model(instance)
+        query_fields = cls._get_query_fields(instance_type, instance, params)
+        query_fields['sample_weight'] = max(sample_rate, 1)
+
+        if asynchronous and settings.PROV_ASYNC_WRITES:
+            # Queue raw documents - constructing MongoEngine documents costs more than building the record
+            # Assign ids now so that the wrapper can reference the entry before either has been written
+            prov_entry = ProvEntry.build_prov_json(params)
+            prov_entry['_id'] = ObjectId()
+
+            wrapper = dict(query_fields)
+            wrapper['_id'] = ObjectId()
+            wrapper['entry'] = prov_entry['_id']
+            wrapper['count'] = 1
+
+            if coalesce_window > 0:
+                prov_coalescer.add(prov_entry, wrapper, coalesce_window)
+
+            else:
+                prov_writer.submit((prov_entry, wrapper))
+
+            return None
+
+        prov_entry = ProvEntry(**ProvEntry.build_prov_json(params))
+        prov_entry.save()
 
         wrapper = cls(
-            app_label=instance_type.app_label,
-            model_name=instance_type.model,
-            related_pk=instance.pk,
-            entry=prov_entry
+            entry=prov_entry,
+            **query_fields
         )
         wrapper.save()
 
+        ProvRollup.increment([query_fields])
+        ProvEdge.increment([query_fields])
+
         return prov_entry
 
     def delete(self, signal_kwargs=None, **write_concern):
@@ -251,31 +516,831 @@ class ProvWrapper(mongoengine.Document):
         self.entry.delete(signal_kwargs, **write_concern)
         super().delete(signal_kwargs, **write_concern)
 
+    @classmethod
+    def delete_documents(cls, wrappers: typing.Iterable[typing.Mapping[str, typing.Any]]) -> None:
+        """
+        Delete raw :class:`ProvWrapper` documents and the :class:`ProvEntry` documents to which they refer.
+
+        Entries are deleted first so that an interrupted deletion leaves no wrapper referring to a missing entry.
+
+        :param wrappers: Raw :class:`ProvWrapper` documents - must include '_id' and 'entry'
+        """
+        wrappers = list(wrappers)
+
+        entry_ids = [wrapper['entry'] for wrapper in wrappers if wrapper.get('entry') is not None]
+        if entry_ids:
+            ProvEntry._get_collection().delete_many({'_id': {'$in': entry_ids}})
+
+        cls._get_collection().delete_many({'_id': {'$in': [wrapper['_id'] for wrapper in wrappers]}})
+
+    @classmethod
+    def delete_records(cls, instance: typing.Optional[BaseAppDataModel] = None,
+                       since: typing.Optional[datetime.datetime] = None,
+                       until: typing.Optional[datetime.datetime] = None,
+                       batch_size: int = 1000, delay: float = 0,
+                       progress: typing.Optional[typing.Callable[[int], None]] = None) -> int:
+        """
+        Delete PROV records related to a Django model instance and / or within a time range, in batches.
+
+        If all PROV records of a model instance are deleted, its rollups and lineage graph edges are also deleted.
+        Otherwise these are kept, as they are when records are archived.
+
+        :param instance: Only delete records related to this model instance
+        :param since: Only delete records of activities which started at or after this time
+        :param until: Only delete records of activities which started before this time
+        :param batch_size: Number of records to delete at once
+        :param delay: Time in seconds to wait between batches
+        :param progress: Function called with the total number of records deleted after each batch
+        :return: Number of records deleted
+        """
+        query = {}
+        if instance is not None:
+            instance_type = ContentType.objects.get_for_model(instance)
+            query.update({
+                'app_label': instance_type.app_label,
+                'model_name': instance_type.model,
+                'related_pk': instance.pk,
+            })
+
+        if since is not None or until is not None:
+            query['timestamp'] = {}
+            if since is not None:
+                query['timestamp']['$gte'] = since
+            if until is not None:
+                query['timestamp']['$lt'] = until
+
+        if not query:
+            raise ValueError('Provide a model instance or time range of PROV records to delete')
+
+        collection = cls._get_collection()
+        n_deleted = 0
+
+        while True:
+            wrappers = list(collection.find(query, {'entry': 1}, limit=batch_size))
+            if not wrappers:
+                break
+
+            cls.delete_documents(wrappers)
+
+            n_deleted += len(wrappers)
+            if progress is not None:
+                progress(n_deleted)
+
+            if delay:
+                time.sleep(delay)
+
+        if instance is not None and since is None and until is None:
+            for summary in (ProvRollup, ProvEdge):
+                summary._get_collection().delete_many({
+                    key: query[key] for key in ('app_label', 'model_name', 'related_pk')
+                })
+
+        return n_deleted
+
+    @staticmethod
+    def _get_entry_query_fields(entry: typing.Mapping[str, typing.Any]) -> typing.Dict[str, typing.Any]:
+        """
+        Get the fields used to query wrappers from an existing raw :class:`ProvEntry` document.
+
+        :param entry: Raw :class:`ProvEntry` document
+        :return: Dictionary of field values - only those present in the PROV record
+        """
+        fields = {}
+
+        for agent_id, agent in entry.get('agent', {}).items():
+            if agent.get('prov:type') == 'prov:Person':
+                fields['user_id'] = agent_id
+
+            elif agent.get('prov:type') == 'prov:SoftwareAgent':
+                fields['application_id'] = agent_id
+
+        for activity in entry.get('activity', {}).values():
+            if activity.get('prov:type') is not None:
+                fields['activity_type'] = activity['prov:type']
+
+            timestamp = dateparse.parse_datetime(activity.get('prov:startTime', ''))
+            if timestamp is not None:
+                fields['timestamp'] = timestamp
+
+        return fields
+
+    @classmethod
+    def backfill_query_fields(cls, batch_size: int = 1000) -> int:
+        """
+        Copy the user, application, activity type and timestamp of PROV records written before these were stored
+        on their wrappers.
+
+        Wrappers whose PROV record is missing or has none of these fields are left unchanged.
+
+        :param batch_size: Number of wrappers to update at once
+        :return: Number of wrappers updated
+        """
+        collection = cls._get_collection()
+        entry_collection = ProvEntry._get_collection()
+
+        cursor = collection.find({'timestamp': {'$exists': False}}, {'entry': 1}, batch_size=batch_size)
+        n_updated = 0
+
+        while True:
+            batch = [wrapper for _, wrapper in zip(range(batch_size), cursor)]
+            if not batch:
+                break
+
+            entry_ids = [wrapper['entry'] for wrapper in batch if 'entry' in wrapper]
+            entries = {entry['_id']: entry for entry in entry_collection.find({'_id': {'$in': entry_ids}})}
+
+            updates = []
+            for wrapper in batch:
+                try:
+                    fields = cls._get_entry_query_fields(entries[wrapper['entry']])
+
+                except KeyError:
+                    continue
+
+                # MongoDB rejects an empty update
+                if fields:
+                    updates.append(pymongo.UpdateOne({'_id': wrapper['_id']}, {'$set': fields}))
+
+            if updates:
+                collection.bulk_write(updates, ordered=False)
+                n_updated += len(updates)
+
+        return n_updated
+
+
+@enum.unique
+class RollupGranularity(enum.Enum):
+    """
+    Enum representing the time buckets into which :class:`ProvRollup` counts are divided.
+    """
+    HOUR = 'hour'
+    DAY = 'day'
+
+    def truncate(self, timestamp: datetime.datetime) -> datetime.datetime:
+        """
+        Get the start of the time bucket containing a timestamp.
+        """
+        timestamp = timestamp.replace(minute=0, second=0, microsecond=0)
+        if self is RollupGranularity.DAY:
+            timestamp = timestamp.replace(hour=0)
+
+        return timestamp
+
+
+class ProvRollup(mongoengine.Document):
+    """
+    Count of activities for a Django model instance, application and activity type within a time bucket.
+
+    Counts include the activities represented by sampled and coalesced PROV records.
+
+    Rollups are updated as PROV records are written, so that usage can be reported without scanning PROV records.
+    """
+    #: App from which the model comes
+    app_label = mongoengine.fields.StringField(max_length=MAX_LENGTH_NAME_FIELD,
+                                               required=True, null=False)
+
+    #: Name of the model
+    model_name = mongoengine.fields.StringField(max_length=MAX_LENGTH_NAME_FIELD,
+                                                required=True, null=False)
+
+    #: Primary key of the model instance
+    related_pk = mongoengine.fields.IntField(required=True, null=False)
+
+    #: PROV identifier of the application used to perform the activities
+    application_id = mongoengine.fields.StringField(max_length=MAX_LENGTH_NAME_FIELD)
+
+    #: Type of the activities - from :class:`ProvActivity`
+    activity_type = mongoengine.fields.StringField(max_length=MAX_LENGTH_NAME_FIELD)
+
+    #: Size of time bucket - from :class:`RollupGranularity`
+    granularity = mongoengine.fields.StringField(max_length=MAX_LENGTH_NAME_FIELD,
+                                                 required=True, null=False)
+
+    #: Start of time bucket
+    bucket = mongoengine.fields.DateTimeField(required=True, null=False)
+
+    #: Number of PROV records
+    count = mongoengine.fields.IntField(default=0)
+
+    meta = {
+        'indexes': [
+            {
+                'fields': ('app_label', 'model_name', 'related_pk', 'granularity', 'bucket',
+                           'application_id', 'activity_type'),
+                'unique': True,
+            },
+            ('granularity', 'bucket'),
+        ],
+    }
+
+    #: Fields which identify a rollup - other than the time bucket
+    key_fields = ('app_label', 'model_name', 'related_pk', 'application_id', 'activity_type')
+
+    @classmethod
+    def _get_counts(cls, wrappers: typing.Iterable[typing.Mapping[str, typing.Any]]) -> typing.Counter:
+        """
+        Count raw :class:`ProvWrapper` documents by rollup key and time bucket.
+
+        :param wrappers: Raw :class:`ProvWrapper` documents
+        :return: Counter mapping rollup keys to counts
+        """
+        counts = collections.Counter()
+
+        for wrapper in wrappers:
+            if wrapper.get('timestamp') is None:
+                continue
+
+            # Estimated number of activities represented by the record
+            weight = wrapper.get('count', 1) * wrapper.get('sample_weight', 1)
+
+            key = tuple(wrapper.get(field) for field in cls.key_fields)
+            for granularity in RollupGranularity:
+                counts[key + (granularity.value, granularity.truncate(wrapper['timestamp']))] += weight
+
+        return counts
+
+    @classmethod
+    def _write_counts(cls, counts: typing.Counter, operator: str) -> None:
+        updates = []
+        for key, count in counts.items():
+            query = dict(zip(cls.key_fields + ('granularity', 'bucket'), key))
+            updates.append(pymongo.UpdateOne(query, {operator: {'count': count}}, upsert=True))
+
+        if updates:
+            cls._get_collection().bulk_write(updates, ordered=False)
+
+    @classmethod
+    def increment(cls, wrappers: typing.Iterable[typing.Mapping[str, typing.Any]]) -> None:
+        """
+        Add newly written PROV records to the rollups.
+
+        :param wrappers: Raw :class:`ProvWrapper` documents which have been written
+        """
+        cls._write_counts(cls._get_counts(wrappers), '$inc')
+
+    @classmethod
+    def rebuild(cls, since: typing.Optional[datetime.datetime] = None,
+                until: typing.Optional[datetime.datetime] = None,
+                batch_size: int = 10000) -> int:
+        """
+        Recalculate rollups from the PROV records in a time range, replacing any existing counts.
+
+        The time range is extended to whole days, so should not include days whose PROV records have been archived,
+        or the day currently in progress, for which records may still be queued.
+
+        :param since: Start of time range
+        :param until: End of time range
+        :param batch_size: Number of PROV records to read from the database at once
+        :return: Number of activities counted
+        """
+        query = {'timestamp': {'$ne': None}}
+        if since is not None:
+            query['timestamp']['$gte'] = RollupGranularity.DAY.truncate(since)
+        if until is not None:
+            query['timestamp']['$lt'] = RollupGranularity.DAY.truncate(until)
+
+        projection = {field: 1 for field in cls.key_fields + ('timestamp', 'count', 'sample_weight')}
+        wrappers = ProvWrapper._get_collection().find(query, projection, batch_size=batch_size)
+
+        counts = cls._get_counts(wrappers)
+        cls._write_counts(counts, '$set')
+
+        # Each activity is counted once per granularity
+        return sum(count for key, count in counts.items() if key[-2] == RollupGranularity.DAY.value)
+
+    @classmethod
+    def filter_model_instance(cls, instance: BaseAppDataModel,
+                              granularity: RollupGranularity = RollupGranularity.DAY,
+                              since: typing.Optional[datetime.datetime] = None,
+                              until: typing.Optional[datetime.datetime] = None,
+                              activity_type: typing.Optional[ProvActivity] = None,
+                              application_id: typing.Optional[str] = None) -> QuerySet:
+        """
+        Get rollups for a particular Django model instance, oldest first.
+
+        :param instance: Model instance for which to get rollups
+        :param granularity: Size of time buckets
+        :param since: Only include time buckets containing or after this time
+        :param until: Only include time buckets starting before this time
+        :param activity_type: Only include activities of this type
+        :param application_id: Only include activities performed using the application with this PROV identifier
+        :return: Queryset of :class:`ProvRollup`\ s
+        """
+        instance_type = ContentType.objects.get_for_model(instance)
+
+        query = (
+            Q(app_label=instance_type.app_label) &
+            Q(model_name=instance_type.model) &
+            Q(related_pk=instance.pk) &
+            Q(granularity=granularity.value)
+        )
+
+        if since is not None:
+            query &= Q(bucket__gte=granularity.truncate(since))
+
+        if until is not None:
+            query &= Q(bucket__lt=until)
+
+        if activity_type is not None:
+            query &= Q(activity_type=activity_type.value)
+
+        if application_id is not None:
+            query &= Q(application_id=application_id)
+
+        return cls.objects(query).order_by('bucket')
+
+
+class ProvArchiveDay(mongoengine.Document):
+    """
+    Record of a day whose PROV records are being archived.
+
+    Written once rollups for the day have been built and before any of its records are deleted,
+    so that the rollups are never rebuilt from a partly archived day.
+    """
+    #: Start of the day
+    day = mongoengine.fields.DateTimeField(required=True, unique=True)
+
+    #: When rollups for the day were built
+    rolled_up = mongoengine.fields.DateTimeField()
+
+
+class ProvEdge(mongoengine.Document):
+    """
+    Link in the PROV lineage graph between a Django model instance, the application used to act upon it
+    and the user on whose behalf the application acted, for a single activity type.
+
+    Repeated activities increase the count of a single edge, so the graph grows with the number of distinct
+    relationships rather than the number of PROV records.  Edges are updated as PROV records are written.
+
+    See :meth:`traverse` to build a :class:`networkx.MultiDiGraph` of the lineage around a node.
+    """
+    #: App from which the model comes
+    app_label = mongoengine.fields.StringField(max_length=MAX_LENGTH_NAME_FIELD,
+                                               required=True, null=False)
+
+    #: Name of the model
+    model_name = mongoengine.fields.StringField(max_length=MAX_LENGTH_NAME_FIELD,
+                                                required=True, null=False)
+
+    #: Primary key of the model instance
+    related_pk = mongoengine.fields.IntField(required=True, null=False)
+
+    #: PROV identifier of the application used to perform the activities
+    application_id = mongoengine.fields.StringField(max_length=MAX_LENGTH_NAME_FIELD)
+
+    #: PROV identifier of the user on whose behalf the activities were performed
+    user_id = mongoengine.fields.StringField(max_length=MAX_LENGTH_NAME_FIELD)
+
+    #: Type of the activities - from :class:`ProvActivity`
+    activity_type = mongoengine.fields.StringField(max_length=MAX_LENGTH_NAME_FIELD)
+
+    #: Number of activities
+    count = mongoengine.fields.IntField(default=0)
+
+    #: Time at which the first activity started
+    first_seen = mongoengine.fields.DateTimeField()
+
+    #: Time at which the latest activity started
+    last_seen = mongoengine.fields.DateTimeField()
+
+    meta = {
+        'indexes': [
+            # Also used to find the edges of a model instance
+            {
+                'fields': ('app_label', 'model_name', 'related_pk', 'application_id', 'user_id', 'activity_type'),
+                'unique': True,
+            },
+            'application_id',
+            'user_id',
+        ],
+    }
+
+    #: Fields which identify an edge
+    key_fields = ('app_label', 'model_name', 'related_pk', 'application_id', 'user_id', 'activity_type')
+
+    @classmethod
+    def _get_edges(cls, wrappers: typing.Iterable[typing.Mapping[str, typing.Any]]) -> typing.Dict[tuple, typing.Dict]:
+        """
+        Summarise raw :class:`ProvWrapper` documents by edge.
+
+        :param wrappers: Raw :class:`ProvWrapper` documents
+        :return: Dictionary mapping edge keys to count and time of first and latest activity
+        """
+        edges = {}
+
+        for wrapper in wrappers:
+            if wrapper.get('timestamp') is None:
+                continue
+
+            key = tuple(wrapper.get(field) for field in cls.key_fields)
+            edge = edges.setdefault(key, {
+                'count': 0,
+                'first_seen': wrapper['timestamp'],
+                'last_seen': wrapper['timestamp'],
+            })
+
+            # Estimated number of activities represented by the record
+            edge['count'] += wrapper.get('count', 1) * wrapper.get('sample_weight', 1)
+            edge['first_seen'] = min(edge['first_seen'], wrapper['timestamp'])
+            edge['last_seen'] = max(edge['last_seen'], wrapper['timestamp'])
+
+        return edges
+
+    @classmethod
+    def _write_edges(cls, edges: typing.Mapping[tuple, typing.Mapping], replace: bool = False) -> None:
+        updates = []
+        for key, edge in edges.items():
+            query = dict(zip(cls.key_fields, key))
+
+            if replace:
+                update = {'$set': edge}
+            else:
+                update = {
+                    '$inc': {'count': edge['count']},
+                    '$min': {'first_seen': edge['first_seen']},
+                    '$max': {'last_seen': edge['last_seen']},
+                }
+
+            updates.append(pymongo.UpdateOne(query, update, upsert=True))
+
+        if updates:
+            cls._get_collection().bulk_write(updates, ordered=False)
+
+    @classmethod
+    def increment(cls, wrappers: typing.Iterable[typing.Mapping[str, typing.Any]]) -> None:
+        """
+        Add newly written PROV records to the lineage graph.
+
+        :param wrappers: Raw :class:`ProvWrapper` documents which have been written
+        """
+        cls._write_edges(cls._get_edges(wrappers))
+
+    @classmethod
+    def rebuild(cls, batch_size: int = 10000) -> int:
+        """
+        Recalculate the lineage graph from all PROV records, replacing any existing edges.
+
+        Edges of PROV records which have been archived are kept, but their counts will not include archived records.
+
+        :param batch_size: Number of PROV records to read from the database at once
+        :return: Number of edges written
+        """
+        projection = {field: 1 for field in cls.key_fields + ('timestamp', 'count', 'sample_weight')}
+        wrappers = ProvWrapper._get_collection().find({'timestamp': {'$ne': None}}, projection,
+                                                      batch_size=batch_size)
+
+        edges = cls._get_edges(wrappers)
+        cls._write_edges(edges, replace=True)
+
+        return len(edges)
+
+    @classmethod
+    def _add_to_graph(cls, graph: networkx.MultiDiGraph, edge: typing.Mapping[str, typing.Any]) -> typing.List[tuple]:
+        """
+        Add a raw edge document to a lineage graph.
+
+        :return: Nodes of the edge - as (node type, key) pairs
+        """
+        entity_id = ProvEntry.get_entity_id(edge['model_name'], edge['related_pk'])
+        graph.add_node(entity_id, type='entity',
+                       app_label=edge['app_label'], model_name=edge['model_name'], pk=edge['related_pk'])
+        graph.add_node(edge['application_id'], type='application')
+        graph.add_node(edge['user_id'], type='user')
+
+        attributes = {
+            'activity': edge.get('activity_type'),
+            'count': edge.get('count', 0),
+            'first_seen': edge['first_seen'].replace(tzinfo=datetime.timezone.utc).isoformat(),
+            'last_seen': edge['last_seen'].replace(tzinfo=datetime.timezone.utc).isoformat(),
+        }
+
+        # The application acted upon the entity on behalf of the user
+        graph.add_edge(edge['application_id'], entity_id,
+                       key=(edge.get('activity_type'), edge['user_id']),
+                       relation='used', on_behalf_of=edge['user_id'], **attributes)
+
+        if graph.has_edge(edge['application_id'], edge['user_id'], key='actedOnBehalfOf'):
+            graph.edges[edge['application_id'], edge['user_id'], 'actedOnBehalfOf']['count'] += attributes['count']
+        else:
+            graph.add_edge(edge['application_id'], edge['user_id'], key='actedOnBehalfOf',
+                           relation='actedOnBehalfOf', count=attributes['count'])
+
+        return [
+            ('entity', (edge['app_label'], edge['model_name'], edge['related_pk'])),
+            ('application', edge['application_id']),
+            ('user', edge['user_id']),
+        ]
+
+    @classmethod
+    def traverse(cls,
+                 instance: typing.Optional[BaseAppDataModel] = None,
+                 application_id: typing.Optional[str] = None,
+                 user_id: typing.Optional[str] = None,
+                 depth: int = 1,
+                 max_edges: int = 1000) -> networkx.MultiDiGraph:
+        """
+        Build the lineage graph around a model instance, application or user.
+
+        Each step of the traversal follows all edges of the nodes reached by the previous step, using a single indexed
+        query.  e.g. with a depth of one from an application - the model instances it used and the users on whose
+        behalf it used them.  With a depth of two - also the other applications and users which used those instances.
+
+        Provide exactly one of 'instance', 'application_id' or 'user_id'.
+
+        :param instance: Model instance from which to start
+        :param application_id: PROV identifier of an application from which to start
+        :param user_id: PROV identifier of a user from which to start
+        :param depth: Number of steps to traverse
+        :param max_edges: Maximum number of edge documents to read - traversal stops early if reached
+        :return: Lineage graph - nodes are PROV identifiers with a 'type' of 'entity', 'application' or 'user'
+        """
+        if sum(start is not None for start in (instance, application_id, user_id)) != 1:
+            raise ValueError('Provide exactly one of instance, application_id or user_id')
+
+        frontier = {'entity': set(), 'application': set(), 'user': set()}
+        if instance is not None:
+            instance_type = ContentType.objects.get_for_model(instance)
+            frontier['entity'].add((instance_type.app_label, instance_type.model, instance.pk))
+        elif application_id is not None:
+            frontier['application'].add(application_id)
+        else:
+            frontier['user'].add(user_id)
+
+        visited = {node_type: set(nodes) for node_type, nodes in frontier.items()}
+        seen_edges = set()
+        graph = networkx.MultiDiGraph()
+
+        collection = cls._get_collection()
+        for _ in range(depth):
+            clauses = []
+
+            entities_by_model = {}
+            for app_label, model_name, pk in frontier['entity']:
+                entities_by_model.setdefault((app_label, model_name), []).append(pk)
+
+            for (app_label, model_name), pks in entities_by_model.items():
+                clauses.append({'app_label': app_label, 'model_name': model_name, 'related_pk': {'$in': pks}})
+
+            if frontier['application']:
+                clauses.append({'application_id': {'$in': list(frontier['application'])}})
+
+            if frontier['user']:
+                clauses.append({'user_id': {'$in': list(frontier['user'])}})
+
+            if not clauses:
+                break
+
+            frontier = {'entity': set(), 'application': set(), 'user': set()}
+            query = {'$or': clauses, '_id': {'$nin': list(seen_edges)}}
+            for edge in collection.find(query, limit=max_edges - len(seen_edges)):
+                seen_edges.add(edge['_id'])
+
+                for node_type, node in cls._add_to_graph(graph, edge):
+                    if node not in visited[node_type]:
+                        visited[node_type].add(node)
+                        frontier[node_type].add(node)
+
+            if len(seen_edges) >= max_edges:
+                break
+
+        return graph
+
+
+def _insert_unordered(collection: pymongo.collection.Collection,
+                      documents: typing.List[typing.Dict]) -> typing.Set[int]:
+    """
+    Insert documents into a collection, continuing past any which fail.
+
+    :return: Indices of documents which could not be inserted
+    """
+    try:
+        collection.insert_many(documents, ordered=False)
+
+    except pymongo.errors.BulkWriteError as exc:
+        return {error['index'] for error in exc.details['writeErrors']}
+
+    return set()
+
+
+def _write_prov_batch(batch: typing.List[typing.Tuple[typing.Dict, typing.Dict]]) -> None:
+    """
+    Write a batch of queued PROV records.
+
+    Entries are written before the wrappers which refer to them.
+    Unordered writes allow the rest of the batch to be written if a single record fails - only records whose entry
+    and wrapper were both written are counted in rollups and edges.
+
+    :param batch: List of (entry, wrapper) pairs of raw :class:`ProvEntry` and :class:`ProvWrapper` documents
+    :raises PartialBatchError: Some records could not be written
+    """
+    failed_entries = _insert_unordered(ProvEntry._get_collection(), [entry for entry, wrapper in batch])
+    batch = [record for i, record in enumerate(batch) if i not in failed_entries]
+
+    failed_wrappers = _insert_unordered(ProvWrapper._get_collection(), [wrapper for entry, wrapper in batch])
+    if failed_wrappers:
+        # Entries are never read without a wrapper
+        ProvEntry._get_collection().delete_many({
+            '_id': {'$in': [entry['_id'] for i, (entry, wrapper) in enumerate(batch) if i in failed_wrappers]}
+        })
+
+    wrappers = [wrapper for i, (entry, wrapper) in enumerate(batch) if i not in failed_wrappers]
+    if wrappers:
+        ProvRollup.increment(wrappers)
+        ProvEdge.increment(wrappers)
+
+    failed = len(failed_entries) + len(failed_wrappers)
+    if failed:
+        raise PartialBatchError(failed)
+
+
+#: Writes PROV records queued by :meth:`ProvWrapper.create_prov` in a background thread
+prov_writer = BatchWorker('prov_writer', _write_prov_batch,
+                          max_size=settings.PROV_QUEUE_SIZE,
+                          batch_size=settings.PROV_BATCH_SIZE,
+                          flush_interval=settings.PROV_FLUSH_INTERVAL)
+
+
+class ProvCoalescer:
+    """
+    Merges identical activities within a time window into a single PROV record with a count.
+
+    The first activity is held until its window has passed, during which time identical activities - by the same user
+    and application on the same object - increase its count.  The merged record is then queued on :data:`prov_writer`.
+    """
+    #: Wrapper fields which must match for activities to be merged
+    key_fields = ('app_label', 'model_name', 'related_pk', 'user_id', 'application_id', 'activity_type',
+                  'sample_weight')
+
+    def __init__(self, writer: BatchWorker):
+        self.writer = writer
+
+        self._pid = None
+        self._reset()
+
+        # Registered after the writer's drain, so runs before it at exit
+        atexit.register(self.flush)
+
+    def _reset(self) -> None:
+        """
+        Discard state inherited from a parent process after a fork, since threads are not inherited.
+        """
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._thread = None
+
+        #: Maps key to held (entry, wrapper, deadline)
+        self._pending = {}
+
+    def depth(self) -> int:
+        """
+        Get the number of merged records being held.
+        """
+        return len(self._pending)
+
+    def add(self, entry: typing.Dict, wrapper: typing.Dict, window: int) -> None:
+        """
+        Add an activity, merging it with an identical activity if one is being held.
+
+        :param entry: Raw :class:`ProvEntry` document
+        :param wrapper: Raw :class:`ProvWrapper` document
+        :param window: Time in seconds for which to hold a new record
+        """
+        if self._pid != os.getpid():
+            self._reset()
+
+        key = tuple(wrapper.get(field) for field in self.key_fields)
+        now = time.monotonic()
+
+        with self._lock:
+            held = self._pending.get(key)
+            if held is not None and held[2] > now:
+                held[1]['count'] += wrapper['count']
+                return
+
+            if held is not None:
+                self.writer.submit(held[:2])
+
+            self._pending[key] = (entry, wrapper, now + window)
+
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='prov_coalescer', daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(1)
+            self.flush(expired_only=True)
+
+    def flush(self, expired_only: bool = False) -> None:
+        """
+        Queue held records to be written.
+
+        :param expired_only: Only queue records whose window has passed?
+        """
+        if self._pid != os.getpid():
+            return
+
+        now = time.monotonic()
+        with self._lock:
+            keys = [key for key, held in self._pending.items() if not expired_only or held[2] <= now]
+            records = [self._pending.pop(key) for key in keys]
+
+        for entry, wrapper, deadline in records:
+            self.writer.submit((entry, wrapper))
+
+
+#: Merges identical activities before they are queued on :data:`prov_writer`
+prov_coalescer = ProvCoalescer(prov_writer)
+
+metrics.register_gauge('prov_coalescer.depth', prov_coalescer.depth)
+
 
 class ProvAbleModel:
     """
     Mixin for models which are capable of having updates tracked by PROV records.
 
     Creates a new PROV record every time the object is modified and saved.
+
+    Field values are recorded when an object is loaded or refreshed from the database and after each save,
+    so detecting a modification does not require the object to be read again.
     """
-    def save(self, *args, **kwargs):
-        try:
-            # Have to read existing saved version from database
-            existing = type(self).objects.get(pk=self.pk)
-            changed = False
+    #: Names of fields which do not cause a PROV record to be created when modified - e.g. usage counters
+    prov_exclude_fields = frozenset()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._prov_snapshot = instance._get_prov_state()
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+
+        # Refreshed fields now hold the values in the database
+        snapshot = getattr(self, '_prov_snapshot', None)
+        if fields is None:
+            self._prov_snapshot = self._get_prov_state()
+
+        elif snapshot is not None:
+            attnames = {self._meta.get_field(name).attname for name in fields}
+            snapshot.update((key, value) for key, value in self._get_prov_state().items() if key in attnames)
+
+    def _get_prov_state(self) -> typing.Dict[str, typing.Any]:
+        """
+        Get the current values of fields tracked by PROV.
+
+        Deferred fields which have not been loaded are not included.
+        """
+        return {
+            field.attname: self.__dict__[field.attname] for field in self._meta.concrete_fields
+            if field.attname in self.__dict__ and field.attname not in self.prov_exclude_fields
+        }
+
+    def _has_prov_changes(self, update_fields: typing.Optional[typing.Iterable[str]] = None) -> bool:
+        """
+        Have any fields tracked by PROV been modified since this object was loaded or last saved?
+
+        :param update_fields: Only consider these fields - as passed to :meth:`save`
+        """
+        snapshot = getattr(self, '_prov_snapshot', None)
+        if snapshot is None:
+            if self._state.adding and self.pk is None:
+                # First time this object has been saved
+                return True
+
+            # Not loaded from database - e.g. constructed with the primary key of an existing object
+            snapshot = type(self)._base_manager.filter(pk=self.pk).values(*self._get_prov_state()).first()
+            if snapshot is None:
+                return True
+
+        current = self._get_prov_state()
+        if update_fields is not None:
+            attnames = {self._meta.get_field(name).attname for name in update_fields}
+            current = {key: value for key, value in current.items() if key in attnames}
+
+        return any(key not in snapshot or snapshot[key] != value for key, value in current.items())
 
-            for field in self._meta.fields:
-                attr = field.attname
+    def _update_prov_snapshot(self, update_fields: typing.Optional[typing.Iterable[str]] = None) -> None:
+        """
+        Record the current values of fields tracked by PROV as those saved in the database.
+
+        :param update_fields: Only record these fields - as passed to :meth:`save`
+        """
+        current = self._get_prov_state()
+        snapshot = getattr(self, '_prov_snapshot', None)
 
-                if getattr(existing, attr) != getattr(self, attr):
-                    changed = True
-                    break
+        if update_fields is not None and snapshot is not None:
+            attnames = {self._meta.get_field(name).attname for name in update_fields}
+            snapshot.update((key, value) for key, value in current.items() if key in attnames)
 
-        except type(self).DoesNotExist:
-            # First time this object has been saved
-            changed = True
+        else:
+            self._prov_snapshot = current
+
+    def save(self, *args, **kwargs):
+        changed = self._has_prov_changes(kwargs.get('update_fields'))
 
         super().save(*args, **kwargs)
+        self._update_prov_snapshot(kwargs.get('update_fields'))
 
         if changed:
             ProvWrapper.create_prov(
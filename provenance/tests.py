@@ -2,13 +2,22 @@
 Tests for PROV tracking functionality and the models required to support it.
 """
 
+import datetime
+import gzip
+import io
 import json
+import os
 import pathlib
+import tempfile
+from unittest import mock
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.models import ContentType
-from django.test import TestCase
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 
 import jsonschema
 import mongoengine
@@ -16,7 +25,7 @@ from mongoengine.queryset.visitor import Q
 
 from applications.models import Application
 from datasources.models import DataSource
-from provenance import models
+from provenance import archive, models
 
 
 # Create connection to test DB
@@ -60,6 +69,30 @@ class ProvEntryTest(TestCase):
 
         self.assertIsNotNone(entry)
 
+    def test_prov_fast_path_conformance(self):
+        """
+        Test that the fast path gives the same PROV-JSON as the PROV library.
+        """
+        application = Application.objects.create(
+            name='Test Application',
+            url='http://www.example.com',
+            owner=self.user,
+        )
+
+        for app in [None, application]:
+            for activity_type in models.ProvActivity:
+                params = models.ProvEntry.get_prov_params(self.datasource, self.user.get_uri(),
+                                                          application=app,
+                                                          activity_type=activity_type)
+
+                expected = json.loads(models.ProvEntry.build_prov_document(params).serialize())
+                self.assertEqual(expected, models.ProvEntry.build_prov_json(params))
+
+                # PROV library omits microseconds from timestamps when zero
+                params['start_time'] = params['start_time'].replace(microsecond=0)
+                expected = json.loads(models.ProvEntry.build_prov_document(params).serialize())
+                self.assertEqual(expected, models.ProvEntry.build_prov_json(params))
+
     # TODO test content of PROV document - not just compliance to spec
     def test_prov_schema(self):
         """
@@ -145,6 +178,83 @@ class ProvWrapperTest(TestCase):
         # No PROV record should be created when saving a model that has not changed
         self.assertEqual(self._count_prov(self.datasource), n_provs)
 
+    def test_prov_datasource_loaded_null_update(self):
+        """
+        Test that saving an unchanged model loaded from the database does not read it again.
+        """
+        datasource = DataSource.objects.get(pk=self.datasource.pk)
+        n_provs = self._count_prov(datasource)
+
+        with CaptureQueriesContext(connection) as context:
+            datasource.save()
+
+        # Changes are detected using the values recorded when the model was loaded
+        selects = [query['sql'] for query in context.captured_queries
+                   if query['sql'].startswith('SELECT') and 'FROM "datasources_datasource"' in query['sql']]
+        self.assertFalse(selects)
+
+        self.assertEqual(self._count_prov(datasource), n_provs)
+
+    def test_prov_datasource_refresh(self):
+        """
+        Test that changes are detected against the values in the database after a model is refreshed.
+        """
+        datasource = DataSource.objects.get(pk=self.datasource.pk)
+        n_provs = self._count_prov(datasource)
+
+        DataSource.objects.filter(pk=datasource.pk).update(description='Changed elsewhere')
+        datasource.refresh_from_db()
+        datasource.save()
+
+        self.assertEqual(self._count_prov(datasource), n_provs)
+
+        datasource.description = 'Test description'
+        datasource.save()
+
+        self.assertEqual(self._count_prov(datasource), n_provs + 1)
+
+    def test_prov_datasource_constructed_null_update(self):
+        """
+        Test that saving an unchanged model constructed with the primary key of an existing object is not recorded.
+        """
+        n_provs = self._count_prov(self.datasource)
+
+        values = {field.attname: getattr(self.datasource, field.attname)
+                  for field in DataSource._meta.concrete_fields}
+        datasource = DataSource(**values)
+        datasource.save()
+
+        self.assertEqual(self._count_prov(datasource), n_provs)
+
+        datasource = DataSource(**dict(values, description='Test description'))
+        datasource.save()
+
+        self.assertEqual(self._count_prov(datasource), n_provs + 1)
+
+    def test_prov_datasource_excluded_fields(self):
+        """
+        Test that no new :class:`ProvEntry` is created when only excluded fields are changed.
+        """
+        datasource = DataSource.objects.get(pk=self.datasource.pk)
+        n_provs = self._count_prov(datasource)
+
+        datasource.external_requests += 1
+        datasource.external_requests_total += 1
+        datasource.save(update_fields=['external_requests', 'external_requests_total'])
+
+        self.assertEqual(self._count_prov(datasource), n_provs)
+        self.assertEqual(DataSource.objects.get(pk=datasource.pk).external_requests_total, 1)
+
+        # Fields not included in update_fields are not considered
+        datasource.description = 'Test description'
+        datasource.save(update_fields=['external_requests'])
+
+        self.assertEqual(self._count_prov(datasource), n_provs)
+
+        datasource.save()
+
+        self.assertEqual(self._count_prov(datasource), n_provs + 1)
+
     def test_prov_records_distinct(self):
         """
         Test that :class:`ProvEntry`s are not reused.
@@ -161,6 +271,361 @@ class ProvWrapperTest(TestCase):
         intersection = set(prov_entries).intersection(new_prov_entries)
         self.assertFalse(intersection)
 
+    def test_prov_query_fields(self):
+        """
+        Test that :class:`ProvWrapper` documents store the fields used to query PROV records.
+        """
+        models.ProvWrapper.create_prov(self.datasource, self.user.get_uri(),
+                                       activity_type=models.ProvActivity.ACCESS)
+
+        wrapper = models.ProvWrapper.objects(related_pk=self.datasource.pk,
+                                             activity_type=models.ProvActivity.ACCESS.value).get()
+        self.assertEqual(wrapper.application_id, 'piot:app-pedasi')
+        self.assertIn(wrapper.user_id, wrapper.entry.agent)
+        self.assertIsNotNone(wrapper.timestamp)
+
+    def test_prov_query_fields_backfill(self):
+        """
+        Test that the query fields of existing :class:`ProvWrapper` documents are filled from their PROV records.
+        """
+        wrappers = models.ProvWrapper.objects(related_pk=self.datasource.pk)
+        wrappers.update(unset__user_id=True, unset__application_id=True,
+                        unset__activity_type=True, unset__timestamp=True)
+        n_wrappers = wrappers.count()
+
+        # PROV record with none of the fields - must be skipped rather than fail the whole batch
+        empty_entry = models.ProvEntry(activity={})
+        empty_entry.save()
+        empty_wrapper = models.ProvWrapper(app_label='datasources', model_name='datasource',
+                                           related_pk=self.datasource.pk, entry=empty_entry)
+        empty_wrapper.save()
+
+        call_command('prov_query_fields_backfill', batch_size=1, stdout=io.StringIO())
+
+        empty_wrapper.reload()
+        self.assertIsNone(empty_wrapper.timestamp)
+        empty_wrapper.delete()
+
+        wrappers = models.ProvWrapper.objects(related_pk=self.datasource.pk)
+        self.assertEqual(wrappers.count(), n_wrappers)
+        for wrapper in wrappers:
+            self.assertEqual(wrapper.activity_type, models.ProvActivity.UPDATE.value)
+            self.assertEqual(wrapper.application_id, 'piot:app-pedasi')
+            self.assertIn(wrapper.user_id, wrapper.entry.agent)
+            self.assertIsNotNone(wrapper.timestamp)
+
+    def test_prov_rollup_rebuild(self):
+        """
+        Test that rebuilding :class:`ProvRollup`\ s from PROV records gives the same counts as incremental updates.
+        """
+        # Records left by other tests with the same primary key
+        models.ProvWrapper.objects(related_pk=self.datasource.pk).delete()
+        models.ProvRollup.objects(related_pk=self.datasource.pk).delete()
+
+        for _ in range(3):
+            models.ProvWrapper.create_prov(self.datasource, self.user.get_uri(),
+                                           activity_type=models.ProvActivity.ACCESS)
+
+        def get_counts():
+            return {
+                (rollup.granularity, rollup.bucket, rollup.activity_type): rollup.count
+                for rollup in models.ProvRollup.objects(related_pk=self.datasource.pk)
+            }
+
+        counts = get_counts()
+        self.assertEqual(counts[('day', models.RollupGranularity.DAY.truncate(
+            models.ProvWrapper.objects(related_pk=self.datasource.pk).first().timestamp
+        ), models.ProvActivity.ACCESS.value)], 3)
+
+        models.ProvRollup.objects(related_pk=self.datasource.pk).delete()
+        models.ProvRollup.rebuild()
+
+        self.assertEqual(get_counts(), counts)
+        models.ProvRollup.objects(related_pk=self.datasource.pk).delete()
+
+    @override_settings(PROV_ASYNC_WRITES=True)
+    def test_prov_batch_partial_failure(self):
+        """
+        Test that records in a batch which were written are counted when other records in the batch fail.
+        """
+        # Records left by other tests with the same primary key
+        models.prov_writer.drain()
+        models.ProvWrapper.objects(related_pk=self.datasource.pk).delete()
+        models.ProvRollup.objects(related_pk=self.datasource.pk).delete()
+
+        batch = []
+        with mock.patch.object(models.prov_writer, 'submit', batch.append):
+            for _ in range(3):
+                models.ProvWrapper.create_prov(self.datasource, self.user.get_uri(),
+                                               activity_type=models.ProvActivity.ACCESS, asynchronous=True)
+
+        # Entry has already been written - e.g. a batch retried after a partial failure
+        models.ProvEntry._get_collection().insert_one(dict(batch[1][0]))
+
+        with self.assertRaises(models.PartialBatchError) as context:
+            models._write_prov_batch(batch)
+
+        self.assertEqual(context.exception.failed, 1)
+        self.assertEqual(models.ProvWrapper.objects(related_pk=self.datasource.pk).count(), 2)
+        self.assertEqual(sum(rollup.count for rollup in models.ProvRollup.objects(
+            related_pk=self.datasource.pk, granularity=models.RollupGranularity.DAY.value
+        )), 2)
+
+        models.ProvWrapper.objects(related_pk=self.datasource.pk).delete()
+        models.ProvRollup.objects(related_pk=self.datasource.pk).delete()
+
+    def test_prov_lineage_rebuild(self):
+        """
+        Test that rebuilding the lineage graph from PROV records gives the same edges as incremental updates.
+        """
+        # Records left by other tests with the same primary key
+        models.prov_writer.drain()
+        models.ProvWrapper.objects(related_pk=self.datasource.pk).delete()
+        models.ProvEdge.objects(related_pk=self.datasource.pk).delete()
+
+        for _ in range(3):
+            models.ProvWrapper.create_prov(self.datasource, self.user.get_uri(),
+                                           activity_type=models.ProvActivity.ACCESS)
+
+        def get_edges():
+            return {
+                (edge.application_id, edge.user_id, edge.activity_type): (edge.count, edge.first_seen, edge.last_seen)
+                for edge in models.ProvEdge.objects(related_pk=self.datasource.pk)
+            }
+
+        edges = get_edges()
+        self.assertEqual(len(edges), 1)
+
+        count, first_seen, last_seen = next(iter(edges.values()))
+        self.assertEqual(count, 3)
+        self.assertLessEqual(first_seen, last_seen)
+
+        models.ProvEdge.objects(related_pk=self.datasource.pk).delete()
+        models.ProvEdge.rebuild()
+
+        self.assertEqual(get_edges(), edges)
+
+        graph = models.ProvEdge.traverse(instance=self.datasource)
+        entity_id = models.ProvEntry.get_entity_id('datasource', self.datasource.pk)
+        self.assertEqual(graph.nodes[entity_id]['type'], 'entity')
+        self.assertEqual(graph.in_degree(entity_id), 1)
+
+        models.ProvEdge.objects(related_pk=self.datasource.pk).delete()
+
+    @override_settings(PROV_ASYNC_WRITES=False)
+    def test_prov_archive(self):
+        """
+        Test that old PROV records are archived to files, counted in rollups and deleted.
+        """
+        # Records left by other tests with the same primary key
+        models.prov_writer.drain()
+        for _ in range(2):
+            models.ProvWrapper.create_prov(self.datasource, self.user.get_uri(),
+                                           activity_type=models.ProvActivity.ACCESS)
+
+        datasource_type = ContentType.objects.get_for_model(DataSource)
+        instance_filter = {
+            'app_label': datasource_type.app_label,
+            'model_name': datasource_type.model,
+            'related_pk': self.datasource.pk,
+        }
+        models.ProvRollup.objects(**instance_filter).delete()
+
+        wrappers = models.ProvWrapper.objects(**instance_filter)
+        old_time = datetime.datetime(2019, 1, 1, 12)
+        wrappers.update(set__timestamp=old_time)
+        entry_ids = [wrapper.entry.id for wrapper in wrappers]
+
+        models.ProvArchiveDay.objects.delete()
+
+        # Incomplete rollup for a day not yet archived - must be rebuilt rather than trusted
+        models.ProvRollup(granularity='day', bucket=old_time.replace(hour=0), count=0,
+                          application_id=wrappers[0].application_id, activity_type=wrappers[0].activity_type,
+                          **instance_filter).save()
+
+        delete_documents = models.ProvWrapper.delete_documents
+        calls = []
+
+        def interrupted_delete(documents):
+            # Delete the first batch then fail after writing the second to the archive
+            calls.append(documents)
+            if len(calls) > 1:
+                raise RuntimeError('Interrupted')
+            delete_documents(documents)
+
+        with tempfile.TemporaryDirectory() as archive_dir:
+            with mock.patch.object(models.ProvWrapper, 'delete_documents', interrupted_delete):
+                with self.assertRaises(RuntimeError):
+                    archive.archive_records(datetime.datetime(2019, 1, 2), archive_dir, batch_size=1)
+
+            n_archived = archive.archive_records(datetime.datetime(2019, 1, 2), archive_dir, batch_size=1)
+            self.assertEqual(n_archived, len(entry_ids) - 1)
+
+            with gzip.open(archive.get_archive_path(archive_dir, old_time.date()), 'rt') as archive_file:
+                records = [json.loads(line) for line in archive_file]
+
+        # Records written before the interruption are not duplicated
+        self.assertEqual(len(records), len(entry_ids))
+        self.assertEqual({record['entry']['_id']['$oid'] for record in records}, {str(id) for id in entry_ids})
+
+        self.assertEqual(models.ProvWrapper.objects(**instance_filter).count(), 0)
+        self.assertEqual(models.ProvEntry.objects(id__in=entry_ids).count(), 0)
+
+        rollups = models.ProvRollup.objects(granularity='day', **instance_filter)
+        self.assertEqual({rollup.bucket for rollup in rollups}, {old_time.replace(hour=0)})
+        self.assertEqual(sum(rollup.count for rollup in rollups), len(entry_ids))
+
+        models.ProvRollup.objects(**instance_filter).delete()
+        models.ProvArchiveDay.objects.delete()
+
+    def test_prov_archive_truncated(self):
+        """
+        Test that an archive file left incomplete by an interrupted write is repaired before more records are added.
+        """
+        with tempfile.TemporaryDirectory() as archive_dir:
+            path = archive.get_archive_path(archive_dir, datetime.date(2019, 1, 1))
+            os.makedirs(os.path.dirname(path))
+
+            with gzip.open(path, 'wt') as archive_file:
+                archive_file.write('{"wrapper": {"_id": 1}, "entry": null}\n')
+            with open(path, 'ab') as archive_file:
+                archive_file.write(gzip.compress(b'{"wrapper": {"_id": 2}, "entry": null}\n')[:20])
+
+            self.assertEqual(archive._read_archived_ids(path), {1})
+
+            with gzip.open(path, 'rt') as archive_file:
+                self.assertEqual(len(archive_file.readlines()), 1)
+
+    @override_settings(PROV_ASYNC_WRITES=False)
+    def test_prov_delete_records(self):
+        """
+        Test that PROV records are deleted in bulk by model instance and time range.
+        """
+        models.prov_writer.drain()
+        datasource_type = ContentType.objects.get_for_model(DataSource)
+        instance_filter = {
+            'app_label': datasource_type.app_label,
+            'model_name': datasource_type.model,
+            'related_pk': self.datasource.pk,
+        }
+
+        # Records left by other tests with the same primary key
+        models.ProvWrapper.delete_records(instance=self.datasource)
+
+        for _ in range(3):
+            models.ProvWrapper.create_prov(self.datasource, self.user.get_uri(),
+                                           activity_type=models.ProvActivity.ACCESS)
+
+        old_time = datetime.datetime(2019, 1, 1, 12)
+        old_wrapper = models.ProvWrapper.objects(**instance_filter).first()
+        old_wrapper.update(set__timestamp=old_time)
+        old_entry_id = old_wrapper.entry.id
+
+        with self.assertRaises(ValueError):
+            models.ProvWrapper.delete_records()
+
+        progress = mock.Mock()
+        n_deleted = models.ProvWrapper.delete_records(instance=self.datasource, until=datetime.datetime(2019, 1, 2),
+                                                      batch_size=1, progress=progress)
+        self.assertEqual(n_deleted, 1)
+        progress.assert_called_once_with(1)
+        self.assertEqual(models.ProvEntry.objects(id=old_entry_id).count(), 0)
+
+        # Summaries are kept when only some records are deleted
+        self.assertTrue(models.ProvRollup.objects(**instance_filter).count())
+
+        entry_ids = [wrapper.entry.id for wrapper in models.ProvWrapper.objects(**instance_filter)]
+        self.assertTrue(entry_ids)
+
+        call_command('delete_prov', datasource=self.datasource.pk, interactive=False, batch_size=2,
+                     stdout=io.StringIO())
+
+        self.assertEqual(models.ProvWrapper.objects(**instance_filter).count(), 0)
+        self.assertEqual(models.ProvEntry.objects(id__in=entry_ids).count(), 0)
+        self.assertEqual(models.ProvRollup.objects(**instance_filter).count(), 0)
+        self.assertEqual(models.ProvEdge.objects(**instance_filter).count(), 0)
+
+    def test_prov_sampling(self):
+        """
+        Test that sampled PROV records are weighted in rollups.
+        """
+        # Records left by other tests with the same primary key
+        models.prov_writer.drain()
+        models.ProvWrapper.objects(related_pk=self.datasource.pk,
+                                   activity_type=models.ProvActivity.ACCESS.value).delete()
+        models.ProvRollup.objects(related_pk=self.datasource.pk).delete()
+
+        for sampled in [False, True, False]:
+            with mock.patch('provenance.models.random.randrange', return_value=0 if sampled else 1):
+                entry = models.ProvWrapper.create_prov(self.datasource, self.user.get_uri(),
+                                                       activity_type=models.ProvActivity.ACCESS,
+                                                       sample_rate=3)
+            self.assertEqual(entry is not None, sampled)
+
+        wrapper = models.ProvWrapper.objects.get(related_pk=self.datasource.pk,
+                                                 activity_type=models.ProvActivity.ACCESS.value)
+        self.assertEqual(wrapper.sample_weight, 3)
+
+        rollup = models.ProvRollup.objects.get(related_pk=self.datasource.pk, granularity='hour')
+        self.assertEqual(rollup.count, 3)
+
+        models.ProvRollup.objects(related_pk=self.datasource.pk).delete()
+
+    @override_settings(PROV_ASYNC_WRITES=True)
+    def test_prov_coalescing(self):
+        """
+        Test that identical activities within the coalesce window are merged into a single PROV record.
+        """
+        # Records left by other tests with the same primary key
+        models.prov_writer.drain()
+        models.ProvWrapper.objects(related_pk=self.datasource.pk,
+                                   activity_type=models.ProvActivity.ACCESS.value).delete()
+        models.ProvRollup.objects(related_pk=self.datasource.pk).delete()
+
+        for _ in range(3):
+            models.ProvWrapper.create_prov(self.datasource, self.user.get_uri(),
+                                           activity_type=models.ProvActivity.ACCESS,
+                                           asynchronous=True,
+                                           coalesce_window=60)
+
+        self.assertEqual(models.prov_coalescer.depth(), 1)
+
+        models.prov_coalescer.flush()
+        models.prov_writer.drain()
+
+        wrapper = models.ProvWrapper.objects.get(related_pk=self.datasource.pk,
+                                                 activity_type=models.ProvActivity.ACCESS.value)
+        self.assertEqual(wrapper.count, 3)
+
+        rollup = models.ProvRollup.objects.get(related_pk=self.datasource.pk, granularity='hour')
+        self.assertEqual(rollup.count, 3)
+
+        models.ProvRollup.objects(related_pk=self.datasource.pk).delete()
+
+    @override_settings(PROV_ASYNC_WRITES=True)
+    def test_prov_async_write(self):
+        """
+        Test that a queued :class:`ProvEntry` and its :class:`ProvWrapper` are written when the queue is drained.
+        """
+        # Records queued by other tests
+        models.prov_writer.drain()
+
+        n_provs = self._count_prov(self.datasource)
+        processed = models.prov_writer.processed
+
+        models.ProvWrapper.create_prov(self.datasource, self.user.get_uri(),
+                                       activity_type=models.ProvActivity.ACCESS,
+                                       asynchronous=True)
+        models.prov_writer.drain()
+
+        self.assertEqual(models.prov_writer.depth(), 0)
+        self.assertEqual(models.prov_writer.processed, processed + 1)
+        self.assertEqual(self._count_prov(self.datasource), n_provs + 1)
+
+        # Queued wrapper must refer to the queued entry
+        wrapper = models.ProvWrapper.objects(related_pk=self.datasource.pk).order_by('-id').first()
+        self.assertEqual(wrapper.entry.activity.popitem()[1]['prov:type'], models.ProvActivity.ACCESS.value)
+
 
 class ProvApplicationTest(TestCase):
     """